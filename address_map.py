@@ -0,0 +1,95 @@
+# address_map.py
+
+from memory import MemObject
+import bisect
+
+class AddressMap:
+    # maps cpu addresses to (index into memories, address inside that memory)
+    # memories are laid out in list order, each covering addr_range bytes starting at its addr_start,
+    # or right after the previous memory when addr_start is None
+    def __init__(self, memories: list[MemObject], page_bits: int = 12, max_table_pages: int = 1 << 20, allow_gaps: bool = False) -> None:
+        self.bases = []
+        self.limits = []
+        cursor = 0
+        for i, memory in enumerate(memories):
+            base = cursor if memory.addr_start is None else memory.addr_start
+            if base < cursor:
+                raise ValueError(f"Memory {i} at 0x{base:08X} overlaps the previous memory ending at 0x{cursor:08X}")
+            if base > cursor and not allow_gaps:
+                raise ValueError(f"Gap in address space between 0x{cursor:08X} and memory {i} at 0x{base:08X}")
+            self.bases.append(base)
+            self.limits.append(base + memory.addr_range)
+            cursor = base + memory.addr_range
+
+        # direct lookup table with one entry per page, -1 when a page is not covered by exactly one memory
+        self.page_bits = page_bits
+        self.table = None
+        num_pages = (cursor + (1 << page_bits) - 1) >> page_bits
+        if num_pages <= max_table_pages:
+            self.table = [-1] * num_pages
+            for i in range(len(memories)):
+                first_page = (self.bases[i] + (1 << page_bits) - 1) >> page_bits
+                last_page = self.limits[i] >> page_bits # first page not fully covered at the end
+                for page in range(first_page, last_page):
+                    self.table[page] = i
+
+    def lookup(self, addr: int) -> tuple[int,int]:
+        page = addr >> self.page_bits
+        if self.table is not None and page < len(self.table) and self.table[page] >= 0:
+            i = self.table[page]
+            return i, addr - self.bases[i]
+        i = bisect.bisect_right(self.bases, addr) - 1
+        if i < 0 or addr >= self.limits[i]:
+            raise IndexError("Out of bounds memory access")
+        return i, addr - self.bases[i]
+
+if __name__ == "__main__":
+    print("AddressMap Test Begin")
+    dram = MemObject(size=8192, addr_range=8192, read_latency=100, write_latency=10, addr_start=0)
+    gemm_cache = MemObject(size=100, addr_range=100, read_latency=1, write_latency=1, addr_start=8192)
+    cache = MemObject(size=256, addr_range=4096, read_latency=1, write_latency=1) # placed after the gemm cache
+    address_map = AddressMap([dram, gemm_cache, cache])
+
+    # Test lookups through the page table and through bisect for pages shared by two memories
+    assert address_map.lookup(0) == (0, 0)
+    assert address_map.lookup(8191) == (0, 8191)
+    assert address_map.lookup(8192) == (1, 0)
+    assert address_map.lookup(8291) == (1, 99)
+    assert address_map.lookup(8292) == (2, 0)
+    assert address_map.lookup(8292 + 4095) == (2, 4095)
+    assert address_map.table[0] == 0 and address_map.table[1] == 0 and address_map.table[2] == -1
+
+    # Test out of bounds access
+    try:
+        address_map.lookup(8292 + 4096)
+        print("Failed, should have been out of bounds")
+    except IndexError:
+        pass
+
+    # Test the same lookups without a page table
+    address_map = AddressMap([dram, gemm_cache, cache], max_table_pages=0)
+    assert address_map.table is None
+    assert address_map.lookup(8191) == (0, 8191)
+    assert address_map.lookup(8292) == (2, 0)
+
+    # Test overlap and gap validation
+    try:
+        AddressMap([dram, MemObject(size=100, addr_range=100, read_latency=1, write_latency=1, addr_start=8000)])
+        print("Failed, should have detected overlap")
+    except ValueError:
+        pass
+
+    gapped = MemObject(size=100, addr_range=100, read_latency=1, write_latency=1, addr_start=16384)
+    try:
+        AddressMap([dram, gapped])
+        print("Failed, should have detected gap")
+    except ValueError:
+        pass
+    address_map = AddressMap([dram, gapped], allow_gaps=True)
+    assert address_map.lookup(16384) == (1, 0)
+    try:
+        address_map.lookup(10000)
+        print("Failed, should have been out of bounds")
+    except IndexError:
+        pass
+    print("AddressMap Test Finished")
@@ -4,12 +4,17 @@ from cpu import Cpu, CpuLatencies
 from dram import Dram
 from gemm_cache import Cache
 from program import Program
+from prefetcher import make_prefetcher
 import numpy as np
+import json
 
 MATRIX_DIM = 4 # matrices are size MATRIX_DIM by MATRIX_DIM
+PREFETCHER = "next_line" # L1 prefetcher: None, "next_line", "stride" or "stream"
 
 dram = Dram(32768, 0, 100, 10)
-cache = Cache(256, 32768, 8, 1, 1, dram)
+l2_cache = Cache(4096, 32768, 8, 4, 4, dram, associativity=4, inclusion="inclusive") # L1 -> L2 -> DRAM
+prefetcher = make_prefetcher(PREFETCHER, 8, degree=2) if PREFETCHER is not None else None
+cache = Cache(256, 32768, 8, 1, 1, l2_cache, prefetcher=prefetcher)
 cpu_latencies = CpuLatencies()
 REGISTER_BYTES = 4
 cpu = Cpu([cache], 32, REGISTER_BYTES, -1, cpu_latencies)
@@ -107,7 +112,9 @@ program.halt()
 
 cpu.run_program(program)
 
-cache.evict_cache() # for syncing to memory
+sync_cycles = cache.flush_all_levels() # for syncing to memory, only dirty blocks are written back
+print(f"Flushed cache to DRAM in {sync_cycles} cycles")
+print(json.dumps(cpu.collect_stats(), indent=2)) # prefetcher stats are nested under the L1 cache
 
 matrix_C = []
 for i in range(rows_C):
@@ -0,0 +1,5 @@
+# benchmarks/__init__.py
+# host side throughput benchmarks of the simulator itself, run with python3 -m benchmarks
+
+from benchmarks.workloads import WORKLOADS, QUICK_WORKLOADS
+from benchmarks.runner import run_benchmarks, compare_results, load_results, save_results
@@ -0,0 +1,37 @@
+# benchmarks/__main__.py
+# python3 -m benchmarks run [--quick] [--output results.json] [workload ...]
+# python3 -m benchmarks compare base.json new.json [--threshold 0.1]
+# python3 -m benchmarks list
+
+from benchmarks.workloads import WORKLOADS, QUICK_WORKLOADS
+from benchmarks.runner import run_benchmarks, compare_results, load_results, save_results
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(prog="python3 -m benchmarks", description="Simulator throughput benchmarks")
+subparsers = parser.add_subparsers(dest="command", required=True)
+run_parser = subparsers.add_parser("run", help="run workloads and save the results as JSON")
+run_parser.add_argument("workloads", nargs="*", help="workloads to run, defaults to all of them")
+run_parser.add_argument("--quick", action="store_true", help="only run the quick subset")
+run_parser.add_argument("--repeat", type=int, default=3, help="runs per workload, the fastest is kept")
+run_parser.add_argument("--output", default="benchmark_results.json")
+compare_parser = subparsers.add_parser("compare", help="compare two result files")
+compare_parser.add_argument("base")
+compare_parser.add_argument("new")
+compare_parser.add_argument("--threshold", type=float, default=0.1, help="slowdown fraction reported as a regression")
+subparsers.add_parser("list", help="list the workloads")
+args = parser.parse_args()
+
+if args.command == "list":
+    for name in WORKLOADS:
+        print(f"{name}{' (quick)' if name in QUICK_WORKLOADS else ''}")
+elif args.command == "run":
+    names = args.workloads or (QUICK_WORKLOADS if args.quick else list(WORKLOADS.keys()))
+    save_results(run_benchmarks(names, args.repeat), args.output)
+    print(f"Saved results to {args.output}")
+else:
+    regressions = compare_results(load_results(args.base), load_results(args.new), args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    print("No regressions")
@@ -0,0 +1,72 @@
+# benchmarks/runner.py
+
+from benchmarks.workloads import WORKLOADS
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import platform
+import resource
+import datetime
+import time
+import json
+import sys
+import numpy as np
+
+def measure(name: str) -> dict:
+    # runs in a fresh process so the peak RSS belongs to this workload only
+    function, args, kwargs = WORKLOADS[name]
+    start = time.perf_counter()
+    ops = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_rss_mb = max_rss / (1 << 20) if sys.platform == "darwin" else max_rss / (1 << 10)
+    return {"seconds": seconds, "ops": ops, "ops_per_second": ops / seconds, "peak_rss_mb": peak_rss_mb}
+
+def run_benchmarks(names: list[str], repeat: int = 3) -> dict:
+    # the fastest of repeat runs is kept, every run gets its own spawned process
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        assert name in WORKLOADS, f"Unknown workload {name}, expected one of {list(WORKLOADS.keys())}"
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(measure, name).result())
+        best = min(runs, key=lambda run: run["seconds"])
+        best["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+        results[name] = best
+        print(f"{name:24} {best['seconds']:9.3f} s {best['ops_per_second']:14.0f} ops/s {best['peak_rss_mb']:8.1f} MB")
+    return {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "repeat": repeat
+        },
+        "results": results
+    }
+
+def save_results(results: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def compare_results(base: dict, new: dict, threshold: float = 0.1) -> list[str]:
+    # prints the change of every workload in both files, returns the workloads more than threshold slower
+    regressions = []
+    for name, base_result in base["results"].items():
+        if name not in new["results"]:
+            continue
+        new_result = new["results"][name]
+        ratio = new_result["seconds"] / base_result["seconds"]
+        rss_change = new_result["peak_rss_mb"] - base_result["peak_rss_mb"]
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:24} {base_result['seconds']:9.3f} s -> {new_result['seconds']:9.3f} s ({ratio - 1:+7.1%}) "
+              f"RSS {rss_change:+8.1f} MB{'  REGRESSION' if regressed else ''}")
+    return regressions
@@ -0,0 +1,103 @@
+# benchmarks/workloads.py
+
+from memory_array import MemoryArray, DenseMemoryArray, PagedMemoryArray
+from dram import Dram
+from gemm_cache import Cache, GemmCache, GemmCacheLatencies
+from packet import Packet, TilePacket, MatrixPacket
+import numpy as np
+import contextlib
+import re
+import io
+import os
+
+# each workload runs once and returns the number of simulated operations it performed
+# (accesses, packets or executed instructions), the runner divides it by the wall time
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEMORY_ARRAYS = {
+    "dict": lambda: MemoryArray(1 << 16),
+    "dense": lambda: DenseMemoryArray(1 << 16),
+    "paged": lambda: PagedMemoryArray(1 << 32)
+}
+
+def memory_array_load_store(kind: str, count: int) -> int:
+    memory = MEMORY_ARRAYS[kind]()
+    size = min(memory.size, 1 << 16) - 8
+    for i in range(count):
+        addr = (i * 97) % size
+        memory.store(addr, 4, i)
+        memory.load(addr, 4)
+    return 2 * count
+
+def dram_bulk_transfers(transfer_bytes: int, count: int) -> int:
+    dram = Dram(1 << 20, 0, 100, 10)
+    data = (1 << (transfer_bytes * 8)) - 1
+    for i in range(count):
+        addr = (i * transfer_bytes) % ((1 << 20) - transfer_bytes)
+        dram.process_packet(Packet(False, addr, transfer_bytes, data))
+        dram.process_packet(Packet(True, addr, transfer_bytes))
+    return 2 * count
+
+def dram_tile_transfers(dim: int, count: int) -> int:
+    dram = Dram(1 << 20, 0, 100, 10)
+    tile = np.ones((dim, dim), dtype=np.uint8)
+    for i in range(count):
+        dram.process_tile_packet(TilePacket(False, 0, dim, dim, 1024, tile))
+        dram.process_tile_packet(TilePacket(True, 0, dim, dim, 1024))
+    return 2 * count
+
+def cache_stream(stride: int, count: int) -> int:
+    # stride 1 mostly hits, a stride of the cache size misses every time
+    dram = Dram(1 << 20, 0, 100, 10)
+    cache = Cache(4096, 1 << 20, 64, 1, 1, dram, associativity=4)
+    for i in range(count):
+        cache.process_packet(Packet(i % 4 == 0, (i * stride) % (1 << 20), 4, i))
+    return count
+
+def gemm_matmul(matrix_dim: int, count: int) -> int:
+    gemm_cache = GemmCache(matrix_dim, 4, 0, GemmCacheLatencies(matrix_dim))
+    gemm_cache.elements[:] = np.arange(gemm_cache.elements.size) % 3
+    matrix_bytes = gemm_cache.matrix_bytes
+    for _ in range(count):
+        gemm_cache.process_matrix_op_packet(MatrixPacket(True, 0, matrix_bytes, 2 * matrix_bytes))
+    return count
+
+def run_script(name: str, **constants) -> int:
+    # run an example script with some of its top level constants replaced, returns the instructions its cpu executed
+    with open(os.path.join(REPO_DIR, name)) as f:
+        source = f.read()
+    for constant, value in constants.items():
+        source, count = re.subn(rf"^{constant} = .*$", f"{constant} = {value!r}", source, count=1, flags=re.MULTILINE)
+        assert count == 1, f"Error: {name} has no top level {constant}"
+    namespace = {"__name__": "__benchmark__"}
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        exec(compile(source, name, "exec"), namespace)
+    assert "is correct" in output.getvalue(), f"Error: {name} produced a wrong result"
+    return namespace["cpu"].instructions_executed
+
+# name -> (function, arguments, keyword arguments)
+WORKLOADS = {
+    "memory_array_dict": (memory_array_load_store, ("dict", 20000), {}),
+    "memory_array_dense": (memory_array_load_store, ("dense", 100000), {}),
+    "memory_array_paged": (memory_array_load_store, ("paged", 100000), {}),
+    "dram_bulk_4k": (dram_bulk_transfers, (4096, 5000), {}),
+    "dram_tile_64": (dram_tile_transfers, (64, 5000), {}),
+    "cache_hit_stream": (cache_stream, (1, 50000), {}),
+    "cache_miss_stream": (cache_stream, (4096, 50000), {}),
+    "gemm_matmul_dim4": (gemm_matmul, (4, 20000), {}),
+    "gemm_matmul_dim16": (gemm_matmul, (16, 20000), {}),
+    "gemm_matmul_dim64": (gemm_matmul, (64, 2000), {}),
+    "gemm_matmul_dim256": (gemm_matmul, (256, 50), {}),
+    "baseline_dim16": (run_script, ("baseline.py",), {"MATRIX_DIM": 16}),
+    "baseline_dim32": (run_script, ("baseline.py",), {"MATRIX_DIM": 32}),
+    "baseline_dim64": (run_script, ("baseline.py",), {"MATRIX_DIM": 64}),
+    "large_matrix_dim16": (run_script, ("large_matrix.py",), {"MATRIX_DIM": 16, "TILE_DIM": 4}),
+    "large_matrix_dim64": (run_script, ("large_matrix.py",), {"MATRIX_DIM": 64, "TILE_DIM": 16}),
+    "large_matrix_dim256": (run_script, ("large_matrix.py",), {"MATRIX_DIM": 256, "TILE_DIM": 32}),
+}
+
+# a subset that finishes in well under a minute
+QUICK_WORKLOADS = [
+    "memory_array_dense", "memory_array_paged", "dram_bulk_4k", "dram_tile_64", "cache_hit_stream",
+    "cache_miss_stream", "gemm_matmul_dim16", "gemm_matmul_dim64", "baseline_dim16", "large_matrix_dim64"
+]
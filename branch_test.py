@@ -6,9 +6,8 @@ import numpy as np
 
 MATRIX_DIM = 4 # matrices are size MATRIX_DIM by MATRIX_DIM
 
-dram = Dram(32768, 100, 10)
-# TODO: Either make Cache support variable size or fix it to a number
-cache = Cache(256, 32768, 8, 1, 1, dram) #TODO: change dram stuff arguments
+dram = Dram(32768, 0, 100, 10)
+cache = Cache(256, 32768, 8, 1, 1, dram)
 cpu_latencies = CpuLatencies()
 REGISTER_BYTES = 4
 cpu = Cpu([cache], 32, REGISTER_BYTES, -1, cpu_latencies)
@@ -28,3 +27,11 @@ program.halt()
 cpu.run_program(program)
 
 cpu.print_registers()
+
+# Same program with straight line register code translated into Python functions
+jit_cpu = Cpu([cache], 32, REGISTER_BYTES, -1, cpu_latencies)
+jit_cpu.run_program(program, jit=True)
+assert jit_cpu.registers == cpu.registers
+assert jit_cpu.time == cpu.time
+assert jit_cpu.pc == cpu.pc
+assert jit_cpu.instructions_executed == cpu.instructions_executed
@@ -1,8 +1,10 @@
 # cache_test.py
 
 from gemm_cache import Cache
-from packet import Packet
+from packet import Packet, TilePacket
 from dram import Dram
+from prefetcher import make_prefetcher
+import numpy as np
 
 if __name__ == "__main__":
     print("Testing Cache")
@@ -12,7 +14,7 @@ if __name__ == "__main__":
     CACHE_BLOCK_SIZE = 8
     CACHE_READ_LATENCY = 1
     CACHE_WRITE_LATENCY = 1
-    CACHE_DRAM = Dram(4096, 100, 10)
+    CACHE_DRAM = Dram(4096, 0, 100, 10)
 
     cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, CACHE_READ_LATENCY, CACHE_WRITE_LATENCY, CACHE_DRAM)
 
@@ -72,10 +74,161 @@ if __name__ == "__main__":
     for i in range(256):    
         test_load = Packet(load=True, addr=0x0000 + (i*4), size=1, data=i+2, latency=1)
         ret_pkt = cache.process_packet(test_load)
-        print(ret_pkt.data, i+2)
-        assert(ret_pkt.data == (i+2))
+        print(ret_pkt.data, (i+2) & 0xff)
+        assert(ret_pkt.data == (i+2) & 0xff) # single byte stores truncate
 
     #cache.print(0)
-    cache.dram.print(0)
+    cache.next_level.print(0)
+
+    # accesses that straddle two blocks
+    test_store = Packet(load=False, addr=0x0206, size=4, data=0x11223344, latency=1)
+    cache.process_packet(test_store)
+    test_load = Packet(load=True, addr=0x0206, size=4, data=None, latency=1)
+    assert(cache.process_packet(test_load).data == 0x11223344)
+    test_load = Packet(load=True, addr=0x0208, size=1, data=None, latency=1)
+    assert(cache.process_packet(test_load).data == 0x33)
+
+    # set associative caches with each replacement policy keep every value through conflict misses
+    for policy in ["lru", "plru", "random", "rrip"]:
+        dram = Dram(4096, 0, 100, 10)
+        cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, CACHE_READ_LATENCY, CACHE_WRITE_LATENCY, dram, associativity=4, replacement_policy=policy)
+        assert(cache.num_sets == 8 and cache.offset_bits == 3 and cache.set_bits == 3)
+        for i in range(512):
+            cache.process_packet(Packet(load=False, addr=i*8, size=1, data=i & 0xff, latency=1))
+        for i in range(512):
+            assert(cache.process_packet(Packet(load=True, addr=i*8, size=1, data=None, latency=1)).data == i & 0xff)
+
+    # LRU keeps the 4 most recently used blocks of a set, a hit adds the cache latency and a miss also adds the DRAM latency
+    dram = Dram(4096, 0, 100, 10)
+    cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, CACHE_READ_LATENCY, CACHE_WRITE_LATENCY, dram, associativity=4, replacement_policy="lru")
+    set_stride = cache.num_sets * CACHE_BLOCK_SIZE # addresses that map to the same set
+    for i in range(5):
+        ret_pkt = cache.process_packet(Packet(load=True, addr=i*set_stride, size=1, data=None, latency=1))
+        assert(ret_pkt.latency == 1 + CACHE_READ_LATENCY + 100)
+    assert(cache.process_packet(Packet(load=True, addr=4*set_stride, size=1, data=None, latency=1)).latency == 1 + CACHE_READ_LATENCY)
+    assert(cache.process_packet(Packet(load=True, addr=0, size=1, data=None, latency=1)).latency == 1 + CACHE_READ_LATENCY + 100)
+
+    # clean evictions are free, dirty evictions pay the DRAM write
+    dram = Dram(4096, 0, 100, 10)
+    cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, CACHE_READ_LATENCY, CACHE_WRITE_LATENCY, dram)
+    cache.process_packet(Packet(load=True, addr=0x0000, size=1, data=None, latency=0))
+    assert(cache.process_packet(Packet(load=True, addr=0x0100, size=1, data=None, latency=0)).latency == CACHE_READ_LATENCY + 100)
+    cache.process_packet(Packet(load=False, addr=0x0100, size=1, data=0x5A, latency=0))
+    assert(cache.process_packet(Packet(load=True, addr=0x0200, size=1, data=None, latency=0)).latency == CACHE_READ_LATENCY + 10 + 100)
+    assert(dram.memory.load(0x0100, 1) == 0x5A)
+
+    # flush writes back dirty blocks and keeps them, invalidate also drops them, both only pay for dirty blocks
+    cache.process_packet(Packet(load=False, addr=0x0200, size=1, data=0x11, latency=0))
+    cache.process_packet(Packet(load=False, addr=0x0008, size=1, data=0x22, latency=0))
+    cache.process_packet(Packet(load=True, addr=0x0010, size=1, data=None, latency=0))
+    assert(cache.flush(0x0200, 8) == 10)
+    assert(dram.memory.load(0x0200, 1) == 0x11)
+    assert(cache.flush(0x0200, 8) == 0)
+    assert(cache.process_packet(Packet(load=True, addr=0x0200, size=1, data=None, latency=0)).latency == CACHE_READ_LATENCY)
+    assert(cache.invalidate(0x0000, 0x18) == 10)
+    assert(dram.memory.load(0x0008, 1) == 0x22)
+    assert(cache.process_packet(Packet(load=True, addr=0x0010, size=1, data=None, latency=0)).latency == CACHE_READ_LATENCY + 100)
+
+    # flush_all only writes back dirty blocks
+    for i in range(4):
+        cache.process_packet(Packet(load=False, addr=0x0400 + i*8, size=1, data=i, latency=0))
+    assert(cache.flush_all() == 4 * 10)
+    assert(cache.flush_all() == 0)
+    assert(dram.memory.load(0x0418, 1) == 3)
+
+    # L1 -> L2 -> DRAM, each level adds its own latency and a miss adds the miss latency of the level
+    dram = Dram(4096, 0, 100, 10)
+    l2 = Cache(1024, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 4, 4, dram, associativity=4, miss_latency=2)
+    l1 = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 1, 1, l2, miss_latency=1)
+    assert(l1.process_packet(Packet(load=True, addr=0x0000, size=1, data=None, latency=0)).latency == 1 + 1 + 4 + 2 + 100)
+    assert(l1.process_packet(Packet(load=True, addr=0x0000, size=1, data=None, latency=0)).latency == 1)
+    l1.process_packet(Packet(load=False, addr=0x0100, size=1, data=0x77, latency=0)) # conflicts with 0x0000 in L1 only
+    assert(l1.process_packet(Packet(load=True, addr=0x0000, size=1, data=None, latency=0)).latency == 1 + 1 + 4 + 4) # dirty 0x0100 is written back into L2, then L2 hits
+    assert(l1.flush_all_levels() > 0)
+    assert(dram.memory.load(0x0100, 1) == 0x77)
+
+    # inclusive L2 evictions back invalidate L1, dirty data from L1 reaches DRAM
+    dram = Dram(8192, 0, 100, 10)
+    l2 = Cache(CACHE_SIZE, 8192, CACHE_BLOCK_SIZE, 4, 4, dram, inclusion="inclusive")
+    l1 = Cache(64, 8192, CACHE_BLOCK_SIZE, 1, 1, l2, associativity=8)
+    l1.process_packet(Packet(load=False, addr=0x0008, size=1, data=0x99, latency=0))
+    l1.process_packet(Packet(load=True, addr=0x0108, size=1, data=None, latency=0)) # evicts 0x0008 from L2 but not L1 capacity
+    assert(len(list(l1.block_range(0x0008, 1))) == 0)
+    assert(dram.memory.load(0x0008, 1) == 0x99)
+
+    # exclusive L2 only holds L1 victims and hands blocks back to L1 on a hit
+    dram = Dram(4096, 0, 100, 10)
+    l2 = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 4, 4, dram, associativity=2, inclusion="exclusive")
+    l1 = Cache(64, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 1, 1, l2)
+    l1.process_packet(Packet(load=False, addr=0x0000, size=1, data=0x42, latency=0))
+    assert(not l2.valid.any()) # the miss bypassed L2
+    l1.process_packet(Packet(load=True, addr=0x0040, size=1, data=None, latency=0)) # conflicts with 0x0000 in L1
+    assert(l2.valid.sum() == 1 and l2.dirty.sum() == 1)
+    assert(l1.process_packet(Packet(load=True, addr=0x0000, size=1, data=None, latency=0)).latency == 1 + 4 + 4) # victim of 0x0040 goes to L2 as well
+    assert(l1.dirty.sum() == 1) # dirty data moved back up
+    assert(l2.valid.sum() == 1 and l2.dirty.sum() == 0) # only the clean victim 0x0040 is left
+    l1.flush_all_levels()
+    assert(dram.memory.load(0x0000, 1) == 0x42)
+
+    # next line prefetching turns every other miss of a sequential scan into a hit, prefetch fills are not charged
+    dram = Dram(4096, 0, 100, 10)
+    prefetcher = make_prefetcher("next_line", CACHE_BLOCK_SIZE, degree=1, distance=1)
+    cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 1, 1, dram, associativity=2, prefetcher=prefetcher)
+    latencies = [cache.process_packet(Packet(load=True, addr=i*CACHE_BLOCK_SIZE, size=1, data=None, latency=0)).latency for i in range(8)]
+    assert(latencies == [1 + 100, 1] * 4)
+    assert(prefetcher.issued == 4 and prefetcher.useful == 4 and prefetcher.fill_bytes == 4 * CACHE_BLOCK_SIZE)
+
+    # prefetched blocks that are evicted or invalidated before use are useless
+    cache.process_packet(Packet(load=True, addr=0x0440, size=1, data=None, latency=0))
+    assert(cache.invalidate(0x0448, 1) == 0)
+    assert(prefetcher.issued == 5 and prefetcher.useless == 1)
+    assert(prefetcher.get_stats()["accuracy"] == 4 / 5)
+
+    # stride prefetching by pc for a column walk, every access after training hits
+    dram = Dram(4096, 0, 100, 10)
+    prefetcher = make_prefetcher("stride", CACHE_BLOCK_SIZE, degree=2, distance=1)
+    cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 1, 1, dram, associativity=4, prefetcher=prefetcher)
+    latencies = [cache.process_packet(Packet(load=True, addr=i*64, size=1, data=None, latency=0, pc=12)).latency for i in range(16)]
+    assert(latencies[:3] == [1 + 100] * 3 and latencies[3:] == [1] * 13)
+
+    # tiles go through the cache one row at a time
+    dram = Dram(4096, 0, 100, 10)
+    cache = Cache(CACHE_SIZE, CACHE_ADDR_RANGE, CACHE_BLOCK_SIZE, 1, 1, dram)
+    tile = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    pkt = cache.process_tile_packet(TilePacket(load=False, addr=0x200, rows=3, cols=4, stride=32, data=tile))
+    assert(pkt.latency == 3 * (1 + 100))
+    pkt = cache.process_tile_packet(TilePacket(load=True, addr=0x200, rows=3, cols=4, stride=32))
+    assert((pkt.data == tile).all() and pkt.latency == 3)
+    stats = cache.get_stats()
+    assert(stats["writes"] == 3 and stats["reads"] == 3 and stats["misses"] == 3 and stats["hits"] == 3)
+    assert(stats["bytes_written"] == 12 and stats["bytes_read"] == 12 and stats["busy_cycles"] == 3 * (1 + 100) + 3)
+    assert(dram.get_stats()["reads"] == 3 and dram.get_stats()["bytes_read"] == 3 * CACHE_BLOCK_SIZE)
+
+    # Cpu.collect_stats nests every level under the one in front of it, reset_stats starts a new phase
+    from cpu import Cpu, CpuLatencies
+    from program import Program
+    dram = Dram(4096, 0, 100, 10)
+    l2 = Cache(1024, 4096, 8, 4, 4, dram, associativity=4)
+    l1 = Cache(64, 4096, 8, 1, 1, l2)
+    cpu = Cpu([l1], 8, 4, 1, CpuLatencies())
+    program = Program(4)
+    program.store_byte(0, 0, 0x000)
+    program.store_byte(0, 0, 0x040) # same L1 set as 0x000, evicts it dirty
+    program.load_byte(1, 0, 0x000) # evicts 0x040 dirty, hits in L2
+    program.halt()
+    cpu.run_program(program)
+    stats = cpu.collect_stats()
+    assert(stats["cycles"] == cpu.time and stats["instructions"] == 4)
+    l1_stats = stats["memories"][0]
+    l2_stats = l1_stats["next_level"]
+    dram_stats = l2_stats["next_level"]
+    assert(l1_stats["type"] == "Cache" and dram_stats["type"] == "Dram" and "next_level" not in dram_stats)
+    assert((l1_stats["writes"], l1_stats["reads"], l1_stats["misses"], l1_stats["evictions"], l1_stats["writebacks"]) == (2, 1, 3, 2, 2))
+    assert((l2_stats["reads"], l2_stats["writes"], l2_stats["hits"], l2_stats["misses"], l2_stats["evictions"]) == (3, 2, 3, 2, 0))
+    assert((dram_stats["reads"], dram_stats["writes"], dram_stats["busy_cycles"]) == (2, 0, 200))
+    assert(l1_stats["busy_cycles"] == cpu.time - 3) # every instruction starts at 1 cycle
+    cpu.reset_stats()
+    stats = cpu.collect_stats()
+    assert(stats["cycles"] == 0 and stats["memories"][0]["reads"] == 0 and stats["memories"][0]["next_level"]["next_level"]["reads"] == 0)
 
     print("Finish Testing Cache")
\ No newline at end of file
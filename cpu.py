@@ -1,9 +1,17 @@
 # cpu.py
 
 from typing import Callable
-from packet import Packet, MatrixPacket
+from packet import Packet, TilePacket, MatrixPacket, MatrixBatchPacket, DmaPacket
 from memory import MemObject
+from dma import DmaEngine
 from program import Program
+from jit import translate_block
+from address_map import AddressMap
+from encoded_program import EncodedProgram
+from profiler import Profiler
+from packet_trace import TraceWriter
+import numpy as np
+import weakref
 
 class CpuLatencies:
     # estimates of latencies for each instruction based on average CPI
@@ -15,38 +23,34 @@ class CpuLatencies:
         self.logical_latency = 1
 
 class Cpu:
-    def __init__(self, memories: list[MemObject], num_registers: int, register_bytes: int, gemm_port: int, cpu_latencies: CpuLatencies) -> None:
+    def __init__(self, memories: list[MemObject], num_registers: int, register_bytes: int, gemm_port: int, cpu_latencies: CpuLatencies, dma_engine: DmaEngine = None) -> None:
         self.memories = memories # list of gemm_caches and drams directly connected to cpu
+        self.dma_engine = dma_engine # runs dma_start transfers in the background, takes no address space
         self.registers = [0 for i in range(num_registers)]
         self.register_bytes = register_bytes
         self.register_mask = [0xff, 0xffff, 0xffffff, 0xffffffff][register_bytes-1] # length of each register in number of bytes
         self.cpu_latencies = cpu_latencies
         self.pc = 0
         self.time = 0
+        self.instructions_executed = 0 # instructions run by run_program, halt included
+        self.stats_start = (0, 0) # (time, instructions_executed) at the last reset_stats
         # each memory the cpu is connected to will contain addr_range part of the address space
         # eg if memories[0].addr_range = 1024 and memories[1].addr_range = 256 then
         # memories[0] covers bytes [1023:0] and memories[1] covers [1279:1024]
         # Cpu translates cpu address range into byte range of each MemObject
         # eg if accessing address 1024 and a is memory covering [2047:1024] then the packet contains addr = 0
-
-    def run_program(self, program: Program):
-        # instructions is a list of tuples with instruction name string followed by operands, e.g. ("add", 1, 2)
-        instructions = program.get_instructions()
-        while instructions[self.pc][0] != "halt":
-            instruction = instructions[self.pc]
-            instr_func = self.get_instruction(instruction[0])
-            self.time += instr_func(*instruction[1:])
-            self.pc = self.pc + 1
-            # print("PC: ", self.pc)
-        print(f"Halted at cycle {self.time}")
-
-    def get_instruction(self, instruction: str) -> Callable:
-        instruction_dict = {
+        # the address map is built once and checks that memories with an addr_start don't overlap or leave gaps
+        self.address_map = AddressMap(memories)
+        # translated blocks for run_program_jit, per program: (instructions, decoded instructions, blocks)
+        self.translations = weakref.WeakKeyDictionary()
+        # opcode name -> handler, used to decode programs once before running them
+        self.instruction_table = {
             "load": self.load,
             "store": self.store,
             "load_byte": self.load_byte,
             "store_byte": self.store_byte,
             "move_memory": self.move_memory,
+            "move_tile": self.move_tile,
             "move": self.move,
             "add": self.add,
             "add_immediate": self.add_immediate,
@@ -61,14 +65,136 @@ class Cpu:
             "logical_shift_left": self.logical_shift_left,
             "logical_shift_right": self.logical_shift_right,
             "matrix_multiply": self.matrix_multiply,
-            "matrix_add": self.matrix_add
+            "matrix_add": self.matrix_add,
+            "matrix_multiply_batch": self.matrix_multiply_batch,
+            "matrix_add_batch": self.matrix_add_batch,
+            "dma_start": self.dma_start,
+            "dma_wait": self.dma_wait
         }
-        return instruction_dict[instruction]
+
+    def run_program(self, program: Program | EncodedProgram, jit: bool = False, profiler: Profiler = None, trace: str | TraceWriter = None):
+        # instructions is a list of tuples with instruction name string followed by operands, e.g. ("add", 1, 2)
+        # they are decoded once so the loop below only indexes and calls
+        # an EncodedProgram, or its structured array, runs the same way as the Program it was encoded from
+        # trace is a TraceWriter or the path of a trace file to write, see packet_trace.py
+        if isinstance(program, np.ndarray):
+            program = EncodedProgram(program)
+        if trace is not None:
+            return self.run_program_traced(program, jit, profiler, trace)
+        if profiler is not None:
+            return self.run_program_profiled(program, profiler)
+        if jit:
+            return self.run_program_jit(program)
+        decoded = self.decode(program.get_instructions())
+        executed = 1
+        handler, operands = decoded[self.pc]
+        while handler is not None:
+            self.time += handler(*operands)
+            self.pc = self.pc + 1
+            executed += 1
+            handler, operands = decoded[self.pc]
+            # print("PC: ", self.pc)
+        self.instructions_executed += executed
+        print(f"Halted at cycle {self.time}")
+
+    def run_program_jit(self, program: Program | EncodedProgram):
+        # straight line runs of register instructions are compiled into Python functions by translate_block
+        # memory and matrix instructions still go through the decoded handlers
+        instructions = program.get_instructions()
+        translation = self.translations.get(program)
+        if translation is None or translation[0] is not instructions:
+            translation = (instructions, self.decode(instructions), {})
+            self.translations[program] = translation
+        _, decoded, blocks = translation # blocks maps entry pc -> compiled block, or None if not translatable
+
+        registers = self.registers
+        latencies = vars(self.cpu_latencies)
+        pc = self.pc
+        executed = 1
+        while True:
+            if pc in blocks:
+                block = blocks[pc]
+            else:
+                block = blocks[pc] = translate_block(instructions, pc, self.register_mask, latencies)
+            if block is not None:
+                executed += block.num_instructions
+                pc, cycles = block(registers)
+                self.time += cycles
+                continue
+            handler, operands = decoded[pc]
+            if handler is None:
+                break
+            self.pc = pc
+            self.time += handler(*operands)
+            executed += 1
+            pc = self.pc + 1
+        self.pc = pc
+        self.instructions_executed += executed
+        print(f"Halted at cycle {self.time}")
+
+    def run_program_profiled(self, program: Program | EncodedProgram, profiler: Profiler):
+        # same loop as run_program with the profiler told about every instruction, kept separate so runs without
+        # a profiler pay nothing; translated blocks are not used so every pc is seen
+        instructions = program.get_instructions()
+        decoded = self.decode(instructions)
+        profiler.attach(self, instructions)
+        try:
+            executed = 1
+            handler, operands = decoded[self.pc]
+            while handler is not None:
+                pc = self.pc
+                profiler.begin(pc)
+                cycles = handler(*operands)
+                profiler.end(pc, cycles)
+                self.time += cycles
+                self.pc = self.pc + 1
+                executed += 1
+                handler, operands = decoded[self.pc]
+            profiler.begin(self.pc)
+            profiler.end(self.pc, 0) # halt
+            self.instructions_executed += executed
+        finally:
+            profiler.detach()
+        print(f"Halted at cycle {self.time}")
+
+    def run_program_traced(self, program: Program | EncodedProgram, jit: bool, profiler: Profiler, trace: str | TraceWriter):
+        # every packet sent to self.memories is recorded while the program runs, a path is written and closed here
+        writer = TraceWriter(trace) if isinstance(trace, str) else trace
+        writer.attach(self)
+        try:
+            self.run_program(program, jit, profiler)
+        finally:
+            writer.detach()
+            if writer is not trace:
+                writer.close()
+
+    def load_program(self, program: Program | EncodedProgram) -> None:
+        # decodes program for step, which runs it one instruction at a time (e.g. interleaved with other cpus)
+        if isinstance(program, np.ndarray):
+            program = EncodedProgram(program)
+        self.decoded = self.decode(program.get_instructions())
+
+    def step(self) -> bool:
+        # runs the instruction at pc, returns False without doing anything once pc is at a halt
+        handler, operands = self.decoded[self.pc]
+        if handler is None:
+            return False
+        self.time += handler(*operands)
+        self.pc += 1
+        self.instructions_executed += 1
+        return True
+
+    def decode(self, instructions: list[tuple]) -> list[tuple[Callable, tuple]]:
+        # turn each instruction into (bound handler, operands), halt decodes to a None handler
+        return [(None, ()) if instruction[0] == "halt" else (self.instruction_table[instruction[0]], instruction[1:]) for instruction in instructions]
+
+    def get_instruction(self, instruction: str) -> Callable:
+        return self.instruction_table[instruction]
 
     def load(self, dest_register: int, addr_register: int, immediate: int) -> int:
         full_address = (self.registers[addr_register] + immediate) & self.register_mask
         memory_idx,addr = self.translate_addr(full_address)
-        ld_req_pkt = Packet(True, addr, self.register_bytes, None, 1)
+        ld_req_pkt = Packet(True, addr, self.register_bytes, None, 1, self.pc)
         
         ld_resp_pkt = self.memories[memory_idx].process_packet(ld_req_pkt)
         self.registers[dest_register] = ld_resp_pkt.data
@@ -78,7 +204,7 @@ class Cpu:
     def store(self, src_register: int, addr_register: int, immediate: int) -> int:
         full_address = (self.registers[addr_register] + immediate) & self.register_mask
         memory_idx,addr = self.translate_addr(full_address)
-        st_req_pkt = Packet(False, addr, self.register_bytes, self.registers[src_register], 1)
+        st_req_pkt = Packet(False, addr, self.register_bytes, self.registers[src_register], 1, self.pc)
         # print(f"STORE: MEM[{full_address}] <- r{src_register} ({self.registers[src_register]})")
         st_resp_pkt = self.memories[memory_idx].process_packet(st_req_pkt)
         return st_resp_pkt.latency
@@ -87,7 +213,7 @@ class Cpu:
         # unsigned load into lowest byte of register
         full_address = (self.registers[addr_register] + immediate) & self.register_mask
         memory_idx,addr = self.translate_addr(full_address)
-        ld_req_pkt = Packet(True, addr, 1, None, 1)
+        ld_req_pkt = Packet(True, addr, 1, None, 1, self.pc)
         
         ld_resp_pkt = self.memories[memory_idx].process_packet(ld_req_pkt)
         self.registers[dest_register] = ld_resp_pkt.data & 0xff
@@ -97,7 +223,7 @@ class Cpu:
         # store lowest byte of register
         full_address = (self.registers[addr_register] + immediate) & self.register_mask
         memory_idx,addr = self.translate_addr(full_address)
-        st_req_pkt = Packet(False, addr, 1, self.registers[src_register] & 0xff, 1)
+        st_req_pkt = Packet(False, addr, 1, self.registers[src_register] & 0xff, 1, self.pc)
 
         st_resp_pkt = self.memories[memory_idx].process_packet(st_req_pkt)
         return st_resp_pkt.latency
@@ -118,6 +244,32 @@ class Cpu:
         st_resp_pkt = self.memories[dest_memory_idx].process_packet(st_req_pkt)
         return st_resp_pkt.latency
 
+    def move_tile(self, src_addr_register: int, dest_addr_register: int, rows: int, cols: int, src_stride: int, dest_stride: int) -> int:
+        # copy a rows x cols byte tile, row r is read from src + r*src_stride and written to dest + r*dest_stride
+        src_memory_idx, src_addr = self.translate_addr(self.registers[src_addr_register] & self.register_mask)
+        dest_memory_idx, dest_addr = self.translate_addr(self.registers[dest_addr_register] & self.register_mask)
+
+        ld_req_pkt = TilePacket(True, src_addr, rows, cols, src_stride)
+        ld_resp_pkt = self.memories[src_memory_idx].process_tile_packet(ld_req_pkt)
+
+        st_req_pkt = TilePacket(False, dest_addr, rows, cols, dest_stride, ld_resp_pkt.data, ld_resp_pkt.latency)
+        st_resp_pkt = self.memories[dest_memory_idx].process_tile_packet(st_req_pkt)
+        return st_resp_pkt.latency
+
+    def dma_start(self, src_addr_register: int, dest_addr_register: int, size_register: int, tag: int) -> int:
+        # like move_memory but the copy runs on the DMA engine, only the issue latency is charged here
+        assert self.dma_engine is not None, "Error: dma_start needs a Cpu with a dma_engine"
+        src_memory_idx, src_addr = self.translate_addr(self.registers[src_addr_register] & self.register_mask)
+        dest_memory_idx, dest_addr = self.translate_addr(self.registers[dest_addr_register] & self.register_mask)
+        dma_req_pkt = DmaPacket(self.memories[src_memory_idx], src_addr, self.memories[dest_memory_idx], dest_addr, self.registers[size_register], tag)
+        dma_resp_pkt = self.dma_engine.process_dma_packet(dma_req_pkt, self.time)
+        return dma_resp_pkt.latency
+
+    def dma_wait(self, tag: int) -> int:
+        # stall until the transfers started with tag are done, tag -1 waits for all of them
+        assert self.dma_engine is not None, "Error: dma_wait needs a Cpu with a dma_engine"
+        return self.dma_engine.wait(tag, self.time)
+
     def move(self, dest_register: int, immediate: int) -> int:
         self.registers[dest_register] = immediate & self.register_mask
         return self.cpu_latencies.logical_latency
@@ -191,6 +343,62 @@ class Cpu:
         ma_resp_pkt = self.memories[memory_idx].process_matrix_op_packet(ma_req_pkt)
         return ma_resp_pkt.latency
     
+    def matrix_multiply_batch(self, dest_addr_register: int, src_addr_register1: int, src_addr_register2: int, count: int, dest_stride: int, src1_stride: int, src2_stride: int, accumulate: bool) -> int:
+        # count multiplies, operation i uses the register addresses plus i times each stride in bytes
+        memory_idx,dest_addr = self.translate_addr(self.registers[dest_addr_register])
+        memory_idx,src1_addr = self.translate_addr(self.registers[src_addr_register1])
+        memory_idx,src2_addr = self.translate_addr(self.registers[src_addr_register2])
+        mat_starts = [(src1_addr + i*src1_stride, src2_addr + i*src2_stride, dest_addr + i*dest_stride) for i in range(count)]
+        mmb_req_pkt = MatrixBatchPacket(True, mat_starts, accumulate)
+        mmb_resp_pkt = self.memories[memory_idx].process_matrix_batch_packet(mmb_req_pkt)
+        return mmb_resp_pkt.latency
+
+    def matrix_add_batch(self, dest_addr_register: int, src_addr_register1: int, src_addr_register2: int, count: int, dest_stride: int, src1_stride: int, src2_stride: int) -> int:
+        memory_idx,dest_addr = self.translate_addr(self.registers[dest_addr_register])
+        memory_idx,src1_addr = self.translate_addr(self.registers[src_addr_register1])
+        memory_idx,src2_addr = self.translate_addr(self.registers[src_addr_register2])
+        mat_starts = [(src1_addr + i*src1_stride, src2_addr + i*src2_stride, dest_addr + i*dest_stride) for i in range(count)]
+        mab_req_pkt = MatrixBatchPacket(False, mat_starts)
+        mab_resp_pkt = self.memories[memory_idx].process_matrix_batch_packet(mab_req_pkt)
+        return mab_resp_pkt.latency
+
+    def hierarchy(self) -> list[MemObject]:
+        # every memory reachable from the cpu, following next_level chains, each one once
+        memories = []
+        for memory in self.memories:
+            while isinstance(memory, MemObject) and all(memory is not seen for seen in memories):
+                memories.append(memory)
+                memory = getattr(memory, "next_level", None)
+        return memories
+
+    def collect_stats(self) -> dict:
+        # statistics since the last reset_stats as a nested dict, each memory holds the stats of its next_level
+        # a level shared by several caches (e.g. an L2 behind two L1s) is only nested under the first one
+        seen = set()
+        def memory_stats(memory: MemObject) -> dict:
+            seen.add(id(memory))
+            stats = {"type": type(memory).__name__, **memory.get_stats()}
+            next_level = getattr(memory, "next_level", None)
+            if isinstance(next_level, MemObject) and id(next_level) not in seen:
+                stats["next_level"] = memory_stats(next_level)
+            return stats
+        stats = {
+            "cycles": self.time - self.stats_start[0],
+            "instructions": self.instructions_executed - self.stats_start[1],
+            "memories": [memory_stats(memory) for memory in self.memories]
+        }
+        if self.dma_engine is not None:
+            stats["dma_engine"] = self.dma_engine.get_stats()
+        return stats
+
+    def reset_stats(self) -> None:
+        # start a new phase, cycles and instructions are counted from here and every memory's counters are cleared
+        self.stats_start = (self.time, self.instructions_executed)
+        for memory in self.hierarchy():
+            memory.reset_stats()
+        if self.dma_engine is not None:
+            self.dma_engine.reset_stats()
+
     def print_registers(self) -> None:
         print("Register State:")
         print(f"PC: 0x{self.pc:08x}")
@@ -199,19 +407,12 @@ class Cpu:
 
     def print_memory(self) -> None:
         print("Memory State:")
-        current_range = 0
         for mem_idx,mem in enumerate(self.memories):
             print(f"Memory Object {mem_idx}")
-            mem.print(current_range)
-            current_range += mem.addr_range
+            mem.print(self.address_map.bases[mem_idx])
                 
     # translate memory address to memories index and address inside memories[index]
     def translate_addr(self, addr: int) -> tuple[int,int]:
-        for i, memory in enumerate(self.memories):
-            if addr >= memory.addr_range:
-                addr -= memory.addr_range
-            else:
-                return i,addr
-        raise IndexError("Out of bounds memory access")
+        return self.address_map.lookup(addr)
         
     
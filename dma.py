@@ -0,0 +1,130 @@
+# dma.py
+
+from packet import Packet, DmaPacket
+from memory import MemObject
+
+class DmaEngine(MemObject):
+    # asynchronous copy engine with num_channels independent channels
+    # a transfer costs the same load + store latency as move_memory but runs in the background on a channel,
+    # the cpu only pays issue_latency to start it and stalls in wait until the transfers it waits on are done
+    # data is copied when the transfer starts, so programs must wait on a tag before relying on its destination
+    # and must not change the source of an outstanding transfer
+    def __init__(self, num_channels: int = 2, issue_latency: int = 1) -> None:
+        super().__init__(0, 0, issue_latency, issue_latency)
+        assert num_channels > 0, "Error: DMA engine needs at least 1 channel"
+        self.num_channels = num_channels
+        self.issue_latency = issue_latency
+        self.reset()
+
+    def reset(self) -> None:
+        self.channel_free = [0] * self.num_channels # cycle each channel finishes its last transfer
+        self.outstanding = {} # tag -> completion cycle of the latest transfer with that tag
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        super().reset_stats()
+        self.transfers = 0
+        self.bytes = 0
+        self.busy_cycles = 0 # summed over channels
+
+    def process_packet(self, pkt: Packet) -> Packet:
+        assert False, "Error: DMA engine has no memory, use process_dma_packet"
+
+    def process_dma_packet(self, pkt: DmaPacket, now: int) -> DmaPacket:
+        # start the transfer at cycle now on the first free channel, pkt.latency is the cycles the cpu stalls to issue it
+        assert pkt.size > 0, "Error: DMA transfer size must be greater than 0"
+        ld_resp_pkt = pkt.src_memory.process_packet(Packet(True, pkt.src_addr, pkt.size))
+        st_resp_pkt = pkt.dest_memory.process_packet(Packet(False, pkt.dest_addr, pkt.size, ld_resp_pkt.data, ld_resp_pkt.latency))
+
+        channel = min(range(self.num_channels), key=lambda i: self.channel_free[i])
+        start = max(now + self.issue_latency, self.channel_free[channel])
+        done = start + st_resp_pkt.latency
+        self.channel_free[channel] = done
+        self.outstanding[pkt.tag] = max(self.outstanding.get(pkt.tag, 0), done)
+        self.transfers += 1
+        self.bytes += pkt.size
+        self.busy_cycles += st_resp_pkt.latency
+        pkt.latency += self.issue_latency
+        return pkt
+
+    def wait(self, tag: int, now: int) -> int:
+        # cycles to stall at cycle now until every transfer with tag is done, tag -1 is a fence on all transfers
+        if tag == -1:
+            done = max(self.outstanding.values(), default=0)
+            self.outstanding.clear()
+        else:
+            done = self.outstanding.pop(tag, 0)
+        return max(done - now, 0)
+
+    def get_stats(self) -> dict:
+        return {
+            "transfers": self.transfers,
+            "bytes": self.bytes,
+            "busy_cycles": self.busy_cycles
+        }
+
+if __name__ == "__main__":
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    from gemm_cache import GemmCache, GemmCacheLatencies
+    from program import Program
+    print("DMA Test Begin")
+
+    def make_cpu(dma_engine):
+        dram = Dram(256, 0, 100, 10)
+        gemm_cache = GemmCache(4, 4, 256, GemmCacheLatencies(4))
+        for i in range(16):
+            dram.set_value(i, 1, i)
+            dram.set_value(16 + i, 1, 1 if i % 5 == 0 else 0) # identity
+        return Cpu([dram, gemm_cache], 8, 4, 1, CpuLatencies(), dma_engine=dma_engine), dram, gemm_cache
+
+    # synchronous reference: load A and B, multiply, then load the next A
+    cpu, dram, gemm_cache = make_cpu(None)
+    program = Program(4)
+    program.move(1, 0)
+    program.move(2, 256)
+    program.move(3, 16)
+    program.move(4, 16)
+    program.move(5, 256 + 16)
+    program.move(6, 256 + 32)
+    program.move(7, 256 + 48)
+    program.move_memory(1, 2, 3)
+    program.move_memory(4, 5, 3)
+    program.matrix_multiply(6, 2, 5)
+    program.move_memory(1, 7, 3)
+    program.halt()
+    cpu.run_program(program)
+    sync_time = cpu.time
+    expected = gemm_cache.matrix_view(32).copy()
+
+    # asynchronous: the load of the next A overlaps the multiply
+    dma_engine = DmaEngine(num_channels=2, issue_latency=1)
+    cpu, dram, gemm_cache = make_cpu(dma_engine)
+    program = Program(4)
+    program.move(1, 0)
+    program.move(2, 256)
+    program.move(3, 16)
+    program.move(4, 16)
+    program.move(5, 256 + 16)
+    program.move(6, 256 + 32)
+    program.move(7, 256 + 48)
+    program.dma_start(1, 2, 3, 0)
+    program.dma_start(4, 5, 3, 0)   # second channel, in flight together with the first transfer
+    program.dma_wait(0)
+    program.dma_start(1, 7, 3, 1)
+    program.matrix_multiply(6, 2, 5)
+    program.dma_wait(-1)
+    program.halt()
+    cpu.run_program(program)
+    assert (gemm_cache.matrix_view(32) == expected).all()
+    assert (gemm_cache.matrix_view(48) == gemm_cache.matrix_view(0)).all()
+    transfer = 100 + 1 # one DRAM burst + one GemmCache store
+    assert dma_engine.get_stats() == {"transfers": 3, "bytes": 48, "busy_cycles": 3 * transfer}
+    # 7 moves, the first two transfers overlap, the third overlaps the multiply
+    multiply = GemmCacheLatencies(4).matmul_latency
+    assert cpu.time == 7 + 1 + 1 + transfer + 1 + max(multiply, transfer)
+    assert cpu.time < sync_time
+
+    # waiting on a finished or unknown tag doesn't stall
+    assert dma_engine.wait(5, cpu.time) == 0
+    print("DMA Test Finished")
@@ -1,22 +1,154 @@
 # dram.py
 
-from packet import Packet
+from packet import Packet, TilePacket
 from memory import MemObject
-from memory_array import MemoryArray
+from memory_array import MemoryArray, DenseMemoryArray, PagedMemoryArray, MemmapMemoryArray
 import math
+import os
+from typing import Callable
+
+class DramTiming:
+    # detailed DRAM timing with banks, open page row buffers and a shared data bus
+    # each burst of a request goes to the bank and row given by the address mapping:
+    #   row hit: t_cas, row miss (bank idle): t_rcd + t_cas, row conflict (other row open): t_rp + t_rcd + t_cas
+    # bursts to different banks overlap, every burst holds the data bus for burst_size / bytes_per_cycle cycles
+    # mapping is "row_bank_column", "row_column_bank" (bursts interleaved across banks), "bank_row_column",
+    # or a function addr -> (bank, row)
+    def __init__(self, num_banks: int = 8, row_size: int = 2048, t_cas: int = 14, t_rcd: int = 14, t_rp: int = 14,
+                 bytes_per_cycle: int = 16, mapping: str | Callable = "row_bank_column") -> None:
+        assert num_banks > 0 and row_size > 0 and bytes_per_cycle > 0, "Error: DRAM timing parameters must be greater than 0"
+        self.num_banks = num_banks
+        self.row_size = row_size
+        self.t_cas = t_cas
+        self.t_rcd = t_rcd
+        self.t_rp = t_rp
+        self.bytes_per_cycle = bytes_per_cycle
+        self.mapping = mapping
+        self.size = None
+        self.burst_size = None
+        self.reset()
+
+    def attach(self, size: int, burst_size: int) -> None:
+        # called by Dram with its size and burst size
+        assert burst_size <= self.row_size, "Error: DRAM burst size must not exceed the row size"
+        self.size = size
+        self.burst_size = burst_size
+        self.burst_cycles = math.ceil(burst_size / self.bytes_per_cycle)
+        self.rows_per_bank = max(math.ceil(size / (self.row_size * self.num_banks)), 1)
+        if callable(self.mapping):
+            self.map_addr = self.mapping
+        else:
+            mappings = {
+                "row_bank_column": self.map_row_bank_column,
+                "row_column_bank": self.map_row_column_bank,
+                "bank_row_column": self.map_bank_row_column
+            }
+            assert self.mapping in mappings, f"Unknown DRAM address mapping {self.mapping}, expected one of {list(mappings.keys())}"
+            self.map_addr = mappings[self.mapping]
+
+    def map_row_bank_column(self, addr: int) -> tuple[int, int]:
+        return (addr // self.row_size) % self.num_banks, addr // (self.row_size * self.num_banks)
+
+    def map_row_column_bank(self, addr: int) -> tuple[int, int]:
+        return (addr // self.burst_size) % self.num_banks, addr // (self.row_size * self.num_banks)
+
+    def map_bank_row_column(self, addr: int) -> tuple[int, int]:
+        return (addr // (self.row_size * self.rows_per_bank)) % self.num_banks, (addr // self.row_size) % self.rows_per_bank
+
+    def reset(self) -> None:
+        # close every row and clear the statistics
+        self.open_rows = [-1] * self.num_banks
+        self.bank_ready = [0] * self.num_banks # cycle the next command can issue to each bank
+        self.bus_free = 0 # cycle the data bus is next free
+        self.now = 0 # requests are blocking, so each one starts when the previous one finished
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        # clear the statistics only, rows stay open
+        self.row_hits = 0
+        self.row_misses = 0
+        self.row_conflicts = 0
+        self.bytes = 0
+        self.busy_cycles = 0
+
+    def access(self, addr: int, size: int) -> int:
+        # returns the cycles from issuing the request until its last burst is transferred
+        return self.access_bursts(range(addr - addr % self.burst_size, addr + size, self.burst_size), size)
+
+    def access_bursts(self, burst_addrs, size: int) -> int:
+        # one request made of the bursts at burst_addrs, size is the bytes requested
+        start = self.now
+        done = start
+        for burst_addr in burst_addrs:
+            bank, row = self.map_addr(burst_addr)
+            issue = max(start, self.bank_ready[bank])
+            if self.open_rows[bank] == row:
+                self.row_hits += 1
+            elif self.open_rows[bank] == -1:
+                self.row_misses += 1
+                issue += self.t_rcd
+            else:
+                self.row_conflicts += 1
+                issue += self.t_rp + self.t_rcd
+            self.open_rows[bank] = row
+            # column commands to an open row are pipelined one burst apart
+            self.bank_ready[bank] = issue + self.burst_cycles
+            self.bus_free = max(issue + self.t_cas, self.bus_free) + self.burst_cycles
+            done = max(done, self.bus_free)
+        self.now = done
+        self.bytes += size
+        self.busy_cycles += done - start
+        return done - start
+
+    def get_stats(self) -> dict:
+        accesses = self.row_hits + self.row_misses + self.row_conflicts
+        return {
+            "row_hits": self.row_hits,
+            "row_misses": self.row_misses,
+            "row_conflicts": self.row_conflicts,
+            "row_hit_rate": self.row_hits / accesses if accesses > 0 else 0.0,
+            "bytes": self.bytes,
+            "busy_cycles": self.busy_cycles,
+            "bandwidth": self.bytes / self.busy_cycles if self.busy_cycles > 0 else 0.0, # bytes per cycle
+            "peak_bandwidth": self.bytes_per_cycle
+        }
 
 class Dram(MemObject):
-    def __init__(self, size: int, addr_start: int, read_latency: int, write_latency: int, burst_size: int = 64) -> None:
-        super().__init__(size, size, read_latency, write_latency)
+    def __init__(self, size: int, addr_start: int, read_latency: int, write_latency: int, burst_size: int = 64, memory: MemoryArray = None,
+                 timing: DramTiming = None) -> None:
+        super().__init__(size, size, read_latency, write_latency, addr_start)
         assert burst_size > 0, "Burst size must be greater than 0"
 
-        self.memory = MemoryArray(size)
+        # storage defaults to a dense buffer, pass a PagedMemoryArray to simulate address spaces larger than host memory
+        if memory is None:
+            memory = DenseMemoryArray(size)
+        assert memory.size == size, "Error: DRAM storage size must match DRAM size"
+        self.memory = memory
         self.mem_size = size
-        self.addr_range = addr_start + size
         self.read_latency = read_latency
         self.write_latency = write_latency
         self.burst_size = burst_size
 
+        # without a timing model every burst costs read_latency / write_latency
+        # with one, read_latency / write_latency are a fixed per request controller latency added to the bank timing
+        self.timing = timing
+        if timing is not None:
+            timing.attach(size, burst_size)
+
+    @classmethod
+    def from_image(cls, path: str, addr_start: int, read_latency: int, write_latency: int, burst_size: int = 64) -> "Dram":
+        # DRAM backed directly by an existing image file through np.memmap, writes go to the file
+        size = os.path.getsize(path)
+        return cls(size, addr_start, read_latency, write_latency, burst_size, MemmapMemoryArray(size, path))
+
+    def snapshot(self, path: str) -> None:
+        # save the whole DRAM contents to a raw image file
+        self.memory.save_image(path)
+
+    def restore(self, path: str) -> None:
+        # load the whole DRAM contents from a raw image file written by snapshot
+        self.memory.restore_image(path)
+
     def process_packet(self, pkt: Packet) -> Packet:
         assert pkt.size > 0, "Error: Packet size must be greater than 0 for DRAM load/store"
         assert (pkt.addr >= 0) and (pkt.addr + pkt.size <= self.mem_size), "Error: out of bounds load or store to DRAM"
@@ -25,28 +157,83 @@ class Dram(MemObject):
             return self.retrieve(pkt)
         return self.store(pkt)
 
+    def process_tile_packet(self, pkt: TilePacket) -> TilePacket:
+        # strided 2D access, the host copies the tile in one operation and rows sharing a burst share its latency
+        assert pkt.rows > 0 and pkt.cols > 0, "Error: Tile must have at least 1 row and 1 column"
+        assert (pkt.addr >= 0) and (pkt.addr + (pkt.rows - 1) * pkt.stride + pkt.cols <= self.mem_size), "Error: out of bounds tile load or store to DRAM"
+
+        if pkt.load:
+            pkt.data = self.memory.load_tile(pkt.addr, pkt.rows, pkt.cols, pkt.stride)
+            latency = self.read_latency
+        else:
+            self.memory.store_tile(pkt.addr, pkt.stride, pkt.data)
+            latency = self.write_latency
+
+        # every distinct burst touched by the tile is transferred once
+        row_starts = [pkt.addr + r * pkt.stride for r in range(pkt.rows)]
+        bursts = sorted({burst for row_start in row_starts for burst in range(row_start // self.burst_size, (row_start + pkt.cols - 1) // self.burst_size + 1)})
+        if self.timing is None:
+            latency *= len(bursts)
+        else:
+            latency += self.timing.access_bursts([burst * self.burst_size for burst in bursts], pkt.rows * pkt.cols)
+        pkt.latency += latency
+        if pkt.load:
+            self.reads += 1
+            self.bytes_read += pkt.rows * pkt.cols
+        else:
+            self.writes += 1
+            self.bytes_written += pkt.rows * pkt.cols
+        self.busy_cycles += latency
+        return pkt
+
     def set_value(self, addr: int, size: int, value: int) -> None:
         # assert math.ceil(value.bit_length() / 8) == size, "Error: Data size mismatch with variable size during DRAM load/store"
         self.memory.store(addr, size, value)
 
     def retrieve(self, pkt: Packet) -> Packet:
         pkt.data = self.memory[pkt.addr : pkt.addr + pkt.size]
-        pkt.latency += math.ceil(pkt.size / self.burst_size) * self.read_latency
+        latency = self.access_latency(pkt.addr, pkt.size, self.read_latency)
+        pkt.latency += latency
+        self.reads += 1
+        self.bytes_read += pkt.size
+        self.busy_cycles += latency
         return pkt
 
     def store(self, pkt: Packet) -> Packet:
         # assert math.ceil(pkt.data.bit_length() / 8) == pkt.size, "Error: Data size mismatch with variable size during DRAM load/store"
         self.memory[pkt.addr : pkt.addr + pkt.size] = pkt.data
-        pkt.latency += math.ceil(pkt.size / self.burst_size) * self.write_latency
+        latency = self.access_latency(pkt.addr, pkt.size, self.write_latency)
+        pkt.latency += latency
+        self.writes += 1
+        self.bytes_written += pkt.size
+        self.busy_cycles += latency
         return pkt
+
+    def reset_stats(self) -> None:
+        super().reset_stats()
+        if getattr(self, "timing", None) is not None:
+            self.timing.reset_stats()
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        if self.timing is not None:
+            stats["timing"] = self.timing.get_stats()
+        return stats
+
+    def access_latency(self, addr: int, size: int, latency: int) -> int:
+        if self.timing is None:
+            return math.ceil(size / self.burst_size) * latency
+        return latency + self.timing.access(addr, size)
     
     def print(self, starting_addr: int) -> None:
         self.memory.print(starting_addr)
 
 if __name__ == "__main__":
+    import tempfile
+    import numpy as np
     print("Testing DRAM")
 
-    DRAM_obj = Dram(size=2048, read_latency=10, write_latency=12)
+    DRAM_obj = Dram(size=2048, addr_start=0, read_latency=10, write_latency=12)
 
     # test write
     num_bytes = 256
@@ -78,11 +265,81 @@ if __name__ == "__main__":
         assert(False)
 
     # test another read
-    expected_data = data << 8
+    expected_data = (data << 8) & data # byte 263 was never written
     pkt_read = Packet(load=True, addr=8, size=num_bytes, data=None, latency = pkt_read_ret.latency)
     pkt_read_ret = DRAM_obj.process_packet(pkt_read)
     assert(pkt_read_ret.data == expected_data)
 
+    # test paged storage for a 4 GB DRAM, the access straddles two pages
+    DRAM_obj = Dram(size=1 << 32, addr_start=0, read_latency=10, write_latency=12, memory=PagedMemoryArray(1 << 32))
+    pkt_write = Packet(load=False, addr=(1 << 31) - 64, size=num_bytes // 2, data=data >> 1024, latency=0)
+    DRAM_obj.process_packet(pkt_write)
+    pkt_read = Packet(load=True, addr=(1 << 31) - 64, size=num_bytes // 2, data=None, latency=0)
+    assert DRAM_obj.process_packet(pkt_read).data == data >> 1024
+    assert DRAM_obj.memory.resident_bytes() == 2 * 4096
+
+    # test snapshot and restore for dense, paged and memory mapped storage
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, "dram.img")
+        DRAM_obj = Dram(size=2048, addr_start=0, read_latency=10, write_latency=12)
+        DRAM_obj.set_value(7, num_bytes, data)
+        DRAM_obj.snapshot(image_path)
+        assert os.path.getsize(image_path) == 2048
+
+        DRAM_obj = Dram(size=2048, addr_start=0, read_latency=10, write_latency=12)
+        DRAM_obj.restore(image_path)
+        assert DRAM_obj.memory.load(7, num_bytes) == data
+
+        DRAM_obj = Dram(size=2048, addr_start=0, read_latency=10, write_latency=12, memory=PagedMemoryArray(2048, page_size=1024))
+        DRAM_obj.restore(image_path)
+        assert DRAM_obj.memory.load(7, num_bytes) == data
+        assert DRAM_obj.memory.resident_bytes() == 1024
+        DRAM_obj.snapshot(image_path)
+
+        DRAM_obj = Dram.from_image(image_path, addr_start=0, read_latency=10, write_latency=12)
+        assert DRAM_obj.mem_size == 2048
+        assert DRAM_obj.memory.load(7, num_bytes) == data
+        DRAM_obj.set_value(0, 1, 0xab) # writes go through to the image file
+        DRAM_obj.memory.flush()
+        with open(image_path, "rb") as f:
+            assert f.read(1) == b"\xab"
+
+    # test bank timing: t_cas=2, t_rcd=3, t_rp=4, 16 byte bursts at 8 bytes per cycle (2 cycles per burst)
+    timing = DramTiming(num_banks=2, row_size=64, t_cas=2, t_rcd=3, t_rp=4, bytes_per_cycle=8)
+    DRAM_obj = Dram(size=1024, addr_start=0, read_latency=1, write_latency=1, burst_size=16, timing=timing)
+    assert DRAM_obj.process_packet(Packet(load=True, addr=0, size=16)).latency == 1 + 3 + 2 + 2 # row miss
+    assert DRAM_obj.process_packet(Packet(load=True, addr=16, size=16)).latency == 1 + 2 + 2 # row hit
+    assert DRAM_obj.process_packet(Packet(load=True, addr=128, size=16)).latency == 1 + 4 + 3 + 2 + 2 # row conflict in bank 0
+    # hits to an open row stream one burst every 2 cycles
+    assert DRAM_obj.process_packet(Packet(load=True, addr=128, size=64)).latency == 1 + 2 + 4 * 2
+    # a request spanning both banks opens the second row while the first bank transfers
+    assert DRAM_obj.process_packet(Packet(load=False, addr=128, size=128, data=0)).latency == 1 + 2 + 8 * 2
+    stats = timing.get_stats()
+    assert (stats["row_hits"], stats["row_misses"], stats["row_conflicts"]) == (12, 2, 1)
+    assert stats["bytes"] == 240 and stats["bandwidth"] <= stats["peak_bandwidth"]
+    stats = DRAM_obj.get_stats()
+    assert (stats["reads"], stats["writes"], stats["bytes_read"], stats["bytes_written"]) == (4, 1, 112, 128)
+    assert stats["timing"]["row_hits"] == 12
+    DRAM_obj.reset_stats() # counters are cleared, the rows stay open
+    assert DRAM_obj.get_stats()["timing"]["row_hits"] == 0 and DRAM_obj.get_stats()["busy_cycles"] == 0
+    assert DRAM_obj.process_packet(Packet(load=True, addr=128, size=16)).latency == 1 + 2 + 2
+
+    # interleaving bursts across banks turns the conflicting stream into misses on both banks
+    timing = DramTiming(num_banks=2, row_size=64, t_cas=2, t_rcd=3, t_rp=4, bytes_per_cycle=8, mapping="row_column_bank")
+    DRAM_obj = Dram(size=1024, addr_start=0, read_latency=1, write_latency=1, burst_size=16, timing=timing)
+    DRAM_obj.process_packet(Packet(load=True, addr=0, size=32))
+    assert timing.get_stats()["row_misses"] == 2
+    assert timing.map_addr(16) == (1, 0) and timing.map_addr(128) == (0, 1)
+
+    # test tiles: the 4 rows of 8 bytes at stride 16 only touch the bursts at 0 and 64, row by row moves would pay 5 bursts
+    DRAM_obj = Dram(size=1024, addr_start=0, read_latency=10, write_latency=12)
+    tile = np.arange(32, dtype=np.uint8).reshape(4, 8)
+    pkt_tile = DRAM_obj.process_tile_packet(TilePacket(load=False, addr=60, rows=4, cols=8, stride=16, data=tile))
+    assert pkt_tile.latency == 2 * 12
+    assert DRAM_obj.memory.load(76, 8) == int.from_bytes(tile[1].tobytes(), "big")
+    pkt_tile = DRAM_obj.process_tile_packet(TilePacket(load=True, addr=60, rows=4, cols=8, stride=16))
+    assert (pkt_tile.data == tile).all() and pkt_tile.latency == 2 * 10
+
     print("Finished Testing DRAM")
 
 
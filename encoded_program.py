@@ -0,0 +1,180 @@
+# encoded_program.py
+
+from program import Program
+from typing import Callable, Iterable
+import numpy as np
+import hashlib
+import inspect
+import json
+import os
+
+# opcode id -> (name, number of operands), ids are part of the file format so only append to this list
+OPCODES = [
+    ("halt", 0),
+    ("load", 3),
+    ("store", 3),
+    ("load_byte", 3),
+    ("store_byte", 3),
+    ("move_memory", 3),
+    ("move", 2),
+    ("add", 3),
+    ("add_immediate", 3),
+    ("multiply", 3),
+    ("branch_if", 2),
+    ("jump", 1),
+    ("bitwise_or", 3),
+    ("bitwise_and", 3),
+    ("bitwise_xor", 3),
+    ("bitwise_nor", 3),
+    ("bitwise_not", 2),
+    ("logical_shift_left", 3),
+    ("logical_shift_right", 3),
+    ("matrix_multiply", 3),
+    ("matrix_add", 3),
+    ("matrix_multiply_batch", 8),
+    ("matrix_add_batch", 7),
+    ("dma_start", 4),
+    ("dma_wait", 1),
+    ("move_tile", 6),
+]
+OPCODE_IDS = {name: opcode for opcode, (name, _) in enumerate(OPCODES)}
+MAX_OPERANDS = max(num_operands for _, num_operands in OPCODES)
+FORMAT_VERSION = 1 # part of the cache key, bump when the encoding changes
+
+# one row per assembled instruction, unused operand fields are 0
+INSTRUCTION_DTYPE = np.dtype([("opcode", np.uint8), ("operands", np.int64, (MAX_OPERANDS,))])
+
+def encode_program(program: Program) -> np.ndarray:
+    # assembled instructions of program as a structured array, operands are ints (bools become 0 / 1)
+    instructions = program.get_instructions()
+    encoded = np.zeros(len(instructions), dtype=INSTRUCTION_DTYPE)
+    opcodes = encoded["opcode"]
+    operands = encoded["operands"]
+    for i, instr in enumerate(instructions):
+        assert instr[0] in OPCODE_IDS, f"Error: instruction {instr[0]} has no opcode id"
+        opcodes[i] = OPCODE_IDS[instr[0]]
+        operands[i, : len(instr) - 1] = instr[1:]
+    return encoded
+
+def decode_program(encoded: np.ndarray) -> list[tuple]:
+    # back to the tuple form Cpu decodes, operands come back as Python ints
+    return [(OPCODES[opcode][0], *operands[: OPCODES[opcode][1]]) for opcode, operands in zip(encoded["opcode"].tolist(), encoded["operands"].tolist())]
+
+class EncodedProgram:
+    # assembled program stored as a structured array, can be passed to Cpu.run_program like a Program
+    def __init__(self, encoded: np.ndarray) -> None:
+        assert encoded.dtype == INSTRUCTION_DTYPE, "Error: array is not an encoded program"
+        self.encoded = encoded
+        self.instructions = None # decoded on first use
+
+    @classmethod
+    def from_program(cls, program: Program) -> "EncodedProgram":
+        return cls(encode_program(program))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "EncodedProgram":
+        # memory mapped by default, so loading is cheap; the first get_instructions decodes and reads the whole file
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+
+    def save(self, path: str) -> None:
+        np.save(path, self.encoded)
+
+    def get_instructions(self) -> list[tuple]:
+        if self.instructions is None:
+            self.instructions = decode_program(self.encoded)
+        return self.instructions
+
+    def __len__(self) -> int:
+        return len(self.encoded)
+
+def cache_key(generator: Callable, params: dict, dependencies: Iterable = ()) -> str:
+    # sha256 of the generator's name, the source of its module, program.py, this module and any extra dependencies
+    # (modules, classes or functions the generated program depends on), its parameters and the format version
+    modules = [inspect.getmodule(generator), inspect.getmodule(Program), inspect.getmodule(encode_program)]
+    key = json.dumps({
+        "generator": f"{generator.__module__}.{generator.__qualname__}",
+        "source": [inspect.getsource(obj) for obj in [*modules, *dependencies]],
+        "params": params,
+        "format": FORMAT_VERSION
+    }, sort_keys=True, default=repr)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def cached_program(generator: Callable[..., Program], cache_dir: str, dependencies: Iterable = (), **params) -> EncodedProgram:
+    # returns generator(**params) encoded, loading it from cache_dir when the same generator, sources and parameters ran before
+    path = os.path.join(cache_dir, cache_key(generator, params, dependencies) + ".npy")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        EncodedProgram.from_program(generator(**params)).save(tmp_path)
+        os.replace(tmp_path, path) # concurrent runs never see a partially written file
+    return EncodedProgram.load(path)
+
+if __name__ == "__main__":
+    import tempfile
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    print("EncodedProgram Test Begin")
+
+    def countdown_program(start: int, register_bytes: int = 4) -> Program:
+        program = Program(register_bytes)
+        program.move(1, start)
+        program.insert_label("loop")
+        program.add_immediate(1, 1, -1)
+        program.store_byte(1, 0, 3)
+        program.label_branch_if(1, "loop")
+        program.matrix_multiply_batch(1, 2, 3, 1, 0, 0, 0, True)
+        program.halt()
+        return program
+
+    # every opcode the cpu knows has an id
+    cpu = Cpu([Dram(64, 0, 1, 1)], 4, 4, 1, CpuLatencies())
+    assert set(OPCODE_IDS) == set(cpu.instruction_table) | {"halt"}
+
+    program = countdown_program(5)
+    encoded = EncodedProgram.from_program(program)
+    assert encoded.get_instructions() == [(name, *(int(op) for op in operands)) for name, *operands in program.get_instructions()]
+    assert decode_program(encoded.encoded)[-2][-1] == 1 # True is stored as 1
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        first = cached_program(countdown_program, cache_dir, start=5)
+        assert isinstance(first.encoded, np.memmap)
+        assert len(os.listdir(cache_dir)) == 1
+        second = cached_program(countdown_program, cache_dir, start=5) # cache hit, nothing is generated
+        assert len(os.listdir(cache_dir)) == 1 and np.array_equal(first.encoded, second.encoded)
+        cached_program(countdown_program, cache_dir, start=6)
+        assert len(os.listdir(cache_dir)) == 2
+
+        # a change in a dependency's source gives a new key, so an edited code generator is never served stale
+        import importlib
+        import sys
+        sys.path.insert(0, cache_dir)
+        with open(os.path.join(cache_dir, "countdown_dep.py"), "w") as f:
+            f.write("STEP = -1\n")
+        countdown_dep = importlib.import_module("countdown_dep")
+        key = cache_key(countdown_program, {"start": 5}, [countdown_dep])
+        assert key != cache_key(countdown_program, {"start": 5})
+        assert key == cache_key(countdown_program, {"start": 5}, [countdown_dep])
+        with open(os.path.join(cache_dir, "countdown_dep.py"), "w") as f:
+            f.write("STEP = -2 # edited\n")
+        assert key != cache_key(countdown_program, {"start": 5}, [countdown_dep])
+        cached_program(countdown_program, cache_dir, dependencies=[countdown_dep], start=5)
+        assert os.path.exists(os.path.join(cache_dir, cache_key(countdown_program, {"start": 5}, [countdown_dep]) + ".npy"))
+        sys.path.remove(cache_dir)
+
+        # the encoded program runs like the original (without the matrix instruction)
+        program = Program(4)
+        program.move(1, 5)
+        program.insert_label("loop")
+        program.add_immediate(1, 1, -1)
+        program.store_byte(1, 0, 3)
+        program.label_branch_if(1, "loop")
+        program.halt()
+        path = os.path.join(cache_dir, "countdown.npy")
+        EncodedProgram.from_program(program).save(path)
+        reference = Cpu([Dram(64, 0, 1, 1)], 4, 4, 1, CpuLatencies())
+        reference.run_program(program)
+        for jit in (False, True):
+            cpu = Cpu([Dram(64, 0, 1, 1)], 4, 4, 1, CpuLatencies())
+            cpu.run_program(EncodedProgram.load(path), jit=jit)
+            assert cpu.time == reference.time and cpu.registers == reference.registers
+    print("EncodedProgram Test Finished")
@@ -1,11 +1,13 @@
 # gemm_cache.py
 
-from packet import Packet, MatrixPacket
+from packet import Packet, TilePacket, MatrixPacket, MatrixBatchPacket
 from memory import MemObject
-from memory_array import MemoryArray
-from dram import Dram
+from memory_array import DenseMemoryArray
+from replacement_policy import make_replacement_policy
+from prefetcher import Prefetcher
 
 import math
+import numpy as np
 
 class GemmCacheLatencies:
     def __init__(self, matrix_dim: int) -> None:
@@ -22,163 +24,418 @@ class GemmCacheLatencies:
         self.matadd_latency = math.ceil(self.read_latency + int8_add_latency + self.write_latency)
         self.matmul_latency = math.ceil(self.read_latency + systolic_array_latency + self.write_latency)
 
+        # cycles between back to back operations of a pipelined batch, a new matrix can enter the systolic array every matrix_dim cycles
+        self.matadd_issue_latency = math.ceil(int8_add_latency)
+        self.matmul_issue_latency = math.ceil(processing_element_latency * matrix_dim)
+
 class GemmCache(MemObject):
-    def __init__(self, matrix_dim: int, num_matrices: int, addr_start: int, gemm_cache_latencies: GemmCacheLatencies, bytes_per_element: int = 1) -> None:
-        size = matrix_dim * matrix_dim * num_matrices # size is also addr_range
-        super().__init__(size, size, gemm_cache_latencies.read_latency, gemm_cache_latencies.write_latency)
-        self.addr_range = addr_start + size
+    def __init__(self, matrix_dim: int, num_matrices: int, addr_start: int, gemm_cache_latencies: GemmCacheLatencies, bytes_per_element: int = 1, pipeline_batches: bool = False) -> None:
+        assert bytes_per_element in [1, 2, 4], "Error: GemmCache elements must be 1, 2 or 4 bytes"
+        size = matrix_dim * matrix_dim * num_matrices * bytes_per_element # size is also addr_range
+        super().__init__(size, size, gemm_cache_latencies.read_latency, gemm_cache_latencies.write_latency, addr_start)
         self.matrix_dim = matrix_dim
         self.num_matrices = num_matrices
         self.matmul_latency = gemm_cache_latencies.matmul_latency
         self.matadd_latency = gemm_cache_latencies.matadd_latency
-        self.matrices = MemoryArray(matrix_dim * matrix_dim * num_matrices)
+        self.matmul_issue_latency = gemm_cache_latencies.matmul_issue_latency
+        self.matadd_issue_latency = gemm_cache_latencies.matadd_issue_latency
+        self.pipeline_batches = pipeline_batches # batches report pipelined latency instead of the sum of each operation
+        self.matrices = DenseMemoryArray(size)
         self.quantization = bytes_per_element
+        self.matrix_bytes = matrix_dim * matrix_dim * bytes_per_element
+        # big endian elements of quantization bytes sharing the buffer of self.matrices
+        self.elements = np.frombuffer(self.matrices.buffer, dtype=np.dtype(f">u{bytes_per_element}"))
 
     def process_packet(self, pkt: Packet) -> Packet:
         if pkt.load:
-            pkt.data = 0
-            for i in range(pkt.size):
-                byte = self.matrices[pkt.addr+i]
-                assert byte < 256
-                pkt.data = (pkt.data << 8) | byte
+            pkt.data = self.matrices.load(pkt.addr, pkt.size)
             pkt.latency += self.read_latency # edit latency stuff
+            self.reads += 1
+            self.bytes_read += pkt.size
+            self.busy_cycles += self.read_latency
         else:
-            for i in range(pkt.size):
-                byte = (pkt.data >> ((pkt.size - i - 1) * 8)) & 0xff
-                self.matrices[pkt.addr+i] = byte
+            self.matrices.store(pkt.addr, pkt.size, pkt.data)
             pkt.latency += self.write_latency
+            self.writes += 1
+            self.bytes_written += pkt.size
+            self.busy_cycles += self.write_latency
+        return pkt
+
+    def process_tile_packet(self, pkt: TilePacket) -> TilePacket:
+        # the whole tile is one access to the matrix storage, copied as a strided NumPy slice
+        if pkt.load:
+            pkt.data = self.matrices.load_tile(pkt.addr, pkt.rows, pkt.cols, pkt.stride)
+            pkt.latency += self.read_latency
+            self.reads += 1
+            self.bytes_read += pkt.rows * pkt.cols
+            self.busy_cycles += self.read_latency
+        else:
+            self.matrices.store_tile(pkt.addr, pkt.stride, pkt.data)
+            pkt.latency += self.write_latency
+            self.writes += 1
+            self.bytes_written += pkt.rows * pkt.cols
+            self.busy_cycles += self.write_latency
         return pkt
     
     def process_matrix_op_packet(self, pkt: MatrixPacket) -> MatrixPacket:
-        assert pkt.matA_start % (self.matrix_dim * self.matrix_dim) == 0
-        assert pkt.matB_start % (self.matrix_dim * self.matrix_dim) == 0
-        assert pkt.matC_start % (self.matrix_dim * self.matrix_dim) == 0
+        assert pkt.matA_start % self.matrix_bytes == 0
+        assert pkt.matB_start % self.matrix_bytes == 0
+        assert pkt.matC_start % self.matrix_bytes == 0
         if pkt.multiply:
             self.matrix_multiply(pkt.matA_start, pkt.matB_start, pkt.matC_start)
             pkt.latency += self.matmul_latency
+            self.matmuls += 1
+            self.busy_cycles += self.matmul_latency
         else:
             self.matrix_add(pkt.matA_start, pkt.matB_start, pkt.matC_start)
             pkt.latency += self.matadd_latency
+            self.matadds += 1
+            self.busy_cycles += self.matadd_latency
         return pkt
     
-    def matrix_multiply(self, matA_start: int, matB_start: int, matC_start: int) -> None:
-        rows_A = cols_A = cols_B = self.matrix_dim
-        
-        for i in range(rows_A):
-            for j in range(cols_B):
-                result = 0
-                for k in range(cols_A):
-                    matA_addr = matA_start + (i * cols_A + k) * self.quantization
-                    matB_addr = matB_start + (k * cols_B + j) * self.quantization
-
-                    valA = self.matrices.load(matA_addr, self.quantization)
-                    valB = self.matrices.load(matB_addr, self.quantization)
+    def process_matrix_batch_packet(self, pkt: MatrixBatchPacket) -> MatrixBatchPacket:
+        assert not pkt.accumulate or pkt.multiply, "Error: only matrix multiply batches can accumulate"
+        slots_A, slots_B, slots_C = [], [], []
+        for matA_start, matB_start, matC_start in pkt.mat_starts:
+            assert matA_start % self.matrix_bytes == 0
+            assert matB_start % self.matrix_bytes == 0
+            assert matC_start % self.matrix_bytes == 0
+            slots_A.append(matA_start // self.matrix_bytes)
+            slots_B.append(matB_start // self.matrix_bytes)
+            slots_C.append(matC_start // self.matrix_bytes)
+        assert all(0 <= slot < self.num_matrices for slot in slots_A + slots_B + slots_C), "Error: out of bounds GemmCache matrix"
+        if len(pkt.mat_starts) == 0:
+            return pkt
 
-                    result += valA * valB
+        if set(slots_C).isdisjoint(slots_A + slots_B):
+            self.matrix_batch(pkt.multiply, pkt.accumulate, slots_A, slots_B, slots_C)
+        else:
+            # a result feeds a later operation, fall back to executing in order
+            for matA_start, matB_start, matC_start in pkt.mat_starts:
+                if pkt.accumulate:
+                    self.matrix_batch(True, True, [matA_start // self.matrix_bytes], [matB_start // self.matrix_bytes], [matC_start // self.matrix_bytes])
+                elif pkt.multiply:
+                    self.matrix_multiply(matA_start, matB_start, matC_start)
+                else:
+                    self.matrix_add(matA_start, matB_start, matC_start)
 
-                matC_addr = matC_start + (i * cols_B + j) * self.quantization
-                self.matrices.store(matC_addr, self.quantization, result)
+        if pkt.multiply:
+            op_latency = self.matmul_latency + (self.matadd_latency if pkt.accumulate else 0)
+            issue_latency = self.matmul_issue_latency
+        else:
+            op_latency = self.matadd_latency
+            issue_latency = self.matadd_issue_latency
+        if self.pipeline_batches:
+            latency = op_latency + (len(pkt.mat_starts) - 1) * issue_latency
+        else:
+            latency = op_latency * len(pkt.mat_starts)
+        pkt.latency += latency
+        # an accumulating multiply is a matmul followed by a matadd
+        self.matmuls += len(pkt.mat_starts) if pkt.multiply else 0
+        self.matadds += len(pkt.mat_starts) if pkt.accumulate or not pkt.multiply else 0
+        self.busy_cycles += latency
+        return pkt
 
-    def matrix_add(self, matA_start: int, matB_start: int, matC_start: int) -> None:
-        rows = cols = self.matrix_dim
-        
-        for i in range(rows):
-            for j in range(cols):
-                matA_addr = matA_start + (i * cols + j) * self.quantization
-                matB_addr = matB_start + (i * cols + j) * self.quantization
-                matC_addr = matC_start + (i * cols + j) * self.quantization
+    def matrix_batch(self, multiply: bool, accumulate: bool, slots_A: list[int], slots_B: list[int], slots_C: list[int]) -> None:
+        # executes every operation at once, only valid when no C slot is also an A or B slot of the batch
+        slots = self.elements.reshape(self.num_matrices, self.matrix_dim, self.matrix_dim)
+        if multiply:
+            results = np.matmul(slots[slots_A].astype(np.uint64), slots[slots_B].astype(np.uint64))
+        else:
+            results = np.add(slots[slots_A], slots[slots_B])
+        if accumulate:
+            # every product for the same C slot is summed, then added onto C
+            out_slots, result_idx = np.unique(slots_C, return_inverse=True)
+            sums = slots[out_slots].astype(np.uint64)
+            np.add.at(sums, result_idx, results)
+            slots[out_slots] = sums.astype(slots.dtype)
+        else:
+            # when a C slot is written more than once the last operation wins, same as executing in order
+            last_result = {slot: i for i, slot in enumerate(slots_C)}
+            slots[list(last_result.keys())] = results[list(last_result.values())].astype(slots.dtype)
 
-                valA = self.matrices.load(matA_addr, self.quantization)
-                valB = self.matrices.load(matB_addr, self.quantization)
+    def matrix_view(self, mat_start: int) -> np.ndarray:
+        # matrix_dim by matrix_dim view of a matrix slot, writes to the view go straight into self.matrices
+        start = mat_start // self.quantization
+        return self.elements[start : start + self.matrix_dim * self.matrix_dim].reshape(self.matrix_dim, self.matrix_dim)
 
-                result = valA + valB
+    def matrix_multiply(self, matA_start: int, matB_start: int, matC_start: int) -> None:
+        # products are accumulated in uint64 and truncated to the element width when stored, same as MemoryArray.store
+        matA = self.matrix_view(matA_start).astype(np.uint64)
+        matB = self.matrix_view(matB_start).astype(np.uint64)
+        matC = self.matrix_view(matC_start)
+        matC[...] = np.matmul(matA, matB).astype(matC.dtype)
 
-                self.matrices.store(matC_addr, self.quantization, result)
+    def matrix_add(self, matA_start: int, matB_start: int, matC_start: int) -> None:
+        # element dtype wraps around on overflow, which truncates the sum to the element width
+        matC = self.matrix_view(matC_start)
+        np.add(self.matrix_view(matA_start), self.matrix_view(matB_start), out=matC)
 
     def print_memory(self, starting_addr) -> None:
         self.matrices.print(starting_addr)
 
 class Cache(MemObject):
-    def __init__(self, size: int, addr_range: int, block_size: int, read_latency: int, write_latency: int, dram: Dram) -> None:
+    # Set associative write allocate, write back cache in front of next_level, which is any MemObject (eg an L2 Cache or a Dram)
+    # sets, ways and offset bits are derived from size, block_size and associativity (1 is direct mapped)
+    # every access pays read_latency or write_latency, a miss also pays miss_latency plus the latency of next_level
+    # inclusion policy towards the caches above this one:
+    #   non_inclusive: blocks are filled into every level and evicted independently
+    #   inclusive: evicting a block here also invalidates it in the caches above
+    #   exclusive: blocks are only allocated here when evicted from the cache above, and move up on a hit
+    # an optional prefetcher fills blocks off the critical path, their latency is not charged to demand accesses
+    def __init__(self, size: int, addr_range: int, block_size: int, read_latency: int, write_latency: int, next_level: MemObject, associativity: int = 1, replacement_policy: str = "lru", inclusion: str = "non_inclusive", miss_latency: int = 0, prefetcher: Prefetcher = None) -> None:
         super().__init__(size, addr_range, read_latency, write_latency)
+        assert block_size > 0 and (block_size & (block_size - 1)) == 0, "Error: cache block size must be a power of 2"
+        assert size % (block_size * associativity) == 0, "Error: cache size must be a multiple of block_size * associativity"
+        assert inclusion in ["non_inclusive", "inclusive", "exclusive"], f"Error: unknown inclusion policy {inclusion}"
         self.block_size = block_size
-        self.cache = MemoryArray(size)
-        self.tags = {}
-        self.dram = dram     
-    
-    def evict_cache(self):
-        for block_num, tag in self.tags.items():
-            evict_pkt = Packet(False, tag + block_num, self.block_size, self.cache.load(block_num, self.block_size), 1)
-            self.dram.process_packet(evict_pkt)
+        self.num_ways = associativity
+        self.num_sets = size // (block_size * associativity)
+        assert (self.num_sets & (self.num_sets - 1)) == 0, "Error: number of cache sets must be a power of 2"
+        self.offset_bits = block_size.bit_length() - 1
+        self.set_bits = self.num_sets.bit_length() - 1
+        self.cache = DenseMemoryArray(size) # block for (set, way) starts at (set * num_ways + way) * block_size
+        self.tags = np.zeros((self.num_sets, self.num_ways), dtype=np.int64)
+        self.valid = np.zeros((self.num_sets, self.num_ways), dtype=bool)
+        self.dirty = np.zeros((self.num_sets, self.num_ways), dtype=bool) # only dirty blocks are written back
+        self.prefetched = np.zeros((self.num_sets, self.num_ways), dtype=bool) # filled by a prefetch and not used yet
+        self.replacement = make_replacement_policy(replacement_policy, self.num_sets, self.num_ways)
+        self.inclusion = inclusion
+        self.miss_latency = miss_latency
+        self.next_level = next_level
+        self.upper_levels = [] # caches that use this cache as their next level
+        assert prefetcher is None or (inclusion != "exclusive" and prefetcher.block_size == block_size), "Error: prefetcher needs a non exclusive cache with the same block size"
+        self.prefetcher = prefetcher
+        if isinstance(next_level, Cache):
+            assert next_level.block_size == block_size, "Error: cache levels must use the same block size"
+            next_level.upper_levels.append(self)
+
+    def block_addr(self, set_idx: int, way: int) -> int:
+        # address of the block currently held in (set_idx, way)
+        return (int(self.tags[set_idx, way]) << (self.offset_bits + self.set_bits)) | (set_idx << self.offset_bits)
+
+    def line_addr(self, set_idx: int, way: int) -> int:
+        # address of (set_idx, way) inside self.cache
+        return (set_idx * self.num_ways + way) * self.block_size
+
+    def find_way(self, set_idx: int, tag: int) -> int:
+        # way holding tag in set_idx, -1 on a miss
+        hit_ways = np.flatnonzero(self.valid[set_idx] & (self.tags[set_idx] == tag))
+        return int(hit_ways[0]) if len(hit_ways) > 0 else -1
+
+    def next_level_is_exclusive(self) -> bool:
+        return isinstance(self.next_level, Cache) and self.next_level.inclusion == "exclusive"
+
+    def write_back(self, set_idx: int, way: int) -> int:
+        # write the block to next_level if it is dirty, returns the cycles consumed
+        if not self.dirty[set_idx, way]:
+            return 0
+        evict_pkt = Packet(False, self.block_addr(set_idx, way), self.block_size, self.cache.load(self.line_addr(set_idx, way), self.block_size), 0)
+        self.dirty[set_idx, way] = False
+        self.writebacks += 1
+        return self.next_level.process_packet(evict_pkt).latency
+
+    def evict(self, set_idx: int, way: int) -> int:
+        # remove a valid block from the cache, returns the cycles consumed
+        cycles = 0
+        self.evictions += 1
+        block_addr = self.block_addr(set_idx, way)
+        if self.inclusion == "inclusive":
+            # back invalidate, dirty copies above are written back into this block first
+            for upper_level in self.upper_levels:
+                cycles += upper_level.invalidate(block_addr, self.block_size)
+        if self.next_level_is_exclusive():
+            # an exclusive next level is filled with every victim, clean or dirty
+            cycles += self.next_level.insert_victim(block_addr, self.cache.load(self.line_addr(set_idx, way), self.block_size), bool(self.dirty[set_idx, way]))
+            self.dirty[set_idx, way] = False
+        else:
+            cycles += self.write_back(set_idx, way)
+        self.drop(set_idx, way)
+        return cycles
+
+    def drop(self, set_idx: int, way: int) -> None:
+        # invalidate a block, counting prefetched blocks that were never used
+        if self.prefetched[set_idx, way]:
+            self.prefetcher.useless += 1
+            self.prefetched[set_idx, way] = False
+        self.valid[set_idx, way] = False
+
+    def allocate(self, addr: int) -> tuple[int, int, int]:
+        # pick a way for the block holding addr, evicting if the set is full; returns (set, way, cycles consumed)
+        set_idx = (addr >> self.offset_bits) & (self.num_sets - 1)
+        invalid_ways = np.flatnonzero(~self.valid[set_idx])
+        if len(invalid_ways) > 0:
+            return set_idx, int(invalid_ways[0]), 0
+        way = self.replacement.victim(set_idx)
+        return set_idx, way, self.evict(set_idx, way)
+
+    def fill(self, set_idx: int, way: int, addr: int, data: int, dirty: bool) -> None:
+        self.cache.store(self.line_addr(set_idx, way), self.block_size, data)
+        self.tags[set_idx, way] = addr >> (self.offset_bits + self.set_bits)
+        self.valid[set_idx, way] = True
+        self.dirty[set_idx, way] = dirty
+        self.replacement.insert(set_idx, way)
+
+    def fetch_block(self, block_addr: int) -> tuple[int, int, bool]:
+        # read a block from next_level on a miss, returns (data, latency, dirty)
+        if self.next_level_is_exclusive():
+            return self.next_level.take_block(block_addr)
+        next_pkt = Packet(True, block_addr, self.block_size, None, 0)
+        next_pkt = self.next_level.process_packet(next_pkt)
+        return next_pkt.data, next_pkt.latency, False
+
+    def take_block(self, block_addr: int) -> tuple[int, int, bool]:
+        # exclusive level: hand a block to the cache above and drop it here, returns (data, latency, dirty)
+        set_idx = (block_addr >> self.offset_bits) & (self.num_sets - 1)
+        way = self.find_way(set_idx, block_addr >> (self.offset_bits + self.set_bits))
+        self.reads += 1
+        self.bytes_read += self.block_size
+        if way < 0:
+            self.misses += 1
+            data, latency, dirty = self.fetch_block(block_addr)
+            self.busy_cycles += self.read_latency + self.miss_latency + latency
+            return data, self.read_latency + self.miss_latency + latency, dirty
+        self.hits += 1
+        data = self.cache.load(self.line_addr(set_idx, way), self.block_size)
+        dirty = bool(self.dirty[set_idx, way])
+        self.drop(set_idx, way)
+        self.dirty[set_idx, way] = False
+        self.busy_cycles += self.read_latency
+        return data, self.read_latency, dirty
+
+    def insert_victim(self, block_addr: int, data: int, dirty: bool) -> int:
+        # exclusive level: allocate a block evicted from the cache above, returns the cycles consumed
+        set_idx, way, cycles = self.allocate(block_addr)
+        self.fill(set_idx, way, block_addr, data, dirty)
+        self.writes += 1
+        self.bytes_written += self.block_size
+        self.busy_cycles += self.write_latency + cycles
+        return self.write_latency + cycles
+
+    def block_range(self, addr: int, size: int):
+        # (set, way) of every resident block overlapping [addr, addr + size)
+        first_block = addr >> self.offset_bits
+        last_block = (addr + size - 1) >> self.offset_bits
+        for block in range(first_block, last_block + 1):
+            set_idx = block & (self.num_sets - 1)
+            way = self.find_way(set_idx, block >> self.set_bits)
+            if way >= 0:
+                yield set_idx, way
+
+    def flush(self, addr: int, size: int) -> int:
+        # write back dirty blocks overlapping the range, they stay valid and clean; returns the cycles consumed
+        return sum(self.write_back(set_idx, way) for set_idx, way in self.block_range(addr, size))
+
+    def invalidate(self, addr: int, size: int) -> int:
+        # write back dirty blocks overlapping the range and drop them from the cache; returns the cycles consumed
+        cycles = 0
+        for set_idx, way in list(self.block_range(addr, size)):
+            cycles += self.write_back(set_idx, way)
+            self.drop(set_idx, way)
+        return cycles
+
+    def flush_all(self) -> int:
+        # write back every dirty block to next_level; returns the cycles consumed
+        cycles = 0
+        for set_idx, way in zip(*np.nonzero(self.dirty)):
+            cycles += self.write_back(int(set_idx), int(way))
+        return cycles
+
+    def flush_all_levels(self) -> int:
+        # flush this cache and then every cache below it, so memory is up to date; returns the cycles consumed
+        cycles = self.flush_all()
+        if isinstance(self.next_level, Cache):
+            cycles += self.next_level.flush_all_levels()
+        return cycles
+
+    def evict_cache(self) -> int:
+        return self.flush_all()
+
+    def access_block(self, addr: int, write: bool) -> tuple[int, int, bool]:
+        # find or allocate the block holding addr, returns (address of the block in self.cache, latency added, hit)
+        # returns address -1 when an exclusive cache misses, the access then goes straight to next_level
+        set_idx = (addr >> self.offset_bits) & (self.num_sets - 1)
+        way = self.find_way(set_idx, addr >> (self.offset_bits + self.set_bits))
+        if way >= 0:
+            self.hits += 1
+            self.replacement.touch(set_idx, way)
+            self.dirty[set_idx, way] |= write
+            if self.prefetched[set_idx, way]:
+                self.prefetcher.useful += 1
+                self.prefetched[set_idx, way] = False
+            return self.line_addr(set_idx, way), 0, True
+        self.misses += 1
+        if self.inclusion == "exclusive":
+            return -1, self.miss_latency, False
+
+        set_idx, way, latency = self.allocate(addr)
+        block_addr = addr & ~(self.block_size - 1)
+        data, fetch_latency, dirty = self.fetch_block(block_addr)
+        self.fill(set_idx, way, block_addr, data, dirty or write)
+        return self.line_addr(set_idx, way), self.miss_latency + latency + fetch_latency, False
+
+    def prefetch(self, block_addrs: list[int]) -> None:
+        # fill blocks that are not resident yet, the cycles are not charged to the demand access
+        for block_addr in block_addrs:
+            if block_addr < 0 or block_addr + self.block_size > self.addr_range:
+                continue
+            set_idx = (block_addr >> self.offset_bits) & (self.num_sets - 1)
+            if self.find_way(set_idx, block_addr >> (self.offset_bits + self.set_bits)) >= 0:
+                continue
+            set_idx, way, _ = self.allocate(block_addr)
+            data, _, dirty = self.fetch_block(block_addr)
+            self.fill(set_idx, way, block_addr, data, dirty)
+            self.prefetched[set_idx, way] = True
+            self.prefetcher.issued += 1
+            self.prefetcher.fill_bytes += self.block_size
 
     def process_packet(self, pkt: Packet) -> Packet:
-        pkt_tag = pkt.addr & (~0xFF)
-        cache_addr = pkt.addr & 0xF8
-        if pkt.load:
-            if cache_addr in self.tags and (self.tags[cache_addr] == pkt_tag):
-                pkt.data = self.cache.load(pkt.addr & (0xFF), pkt.size)
-                return pkt
-            elif cache_addr in self.tags:
-                # Evict data in set
-                evict_data = self.cache.load(cache_addr, self.block_size)
-                evict_pkt = Packet(False, self.tags[cache_addr] + cache_addr, self.block_size, evict_data, 1)
-                self.dram.process_packet(evict_pkt)
-                self.tags.pop(cache_addr)
-
-                # Ask DRAM for Data block
-                dram_pkt = Packet(pkt.load, pkt.addr & (~0x7), self.block_size, pkt.data, pkt.latency)
-                new_data = self.dram.process_packet(dram_pkt)
-
-                # Store DRAM's block into cache, add to tag array, and return loaded data
-                self.cache.store(new_data.addr & 0xF8, new_data.size, new_data.data)
-                self.tags[cache_addr]=pkt_tag
-                pkt.data = self.cache.load(pkt.addr & (0xFF), pkt.size)
-                pkt.latency += new_data.latency
-                return pkt
+        # accesses that cross a block boundary are split into one access per block
+        data = 0
+        addr = pkt.addr
+        end = pkt.addr + pkt.size
+        before = pkt.latency
+        pkt.latency += self.read_latency if pkt.load else self.write_latency
+        while addr < end:
+            size = min(end, (addr | (self.block_size - 1)) + 1) - addr
+            line_addr, latency, hit = self.access_block(addr, not pkt.load)
+            if line_addr < 0:
+                # exclusive miss, bypass this cache
+                piece_pkt = Packet(pkt.load, addr, size, None if pkt.load else pkt.data >> ((end - addr - size) * 8), 0)
+                piece_pkt = self.next_level.process_packet(piece_pkt)
+                latency += piece_pkt.latency
+                piece_data = piece_pkt.data
+            elif pkt.load:
+                piece_data = self.cache.load(line_addr + (addr & (self.block_size - 1)), size)
             else:
-                # Ask DRAM for Data block
-                dram_pkt = Packet(pkt.load, pkt.addr & (~0x7), self.block_size, pkt.data, pkt.latency)
-                new_data = self.dram.process_packet(dram_pkt)
-
-                # Store DRAM's block into cache, add to tag array, and return loaded data
-                self.cache.store(new_data.addr & 0xF8, new_data.size, new_data.data)
-                self.tags[cache_addr]=pkt_tag
-                pkt.data = self.cache.load(pkt.addr & (0xFF), pkt.size)
-                pkt.latency += new_data.latency
-                return pkt
+                self.cache.store(line_addr + (addr & (self.block_size - 1)), size, pkt.data >> ((end - addr - size) * 8))
+            if pkt.load:
+                data = (data << (size * 8)) | piece_data
+            if self.prefetcher is not None:
+                # after the demand access is done, so a prefetch can't evict the block that was just used
+                self.prefetch(self.prefetcher.observe(addr, pkt.pc, hit))
+            pkt.latency += latency
+            addr += size
+        if pkt.load:
+            pkt.data = data
+            self.reads += 1
+            self.bytes_read += pkt.size
         else:
-            if cache_addr in self.tags and (self.tags[cache_addr] == pkt_tag):
-                self.cache.store(pkt.addr & (0xFF), pkt.size, pkt.data)
-                return pkt
-            elif cache_addr in self.tags and (self.tags[cache_addr] != pkt_tag):
-                # Evict data in set
-                evict_data = self.cache.load(cache_addr, self.block_size)
-                evict_pkt = Packet(False, self.tags[cache_addr] + cache_addr, self.block_size, evict_data, 1)
-                self.dram.process_packet(evict_pkt)
-                self.tags.pop(cache_addr)
-
-                # Ask DRAM for Data block
-                dram_pkt = Packet(True, pkt.addr & (~0x7), self.block_size, pkt.data, pkt.latency)
-                new_data = self.dram.process_packet(dram_pkt)
-
-                # Store DRAM's data in the cache and then store the requested data into cache
-                self.cache.store(new_data.addr & 0xF8, new_data.size, new_data.data)
-                self.cache.store(pkt.addr & (0xFF), pkt.size, pkt.data)
-                self.tags[cache_addr]=pkt_tag
-                pkt.latency += new_data.latency
-                return pkt
-            else:
-                # Ask DRAM for Data block
-                dram_pkt = Packet(True, pkt.addr & (~0x7), self.block_size, pkt.data, pkt.latency)
-                new_data = self.dram.process_packet(dram_pkt)
+            self.writes += 1
+            self.bytes_written += pkt.size
+        self.busy_cycles += pkt.latency - before
+        return pkt
+
+    def reset_stats(self) -> None:
+        super().reset_stats()
+        if getattr(self, "prefetcher", None) is not None:
+            self.prefetcher.reset_stats()
 
-                # Store DRAM's data in the cache and then store the requested data into cache
-                self.cache.store(new_data.addr & 0xF8, new_data.size, new_data.data)
-                self.cache.store(pkt.addr & (0xFF), pkt.size, pkt.data)
-                self.tags[cache_addr]=pkt_tag
-                pkt.latency += new_data.latency
-                return pkt
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        if self.prefetcher is not None:
+            stats["prefetcher"] = self.prefetcher.get_stats()
+        return stats
 
     def print(self, starting_addr: int) -> None:
         self.cache.print(starting_addr)
-
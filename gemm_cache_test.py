@@ -1,7 +1,7 @@
 # gemm_cache_test.py
 
-from gemm_cache import GemmCache
-from packet import Packet, MatrixPacket
+from gemm_cache import GemmCache, GemmCacheLatencies
+from packet import Packet, MatrixPacket, MatrixBatchPacket
 import numpy as np
 
 def integer_to_array(integer, rows, cols, dtype=np.uint8):
@@ -32,13 +32,17 @@ if __name__ == "__main__":
     MATRIX_DIM = 3
     MATRIX_SIZE = MATRIX_DIM * MATRIX_DIM
 
+    gemm_cache_latencies = GemmCacheLatencies(matrix_dim=MATRIX_DIM)
+    gemm_cache_latencies.read_latency = READ_LATENCY
+    gemm_cache_latencies.write_latency = WRITE_LATENCY
+    gemm_cache_latencies.matmul_latency = MATMUL_LATENCY
+    gemm_cache_latencies.matadd_latency = MATADD_LATENCY
+
     gemm_cache = GemmCache(
         matrix_dim=MATRIX_DIM,
         num_matrices=NUM_MATRICES,
-        read_latency=READ_LATENCY,
-        write_latency=WRITE_LATENCY,
-        matmul_latency=MATMUL_LATENCY,
-        matadd_latency=MATADD_LATENCY
+        addr_start=0,
+        gemm_cache_latencies=gemm_cache_latencies
     )
 
     matA = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.uint8)
@@ -78,29 +82,80 @@ if __name__ == "__main__":
     pkt_read_ret = gemm_cache.process_packet(pkt_read)
     assert(pkt_read_ret.data == expected_mat_flat)
 
-    # # test add
-    # pkt_write = Packet(load=False, addr=MATRIX_SIZE, size=MATRIX_SIZE, data=matB_flat, latency=pkt_read_ret.latency)
-    # pkt_write_ret = gemm_cache.process_packet(pkt_write)
-
-    # pkt_mat_add = MatrixPacket(multiply=False, matA_start=0, matB_start=MATRIX_SIZE, matC_start = MATRIX_SIZE*2, latency=pkt_write_ret.latency)
-    # pkt_mat_add_ret = gemm_cache.process_matrix_op_packet(pkt_mat_add)
-    # assert(pkt_mat_add_ret.latency == WRITE_LATENCY*2 + READ_LATENCY + MATADD_LATENCY)
-
-    # expected_mat = np.add(matA, matB, dtype=np.uint8)
-    # expected_mat_flat = array_to_integer(expected_mat.flatten(order='C'))
-    # pkt_read = Packet(load=True, addr=MATRIX_SIZE*2, size=MATRIX_SIZE, data=None, latency=pkt_mat_add_ret.latency)
-    # pkt_read_ret = gemm_cache.process_packet(pkt_read)
-    # assert(pkt_read_ret.data == expected_mat_flat)
-
-    # # test multiply
-    # pkt_mat_mul = MatrixPacket(multiply=True, matA_start=0, matB_start=MATRIX_SIZE, matC_start = MATRIX_SIZE*2, latency=pkt_read_ret.latency)
-    # pkt_mat_mul_ret = gemm_cache.process_matrix_op_packet(pkt_mat_mul)
-    # assert(pkt_mat_mul_ret.latency == WRITE_LATENCY*2 + READ_LATENCY*2 + MATADD_LATENCY + MATMUL_LATENCY)
-
-    # expected_mat = np.matmul(matA, matB)
-    # expected_mat_flat = array_to_integer(expected_mat.flatten(order='C'))
-    # pkt_read = Packet(load=True, addr=MATRIX_SIZE*2, size=MATRIX_SIZE, data=None, latency=pkt_mat_mul_ret.latency)
-    # pkt_read_ret = gemm_cache.process_packet(pkt_read)
-    # assert(pkt_read_ret.data == expected_mat_flat)
+    # test add
+    pkt_write = Packet(load=False, addr=MATRIX_SIZE, size=MATRIX_SIZE, data=matB_flat, latency=pkt_read_ret.latency)
+    pkt_write_ret = gemm_cache.process_packet(pkt_write)
+
+    pkt_mat_add = MatrixPacket(multiply=False, matA_start=0, matB_start=MATRIX_SIZE, matC_start = MATRIX_SIZE*2, latency=pkt_write_ret.latency)
+    pkt_mat_add_ret = gemm_cache.process_matrix_op_packet(pkt_mat_add)
+    assert(pkt_mat_add_ret.latency == pkt_write_ret.latency + MATADD_LATENCY)
+
+    expected_mat = np.add(matA, matB, dtype=np.uint8)
+    expected_mat_flat = array_to_integer(expected_mat.flatten(order='C'))
+    pkt_read = Packet(load=True, addr=MATRIX_SIZE*2, size=MATRIX_SIZE, data=None, latency=pkt_mat_add_ret.latency)
+    pkt_read_ret = gemm_cache.process_packet(pkt_read)
+    assert(pkt_read_ret.data == expected_mat_flat)
+
+    # test multiply
+    pkt_mat_mul = MatrixPacket(multiply=True, matA_start=0, matB_start=MATRIX_SIZE, matC_start = MATRIX_SIZE*2, latency=pkt_read_ret.latency)
+    pkt_mat_mul_ret = gemm_cache.process_matrix_op_packet(pkt_mat_mul)
+    assert(pkt_mat_mul_ret.latency == pkt_read_ret.latency + MATMUL_LATENCY)
+
+    expected_mat = np.matmul(matA, matB)
+    expected_mat_flat = array_to_integer(expected_mat.flatten(order='C'))
+    pkt_read = Packet(load=True, addr=MATRIX_SIZE*2, size=MATRIX_SIZE, data=None, latency=pkt_mat_mul_ret.latency)
+    pkt_read_ret = gemm_cache.process_packet(pkt_read)
+    assert(pkt_read_ret.data == expected_mat_flat)
+
+    # test multiply and add with 2 byte elements against a reference that truncates like MemoryArray.store
+    gemm_cache = GemmCache(matrix_dim=MATRIX_DIM, num_matrices=NUM_MATRICES, addr_start=0, gemm_cache_latencies=gemm_cache_latencies, bytes_per_element=2)
+    matA = np.random.randint(0, 1 << 16, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.int64)
+    matB = np.random.randint(0, 1 << 16, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.int64)
+    for i in range(MATRIX_DIM):
+        for j in range(MATRIX_DIM):
+            gemm_cache.matrices.store((i * MATRIX_DIM + j) * 2, 2, int(matA[i][j]))
+            gemm_cache.matrices.store(MATRIX_SIZE * 2 + (i * MATRIX_DIM + j) * 2, 2, int(matB[i][j]))
+
+    pkt_mat_mul = MatrixPacket(multiply=True, matA_start=0, matB_start=MATRIX_SIZE*2, matC_start=MATRIX_SIZE*4)
+    assert(gemm_cache.process_matrix_op_packet(pkt_mat_mul).latency == MATMUL_LATENCY)
+    pkt_mat_add = MatrixPacket(multiply=False, matA_start=0, matB_start=MATRIX_SIZE*2, matC_start=MATRIX_SIZE*2)
+    assert(gemm_cache.process_matrix_op_packet(pkt_mat_add).latency == MATADD_LATENCY)
+    for i in range(MATRIX_DIM):
+        for j in range(MATRIX_DIM):
+            expected_product = sum(int(matA[i][k]) * int(matB[k][j]) for k in range(MATRIX_DIM)) & 0xffff
+            assert(gemm_cache.matrices.load(MATRIX_SIZE * 4 + (i * MATRIX_DIM + j) * 2, 2) == expected_product)
+            expected_sum = (int(matA[i][j]) + int(matB[i][j])) & 0xffff
+            assert(gemm_cache.matrices.load(MATRIX_SIZE * 2 + (i * MATRIX_DIM + j) * 2, 2) == expected_sum)
+
+    # test batched multiply accumulate against issuing the same operations one at a time
+    NUM_MATRICES = 8
+    batch_cache = GemmCache(matrix_dim=MATRIX_DIM, num_matrices=NUM_MATRICES, addr_start=0, gemm_cache_latencies=gemm_cache_latencies)
+    serial_cache = GemmCache(matrix_dim=MATRIX_DIM, num_matrices=NUM_MATRICES, addr_start=0, gemm_cache_latencies=gemm_cache_latencies)
+    contents = np.random.randint(0, 256, size=MATRIX_SIZE * NUM_MATRICES, dtype=np.uint8)
+    batch_cache.matrices.store(0, MATRIX_SIZE * NUM_MATRICES, array_to_integer(contents))
+    serial_cache.matrices.store(0, MATRIX_SIZE * NUM_MATRICES, array_to_integer(contents))
+
+    # C slot 6 accumulates A0*B1 + A2*B3 + A4*B5
+    mat_starts = [(0, MATRIX_SIZE, MATRIX_SIZE*6), (MATRIX_SIZE*2, MATRIX_SIZE*3, MATRIX_SIZE*6), (MATRIX_SIZE*4, MATRIX_SIZE*5, MATRIX_SIZE*6)]
+    pkt_batch = batch_cache.process_matrix_batch_packet(MatrixBatchPacket(multiply=True, mat_starts=mat_starts, accumulate=True))
+    assert(pkt_batch.latency == 3 * (MATMUL_LATENCY + MATADD_LATENCY))
+    for matA_start, matB_start, matC_start in mat_starts:
+        serial_cache.process_matrix_op_packet(MatrixPacket(multiply=True, matA_start=matA_start, matB_start=matB_start, matC_start=MATRIX_SIZE*7))
+        serial_cache.process_matrix_op_packet(MatrixPacket(multiply=False, matA_start=matC_start, matB_start=MATRIX_SIZE*7, matC_start=matC_start))
+    assert(batch_cache.matrices.load(MATRIX_SIZE*6, MATRIX_SIZE) == serial_cache.matrices.load(MATRIX_SIZE*6, MATRIX_SIZE))
+    assert((batch_cache.matmuls, batch_cache.matadds) == (serial_cache.matmuls, serial_cache.matadds) == (3, 3))
+    assert(batch_cache.busy_cycles == serial_cache.busy_cycles == pkt_batch.latency)
+
+    # a result that feeds a later operation in the same batch is executed in order
+    mat_starts = [(0, MATRIX_SIZE, MATRIX_SIZE*2), (MATRIX_SIZE*2, MATRIX_SIZE*3, MATRIX_SIZE*4)]
+    batch_cache.process_matrix_batch_packet(MatrixBatchPacket(multiply=False, mat_starts=mat_starts))
+    for matA_start, matB_start, matC_start in mat_starts:
+        serial_cache.process_matrix_op_packet(MatrixPacket(multiply=False, matA_start=matA_start, matB_start=matB_start, matC_start=matC_start))
+    assert(batch_cache.matrices.load(0, MATRIX_SIZE * 6) == serial_cache.matrices.load(0, MATRIX_SIZE * 6))
+
+    # pipelined batches only pay the issue latency after the first operation
+    batch_cache.pipeline_batches = True
+    pkt_batch = batch_cache.process_matrix_batch_packet(MatrixBatchPacket(multiply=True, mat_starts=[(0, MATRIX_SIZE, MATRIX_SIZE*6)] * 4))
+    assert(pkt_batch.latency == MATMUL_LATENCY + 3 * gemm_cache_latencies.matmul_issue_latency)
 
     print("GemmCache Test Finished")
@@ -0,0 +1,282 @@
+# gemm_codegen.py
+
+from program import Program
+import math
+
+# C = A*B (+ D) with A M x K, B K x N and C, D M x N, all row major in DRAM
+# output_stationary: C tiles stay in the GemmCache for the whole k loop
+# weight_stationary: B tiles stay in the GemmCache and are used by every row block of A, partial C tiles go back to DRAM
+# input_stationary: A tiles stay in the GemmCache and are used by every column block of B, partial C tiles go back to DRAM
+DATAFLOWS = ("output_stationary", "weight_stationary", "input_stationary")
+
+# registers used by the generated code, r1 = C slot or destination, r2 = A slot or source, r3 = B slot
+DEST_REGISTER = 1
+SRC_REGISTER = 2
+SRC2_REGISTER = 3
+
+class GemmCodegen:
+    # emits a tiled GEMM Program for a GemmCache with num_matrices slots of matrix_dim x matrix_dim elements
+    # slots not needed by the dataflow hold extra stationary tiles so each streamed tile is used as often as possible
+    # ragged edges use partial move_tile transfers, the padding of A tiles on a ragged k edge is cleared from
+    # zero_addr, a DRAM region of at least one zeroed slot; garbage in the other padding never reaches a stored element
+    # output_tiles restricts the GEMM to a list of (tile row, tile col) C tiles, e.g. the share of one core
+    def __init__(self, M: int, N: int, K: int, matrix_dim: int, num_matrices: int, gemm_cache_addr: int,
+                 addr_A: int, addr_B: int, addr_C: int, addr_D: int = None, bytes_per_element: int = 1,
+                 dataflow: str = "output_stationary", zero_addr: int = None, output_tiles: list[tuple[int, int]] = None) -> None:
+        assert dataflow in DATAFLOWS, f"Unknown dataflow {dataflow}, expected one of {list(DATAFLOWS)}"
+        assert num_matrices >= 3, "Error: GemmCache needs at least 3 matrix slots for A, B and C"
+        assert K % matrix_dim == 0 or zero_addr is not None, "Error: zero_addr is needed when K is not a multiple of matrix_dim"
+        self.M = M
+        self.N = N
+        self.K = K
+        self.dim = matrix_dim
+        self.num_matrices = num_matrices
+        self.gemm_cache_addr = gemm_cache_addr
+        self.addr_A = addr_A
+        self.addr_B = addr_B
+        self.addr_C = addr_C
+        self.addr_D = addr_D
+        self.bytes_per_element = bytes_per_element
+        self.matrix_bytes = matrix_dim * matrix_dim * bytes_per_element
+        self.dataflow = dataflow
+        self.zero_addr = zero_addr
+        self.m_tiles = math.ceil(M / matrix_dim)
+        self.n_tiles = math.ceil(N / matrix_dim)
+        self.k_tiles = math.ceil(K / matrix_dim)
+        self.output_tiles = None if output_tiles is None else set(output_tiles)
+
+    def generate(self, program: Program) -> Program:
+        # appends the GEMM to program, the caller adds the halt
+        self.program = program
+        self.registers = {} # register -> value it currently holds, so repeated addresses aren't moved again
+        self.slot_tiles = {} # slot -> (matrix name, tile row, tile col) it currently holds
+        self.tile_loads = {"A": 0, "B": 0, "C": 0, "D": 0} # tiles moved into the GemmCache per matrix
+        self.tile_stores = 0 # C tiles moved back to DRAM
+        # output stationary only: (instruction index, registers, slot_tiles, C tiles) at the start of each group of
+        # C tiles, enough state to run the instructions of the group on their own (see parallel_gemm.py)
+        self.checkpoints = []
+        if self.dataflow == "output_stationary":
+            self.output_stationary()
+        elif self.dataflow == "weight_stationary":
+            self.weight_stationary()
+        else:
+            self.input_stationary()
+        return program
+
+    def output_stationary(self) -> None:
+        # A panel mode: the whole row panel of A stays resident across the column blocks, 1 B slot and 1 C slot
+        # group mode: 1 A slot, 1 B slot and the rest are C tiles of consecutive column blocks sharing each A tile
+        if self.k_tiles + 2 <= self.num_matrices:
+            a_slots = list(range(self.k_tiles))
+            c_slots = [self.k_tiles]
+        else:
+            a_slots = [0]
+            c_slots = list(range(1, self.num_matrices - 1))
+        b_slot = self.num_matrices - 1
+        for i in range(self.m_tiles):
+            columns = [j for j in range(self.n_tiles) if self.computes(i, j)]
+            for j0 in range(0, len(columns), len(c_slots)):
+                group = list(zip(columns[j0 : j0 + len(c_slots)], c_slots))
+                self.checkpoints.append((len(self.program.instructions), dict(self.registers), dict(self.slot_tiles), [(i, j) for j, _ in group]))
+                for k in range(self.k_tiles):
+                    a_slot = a_slots[k % len(a_slots)]
+                    self.load_tile("A", i, k, a_slot)
+                    for j, c_slot in group:
+                        if k == 0:
+                            self.init_c(i, j, c_slot)
+                        self.load_tile("B", k, j, b_slot)
+                        self.multiply(c_slot, a_slot, b_slot, accumulate=k > 0 or self.addr_D is not None)
+                for j, c_slot in group:
+                    self.store_c(i, j, c_slot)
+
+    def weight_stationary(self) -> None:
+        # B tiles of consecutive column blocks stay resident while every row block of A streams past them
+        b_slots = list(range(self.num_matrices - 2))
+        a_slot = self.num_matrices - 2
+        c_slot = self.num_matrices - 1
+        columns = [j for j in range(self.n_tiles) if any(self.computes(i, j) for i in range(self.m_tiles))]
+        for k in range(self.k_tiles):
+            for j0 in range(0, len(columns), len(b_slots)):
+                group = list(zip(columns[j0 : j0 + len(b_slots)], b_slots))
+                for j, b_slot in group:
+                    self.load_tile("B", k, j, b_slot)
+                for i in range(self.m_tiles):
+                    tiles = [(j, b_slot) for j, b_slot in group if self.computes(i, j)]
+                    if tiles:
+                        self.load_tile("A", i, k, a_slot)
+                    for j, b_slot in tiles:
+                        self.accumulate_partial(i, j, k, c_slot, a_slot, b_slot)
+
+    def input_stationary(self) -> None:
+        # A tiles of consecutive row blocks stay resident while every column block of B streams past them
+        a_slots = list(range(self.num_matrices - 2))
+        b_slot = self.num_matrices - 2
+        c_slot = self.num_matrices - 1
+        rows = [i for i in range(self.m_tiles) if any(self.computes(i, j) for j in range(self.n_tiles))]
+        for k in range(self.k_tiles):
+            for i0 in range(0, len(rows), len(a_slots)):
+                group = list(zip(rows[i0 : i0 + len(a_slots)], a_slots))
+                for i, a_slot in group:
+                    self.load_tile("A", i, k, a_slot)
+                for j in range(self.n_tiles):
+                    tiles = [(i, a_slot) for i, a_slot in group if self.computes(i, j)]
+                    if tiles:
+                        self.load_tile("B", k, j, b_slot)
+                    for i, a_slot in tiles:
+                        self.accumulate_partial(i, j, k, c_slot, a_slot, b_slot)
+
+    def computes(self, i: int, j: int) -> bool:
+        return self.output_tiles is None or (i, j) in self.output_tiles
+
+    def accumulate_partial(self, i: int, j: int, k: int, c_slot: int, a_slot: int, b_slot: int) -> None:
+        # C tile (i, j) is brought back from DRAM for every k after the first
+        if k == 0:
+            self.init_c(i, j, c_slot)
+        else:
+            self.load_tile("C", i, j, c_slot)
+        self.multiply(c_slot, a_slot, b_slot, accumulate=k > 0 or self.addr_D is not None)
+        self.store_c(i, j, c_slot)
+
+    def init_c(self, i: int, j: int, c_slot: int) -> None:
+        # C starts as D, without D the first multiply overwrites the slot
+        if self.addr_D is not None:
+            self.load_tile("D", i, j, c_slot)
+
+    def multiply(self, c_slot: int, a_slot: int, b_slot: int, accumulate: bool) -> None:
+        self.set_register(DEST_REGISTER, self.slot_addr(c_slot))
+        self.set_register(SRC_REGISTER, self.slot_addr(a_slot))
+        self.set_register(SRC2_REGISTER, self.slot_addr(b_slot))
+        if accumulate:
+            self.program.matrix_multiply_batch(DEST_REGISTER, SRC_REGISTER, SRC2_REGISTER, 1, 0, 0, 0, True)
+        else:
+            self.program.matrix_multiply(DEST_REGISTER, SRC_REGISTER, SRC2_REGISTER)
+        self.slot_tiles[c_slot] = None
+
+    def load_tile(self, name: str, row: int, col: int, slot: int) -> None:
+        # move tile (row, col) of a matrix into slot, skipped when the slot already holds it
+        if self.slot_tiles.get(slot) == (name, row, col):
+            return
+        addr, rows, cols = self.tile_extent(name, row, col)
+        if name == "A" and cols < self.dim:
+            # padding columns of A must be 0 so the padding rows of B don't contribute
+            self.move_tile(self.zero_addr, self.slot_addr(slot), self.dim, self.dim, self.dim, self.dim)
+        row_elements = self.K if name == "A" else self.N
+        self.move_tile(addr, self.slot_addr(slot), rows, cols, row_elements, self.dim)
+        self.slot_tiles[slot] = (name, row, col)
+        self.tile_loads[name] += 1
+
+    def store_c(self, i: int, j: int, c_slot: int) -> None:
+        addr, rows, cols = self.tile_extent("C", i, j)
+        self.move_tile(self.slot_addr(c_slot), addr, rows, cols, self.dim, self.N)
+        self.slot_tiles[c_slot] = ("C", i, j)
+        self.tile_stores += 1
+
+    def tile_extent(self, name: str, row: int, col: int) -> tuple[int, int, int]:
+        # DRAM address, rows and columns (in elements) of a tile, edge tiles are smaller than matrix_dim
+        rows_total, cols_total, base = {
+            "A": (self.M, self.K, self.addr_A),
+            "B": (self.K, self.N, self.addr_B),
+            "C": (self.M, self.N, self.addr_C),
+            "D": (self.M, self.N, self.addr_D)
+        }[name]
+        rows = min(self.dim, rows_total - row * self.dim)
+        cols = min(self.dim, cols_total - col * self.dim)
+        return base + (row * self.dim * cols_total + col * self.dim) * self.bytes_per_element, rows, cols
+
+    def move_tile(self, src_addr: int, dest_addr: int, rows: int, cols: int, src_row_elements: int, dest_row_elements: int) -> None:
+        bpe = self.bytes_per_element
+        self.set_register(SRC_REGISTER, src_addr)
+        self.set_register(DEST_REGISTER, dest_addr)
+        self.program.move_tile(SRC_REGISTER, DEST_REGISTER, rows, cols * bpe, src_row_elements * bpe, dest_row_elements * bpe)
+
+    def set_register(self, register: int, value: int) -> None:
+        if self.registers.get(register) != value:
+            self.program.move(register, value)
+            self.registers[register] = value
+
+    def slot_addr(self, slot: int) -> int:
+        return self.gemm_cache_addr + slot * self.matrix_bytes
+
+def generate_gemm(program: Program, M: int, N: int, K: int, matrix_dim: int, num_matrices: int, gemm_cache_addr: int,
+                  addr_A: int, addr_B: int, addr_C: int, addr_D: int = None, bytes_per_element: int = 1,
+                  dataflow: str = "output_stationary", zero_addr: int = None, output_tiles: list[tuple[int, int]] = None) -> GemmCodegen:
+    # appends the GEMM to program and returns the generator, whose tile_loads and tile_stores count the traffic
+    codegen = GemmCodegen(M, N, K, matrix_dim, num_matrices, gemm_cache_addr, addr_A, addr_B, addr_C, addr_D,
+                          bytes_per_element, dataflow, zero_addr, output_tiles)
+    codegen.generate(program)
+    return codegen
+
+def gemm_program(M: int, N: int, K: int, matrix_dim: int, num_matrices: int, gemm_cache_addr: int,
+                 addr_A: int, addr_B: int, addr_C: int, addr_D: int = None, bytes_per_element: int = 1,
+                 dataflow: str = "output_stationary", zero_addr: int = None, output_tiles: list[tuple[int, int]] = None,
+                 register_bytes: int = 4) -> Program:
+    # whole program ending in halt, usable as a generator for encoded_program.cached_program
+    program = Program(register_bytes)
+    generate_gemm(program, M, N, K, matrix_dim, num_matrices, gemm_cache_addr, addr_A, addr_B, addr_C, addr_D,
+                  bytes_per_element, dataflow, zero_addr, output_tiles)
+    program.halt()
+    return program
+
+if __name__ == "__main__":
+    import numpy as np
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    from gemm_cache import GemmCache, GemmCacheLatencies
+    print("GemmCodegen Test Begin")
+
+    def run_gemm(M, N, K, matrix_dim, num_matrices, dataflow, bytes_per_element=1, with_D=True):
+        dtype = np.dtype(f">u{bytes_per_element}")
+        rng = np.random.default_rng(M * 10000 + N * 100 + K)
+        mat_A = rng.integers(0, 4, size=(M, K)).astype(dtype)
+        mat_B = rng.integers(0, 4, size=(K, N)).astype(dtype)
+        mat_D = rng.integers(0, 4, size=(M, N)).astype(dtype) if with_D else np.zeros((M, N), dtype=dtype)
+        expected = (mat_A.astype(np.uint64) @ mat_B.astype(np.uint64) + mat_D).astype(dtype)
+
+        addr_A = 0
+        addr_B = addr_A + mat_A.nbytes
+        addr_C = addr_B + mat_B.nbytes
+        addr_D = addr_C + mat_D.nbytes
+        zero_addr = addr_D + mat_D.nbytes
+        dram_size = zero_addr + matrix_dim * matrix_dim * bytes_per_element
+        dram = Dram(dram_size, 0, 100, 10)
+        for addr, mat in ((addr_A, mat_A), (addr_B, mat_B), (addr_D, mat_D)):
+            dram.memory.view[addr : addr + mat.nbytes] = mat.tobytes()
+        gemm_cache = GemmCache(matrix_dim, num_matrices, dram_size, GemmCacheLatencies(matrix_dim), bytes_per_element)
+        cpu = Cpu([dram, gemm_cache], 8, 4, 1, CpuLatencies())
+
+        program = Program(4)
+        codegen = generate_gemm(program, M, N, K, matrix_dim, num_matrices, dram_size, addr_A, addr_B, addr_C,
+                                addr_D if with_D else None, bytes_per_element, dataflow, zero_addr)
+        program.halt()
+        cpu.run_program(program)
+        result = np.frombuffer(bytes(dram.memory.view[addr_C : addr_C + mat_D.nbytes]), dtype=dtype).reshape(M, N)
+        assert np.array_equal(result, expected), f"{dataflow} {M}x{N}x{K} is not correct"
+        return codegen, cpu.time
+
+    # every dataflow is correct on ragged shapes, with and without D, for 1 and 2 byte elements
+    for dataflow in DATAFLOWS:
+        run_gemm(7, 9, 11, 4, 4, dataflow)
+        run_gemm(7, 9, 11, 4, 3, dataflow, with_D=False)
+        run_gemm(5, 6, 4, 4, 5, dataflow, bytes_per_element=2)
+
+    # with room for the A panel, A is loaded once per row block instead of once per column block
+    codegen, panel_time = run_gemm(8, 8, 8, 4, 4, "output_stationary")
+    assert codegen.tile_loads == {"A": 4, "B": 8, "C": 0, "D": 4} and codegen.tile_stores == 4
+    codegen, single_time = run_gemm(8, 8, 8, 4, 3, "output_stationary")
+    assert codegen.tile_loads == {"A": 8, "B": 8, "C": 0, "D": 4}
+    assert panel_time < single_time
+
+    # weight stationary loads every B tile exactly once and spills partial C tiles
+    codegen, _ = run_gemm(8, 8, 8, 4, 4, "weight_stationary")
+    assert codegen.tile_loads == {"A": 4, "B": 4, "C": 4, "D": 4} and codegen.tile_stores == 8
+
+    # input stationary loads every A tile exactly once
+    codegen, _ = run_gemm(8, 8, 8, 4, 4, "input_stationary")
+    assert codegen.tile_loads == {"A": 4, "B": 4, "C": 4, "D": 4} and codegen.tile_stores == 8
+
+    # output_tiles limits the program to a share of C, here the second row block
+    for dataflow in DATAFLOWS:
+        codegen = GemmCodegen(8, 8, 8, 4, 4, 256, 0, 64, 128, 192, dataflow=dataflow, output_tiles=[(1, 0), (1, 1)])
+        codegen.generate(Program(4))
+        assert codegen.tile_loads["D"] == 2 and codegen.tile_loads["B"] == 4 and codegen.tile_loads["A"] == 2
+    print("GemmCodegen Test Finished")
@@ -0,0 +1,83 @@
+# jit.py
+
+from typing import Callable
+
+# register only instructions that can be translated, as (python expression, latency name)
+# {0}, {1}, {2} are the operands after the destination register
+ALU_INSTRUCTIONS = {
+    "move": ("{0}", "logical_latency"),
+    "add": ("r{0} + r{1}", "add_latency"),
+    "add_immediate": ("r{0} + {1}", "add_latency"),
+    "multiply": ("r{0} * r{1}", "multiply_latency"),
+    "bitwise_or": ("r{0} | r{1}", "logical_latency"),
+    "bitwise_and": ("r{0} & r{1}", "logical_latency"),
+    "bitwise_xor": ("r{0} ^ r{1}", "logical_latency"),
+    "bitwise_nor": ("~(r{0} | r{1})", "logical_latency"),
+    "bitwise_not": ("~r{0}", "logical_latency"),
+    "logical_shift_left": ("r{0} << {1}", "logical_latency"),
+    "logical_shift_right": ("r{0} >> {1}", "logical_latency"),
+}
+
+# operand positions (after the opcode) that name source registers
+SOURCE_REGISTERS = {
+    "move": [],
+    "add": [1, 2],
+    "add_immediate": [1],
+    "multiply": [1, 2],
+    "bitwise_or": [1, 2],
+    "bitwise_and": [1, 2],
+    "bitwise_xor": [1, 2],
+    "bitwise_nor": [1, 2],
+    "bitwise_not": [1],
+    "logical_shift_left": [1],
+    "logical_shift_right": [1],
+}
+
+def translate_block(instructions: list[tuple], start_pc: int, register_mask: int, latencies: dict[str, int]) -> Callable:
+    # compile the straight line run of register instructions starting at start_pc into one function
+    # the function takes the register list and returns (next pc, cycles), a trailing branch_if or jump ends the block
+    # latencies maps CpuLatencies attribute names to cycles, their sum is precomputed into the block
+    # returns None when the instruction at start_pc can't be translated
+    body = []
+    used_registers = set()
+    written_registers = set()
+    cycles = 0
+    pc = start_pc
+    while pc < len(instructions) and instructions[pc][0] in ALU_INSTRUCTIONS:
+        name, dest, *operands = instructions[pc]
+        expression, latency_name = ALU_INSTRUCTIONS[name]
+        used_registers.update(instructions[pc][i + 1] for i in SOURCE_REGISTERS[name])
+        body.append(f"    r{dest} = ({expression.format(*operands)}) & {register_mask}")
+        used_registers.add(dest)
+        written_registers.add(dest)
+        cycles += latencies[latency_name]
+        pc += 1
+
+    exit_name = instructions[pc][0] if pc < len(instructions) else None
+    if exit_name in ("branch_if", "jump"):
+        used_registers.add(instructions[pc][1])
+    elif pc == start_pc:
+        return None
+
+    # registers live in locals inside the block and are written back once before returning
+    lines = ["def block(r):"]
+    lines += [f"    r{reg} = r[{reg}]" for reg in sorted(used_registers)]
+    lines += body
+    lines += [f"    r[{reg}] = r{reg}" for reg in sorted(written_registers)]
+    if exit_name == "branch_if":
+        _, cond_register, immediate = instructions[pc]
+        cycles += latencies["branch_latency"]
+        lines.append(f"    if r{cond_register} != 0:")
+        lines.append(f"        return {pc + immediate}, {cycles}")
+        lines.append(f"    return {pc + 1}, {cycles}")
+    elif exit_name == "jump":
+        cycles += latencies["jump_latency"]
+        lines.append(f"    return r{instructions[pc][1]}, {cycles}")
+    else:
+        lines.append(f"    return {pc}, {cycles}")
+
+    namespace = {}
+    exec(compile("\n".join(lines), f"<block {start_pc}>", "exec"), namespace)
+    block = namespace["block"]
+    block.num_instructions = pc - start_pc + (exit_name in ("branch_if", "jump")) # for Cpu.instructions_executed
+    return block
@@ -1,17 +1,22 @@
 # large_matrix.py
 
 from cpu import Cpu, CpuLatencies
-from dram import Dram
+from dram import Dram, DramTiming
 from gemm_cache import GemmCache, GemmCacheLatencies
 from program import Program
+from gemm_codegen import generate_gemm, gemm_program
+from encoded_program import cached_program
 import numpy as np
 
 MATRIX_DIM = 25
 TILE_DIM = 5
+DATAFLOW = "output_stationary" # or "weight_stationary" / "input_stationary", see gemm_codegen.py
+PROGRAM_CACHE_DIR = None # e.g. ".program_cache" to reuse the generated program across runs
+DRAM_TIMING = False # True models banks and row buffers instead of a fixed latency per burst
+PARALLEL_WORKERS = None # e.g. 8 (0 for this process) to simulate groups of output tiles in parallel, output_stationary only
 
-assert MATRIX_DIM % TILE_DIM == 0
-dram_size = MATRIX_DIM * MATRIX_DIM * 5
-dram = Dram(dram_size, 0, 100, 10)
+dram_size = MATRIX_DIM * MATRIX_DIM * 4 + TILE_DIM * TILE_DIM
+dram = Dram(dram_size, 0, 100, 10, timing=DramTiming() if DRAM_TIMING else None)
 gemm_cache_latencies = GemmCacheLatencies(matrix_dim=TILE_DIM)
 gemm_cache = GemmCache(matrix_dim=TILE_DIM, num_matrices=4, addr_start=dram_size, gemm_cache_latencies=gemm_cache_latencies)
 cpu_latencies = CpuLatencies()
@@ -19,9 +24,9 @@ REGISTER_BYTES = 4
 cpu = Cpu([dram, gemm_cache], 32, REGISTER_BYTES, 1, cpu_latencies)
 
 # Generate matrix values
-mat_A = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.int8)
-mat_B = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.int8)
-mat_D = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.int8)
+mat_A = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.uint8) # uint8 wraps like the 1 byte GemmCache elements
+mat_B = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.uint8)
+mat_D = np.random.randint(0, 2, size=(MATRIX_DIM, MATRIX_DIM), dtype=np.uint8)
 mat_C = np.add(np.matmul(mat_A, mat_B), mat_D)
 
 rows_A, cols_A = mat_A.shape
@@ -38,12 +43,7 @@ addr_A = 0
 addr_B = addr_A + MATRIX_DIM * MATRIX_DIM # Each element is 1 byte
 addr_C = addr_B + MATRIX_DIM * MATRIX_DIM
 addr_D = addr_C + MATRIX_DIM * MATRIX_DIM
-
-# GemmCache addresses
-cache_addr_A = dram_size
-cache_addr_B = cache_addr_A + TILE_DIM * TILE_DIM
-cache_addr_C = cache_addr_B + TILE_DIM * TILE_DIM
-cache_addr_D = cache_addr_C + TILE_DIM * TILE_DIM
+addr_zero = addr_D + MATRIX_DIM * MATRIX_DIM # never written, pads ragged tiles when MATRIX_DIM % TILE_DIM != 0
 
 # Store matrices in DRAM
 for i in range(rows_A):
@@ -58,69 +58,39 @@ for i in range(rows_D):
     for j in range(cols_D):
         dram.set_value(addr_D + (i * cols_D + j), 1, matrix_D[i][j])
 
-# Create the program for matrix multiplication
-program = Program(REGISTER_BYTES)
-
-def move_from_dram_to_cache(program, dram_matrix, cache_matrix, size):
-    program.add_immediate(1, 0, dram_matrix)   # r1 = addr_A (DRAM address for A)
-    program.add_immediate(2, 0, cache_matrix)  # r2 = cache_addr_A (GemmCache address for A)
-    program.add_immediate(3, 0, size)     # r3 = size of A
-    program.move_memory(1, 2, 3)               # Move A from DRAM to GemmCache
-
-def move_from_cache_to_dram(program, dram_matrix, cache_matrix, size):
-    program.add_immediate(1, 0, cache_matrix)  # r1 = cache_addr_C (GemmCache address for C)
-    program.add_immediate(2, 0, dram_matrix)   # r2 = addr_C (DRAM address for C)
-    program.add_immediate(3, 0, size)     # r3 = size of C
-    program.move_memory(1, 2, 3)               # Move C from GemmCache to DRAM
-
-for row in range(0, MATRIX_DIM, TILE_DIM):
-    for col in range(0, MATRIX_DIM, TILE_DIM):
-        tile_height = TILE_DIM
-        tile_width = TILE_DIM
-
-        # Initialize C tile with D tile
-        # D tile DRAM base:
-        d_tile_dram_base = addr_D + row * MATRIX_DIM + col
-        for r in range(tile_height):
-            row_start = d_tile_dram_base + r * MATRIX_DIM
-            move_from_dram_to_cache(program, row_start, cache_addr_C + r*TILE_DIM, TILE_DIM)
-
-        # Now accumulate A*B into C
-        for k in range(0, MATRIX_DIM, TILE_DIM):
-
-            # If the k-tile doesn't fully cover TILE_DIM, we still place it in the cache padded with zeros
-            # Move A tile: from A[row : row+tile_height, k : k+a_tile_width]
-            a_tile_dram_base = addr_A + row * MATRIX_DIM + k
-            for r in range(tile_height):
-                row_start = a_tile_dram_base + r * MATRIX_DIM
-                move_from_dram_to_cache(program, row_start, cache_addr_A  + r*TILE_DIM, TILE_DIM)
-
-            # Move B tile: from B[k : k+b_tile_height, col : col+tile_width]
-            b_tile_dram_base = addr_B + k * MATRIX_DIM + col
-            for r in range(tile_height):
-                row_start = b_tile_dram_base + r * MATRIX_DIM
-                move_from_dram_to_cache(program, row_start, cache_addr_B  + r*TILE_DIM, TILE_DIM)
-
-            # Perform D = A*B
-            program.add_immediate(1, 0, cache_addr_D)  # r1 = D address in GemmCache
-            program.add_immediate(2, 0, cache_addr_A)  # r2 = A address in GemmCache
-            program.add_immediate(3, 0, cache_addr_B)  # r3 = B address in GemmCache
-            program.matrix_multiply(1, 2, 3)
-
-            # Perform the matrix add in GemmCache
-            program.add_immediate(1, 0, cache_addr_C)  # r1 = cache_addr_C (GemmCache address for C)
-            program.add_immediate(2, 0, cache_addr_D)  # r2 = cache_addr_D (GemmCache address for D)
-            program.matrix_add(1, 2, 1)                # Add C and D, store result in C
-
-        # After finishing accumulation over k, move C tile back to DRAM
-        c_tile_dram_base = addr_C + row * MATRIX_DIM + col
-        for r in range(TILE_DIM):
-            row_start = c_tile_dram_base + r * MATRIX_DIM
-            move_from_cache_to_dram(program, row_start, cache_addr_C  + r*TILE_DIM, TILE_DIM)
-        
-program.halt()
-
-cpu.run_program(program)
+# Create the program for matrix multiplication, C = A*B + D tiled for the GemmCache
+if PARALLEL_WORKERS is not None:
+    # same program and cycles as the serial run, simulated by parallel_gemm.py in worker processes
+    from parallel_gemm import parallel_gemm, gemm_layout
+    assert DATAFLOW == "output_stationary" and not DRAM_TIMING, "Error: parallel simulation needs output_stationary without DRAM timing"
+    layout = {"addr_A": addr_A, "addr_B": addr_B, "addr_C": addr_C, "addr_D": addr_D, "zero_addr": addr_zero, "dram_size": dram_size}
+    assert layout == gemm_layout(MATRIX_DIM, MATRIX_DIM, MATRIX_DIM, TILE_DIM), "Error: DRAM layout differs from the one parallel_gemm builds"
+    codegen = None
+    program = None
+    result, stats = parallel_gemm(mat_A, mat_B, mat_D, TILE_DIM, gemm_cache.num_matrices, PARALLEL_WORKERS,
+                                  dram_read_latency=dram.read_latency, dram_write_latency=dram.write_latency, burst_size=dram.burst_size,
+                                  gemm_cache_latencies=gemm_cache_latencies, cpu_latencies=cpu_latencies,
+                                  num_registers=len(cpu.registers), register_bytes=cpu.register_bytes)
+    dram.memory.store_tile(addr_C, MATRIX_DIM, result)
+    print(f"Halted at cycle {stats['cycles']}, {len(stats['jobs'])} jobs")
+elif PROGRAM_CACHE_DIR is None:
+    program = Program(REGISTER_BYTES)
+    codegen = generate_gemm(program, MATRIX_DIM, MATRIX_DIM, MATRIX_DIM, TILE_DIM, gemm_cache.num_matrices, dram_size,
+                            addr_A, addr_B, addr_C, addr_D, dataflow=DATAFLOW, zero_addr=addr_zero)
+    program.halt()
+else:
+    # generated and assembled once, later runs with the same parameters load the encoded program
+    codegen = None
+    program = cached_program(gemm_program, PROGRAM_CACHE_DIR, M=MATRIX_DIM, N=MATRIX_DIM, K=MATRIX_DIM, matrix_dim=TILE_DIM,
+                             num_matrices=gemm_cache.num_matrices, gemm_cache_addr=dram_size, addr_A=addr_A, addr_B=addr_B,
+                             addr_C=addr_C, addr_D=addr_D, dataflow=DATAFLOW, zero_addr=addr_zero, register_bytes=REGISTER_BYTES)
+
+if program is not None:
+    cpu.run_program(program)
+if codegen is not None:
+    print(f"Tiles loaded: {codegen.tile_loads}, tiles stored: {codegen.tile_stores}")
+if dram.timing is not None:
+    print(f"DRAM timing: {dram.timing.get_stats()}")
 
 print("Resultant Matrix C:")
 
@@ -5,6 +5,7 @@ from dram import Dram
 from gemm_cache import GemmCache, GemmCacheLatencies
 from program import Program
 import numpy as np
+import json
 
 MATRIX_DIM = 4 # input matrices are size MATRIX_DIM by MATRIX_DIM
 TILE_DIM = 4 # GemmCache matrices are size TILE_DIM by TILE_DIM
@@ -122,6 +123,7 @@ program.move_memory(1, 2, 3)               # Move C from GemmCache to DRAM
 program.halt()
 
 cpu.run_program(program)
+print(json.dumps(cpu.collect_stats(), indent=2))
 
 print("Resultant Matrix C:")
 
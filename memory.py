@@ -1,16 +1,64 @@
 # memory.py
 
-from packet import Packet
+from packet import Packet, TilePacket
+import numpy as np
 
 class MemObject:
-    def __init__(self, size: int, addr_range: int, read_latency: int, write_latency: int):
+    def __init__(self, size: int, addr_range: int, read_latency: int, write_latency: int, addr_start: int = None):
         self.size = size
         self.addr_range = addr_range # Size of address space held by MemObject; addr_range == size except for normal caches
+        self.addr_start = addr_start # First cpu address of the MemObject; None places it right after the previous memory
         self.read_latency = read_latency
         self.write_latency = write_latency
-    
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        # counters updated by the subclasses as they serve packets, cleared between phases of a run
+        self.reads = 0 # load packets served, a tile counts once unless it is split into rows
+        self.writes = 0 # store packets served
+        self.bytes_read = 0 # bytes sent out by loads
+        self.bytes_written = 0 # bytes received by stores
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 # valid blocks replaced, clean or dirty
+        self.writebacks = 0 # dirty blocks written to the next level, by evictions or flushes
+        self.matmuls = 0
+        self.matadds = 0
+        self.busy_cycles = 0 # latency added to the packets served, next levels included
+
+    def get_stats(self) -> dict:
+        accesses = self.hits + self.misses
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / accesses if accesses > 0 else 0.0,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks,
+            "matmuls": self.matmuls,
+            "matadds": self.matadds,
+            "busy_cycles": self.busy_cycles
+        }
+
     def process_packet(self, pkt: Packet) -> Packet:
         pass
 
+    def process_tile_packet(self, pkt: TilePacket) -> TilePacket:
+        # generic strided 2D access, one process_packet per row
+        # memories that can coalesce rows or copy the tile in one operation override this
+        if pkt.load:
+            pkt.data = np.zeros((pkt.rows, pkt.cols), dtype=np.uint8)
+        for r in range(pkt.rows):
+            if pkt.load:
+                row_pkt = self.process_packet(Packet(True, pkt.addr + r * pkt.stride, pkt.cols, None, pkt.latency))
+                pkt.data[r] = np.frombuffer(row_pkt.data.to_bytes(pkt.cols, "big"), dtype=np.uint8)
+            else:
+                row_pkt = self.process_packet(Packet(False, pkt.addr + r * pkt.stride, pkt.cols, int.from_bytes(pkt.data[r].tobytes(), "big"), pkt.latency))
+            pkt.latency = row_pkt.latency
+        return pkt
+
     def print(self, starting_addr: int) -> None:
         pass
\ No newline at end of file
@@ -1,5 +1,8 @@
 # memory_array.py
 
+from multiprocessing import shared_memory
+import numpy as np
+
 class MemoryArray:
     # Acts like a contiguous array of bytes and allows [] operator to be used
     # Big endian
@@ -39,10 +42,199 @@ class MemoryArray:
         for i in range(size):
             del self.array[addr + i]
 
+    def load_tile(self, addr: int, rows: int, cols: int, stride: int) -> np.ndarray:
+        # rows x cols bytes, row r starts at addr + r*stride, returned as a new np.uint8 array
+        tile = np.zeros((rows, cols), dtype=np.uint8)
+        for r in range(rows):
+            tile[r] = np.frombuffer(self.load(addr + r * stride, cols).to_bytes(cols, "big"), dtype=np.uint8)
+        return tile
+
+    def store_tile(self, addr: int, stride: int, tile: np.ndarray) -> None:
+        cols = tile.shape[1]
+        for r in range(tile.shape[0]):
+            self.store(addr + r * stride, cols, int.from_bytes(tile[r].tobytes(), "big"))
+
     def print(self, starting_addr: int) -> None:
         for addr in sorted(self.array.keys()):
             print(f"Address {starting_addr+addr:08X}: {self.array[addr]:02X}")
 
+class DenseMemoryArray(MemoryArray):
+    # Same interface as MemoryArray but backed by a preallocated contiguous buffer
+    # Addresses must lie in [0, size), unwritten bytes read as 0 and delete zeroes the bytes
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer) # all accesses go through the memoryview so any writable buffer works
+
+    def load(self, addr: int, size: int) -> int:
+        assert addr >= 0 and addr + size <= self.size
+        return int.from_bytes(self.view[addr : addr + size], "big")
+
+    def store(self, addr: int, size: int, data: int) -> None:
+        assert addr >= 0 and addr + size <= self.size
+        # masking keeps the lowest size bytes, same truncation as the byte loop in MemoryArray.store
+        self.view[addr : addr + size] = (data & ((1 << (size * 8)) - 1)).to_bytes(size, "big")
+
+    def delete(self, addr: int, size: int) -> None:
+        assert addr >= 0 and addr + size <= self.size
+        self.view[addr : addr + size] = bytes(size)
+
+    def tile_view(self, addr: int, rows: int, cols: int, stride: int) -> np.ndarray:
+        # writable strided np.uint8 view of a rows x cols tile whose row r starts at addr + r*stride
+        assert rows > 0 and cols > 0 and stride >= cols, "Error: tile rows must not overlap"
+        assert addr >= 0 and addr + (rows - 1) * stride + cols <= self.size
+        flat = np.frombuffer(self.view, dtype=np.uint8)
+        return np.lib.stride_tricks.as_strided(flat[addr:], shape=(rows, cols), strides=(stride, 1))
+
+    def load_tile(self, addr: int, rows: int, cols: int, stride: int) -> np.ndarray:
+        return self.tile_view(addr, rows, cols, stride).copy()
+
+    def store_tile(self, addr: int, stride: int, tile: np.ndarray) -> None:
+        self.tile_view(addr, tile.shape[0], tile.shape[1], stride)[...] = tile
+
+    def save_image(self, path: str) -> None:
+        # write the whole array to a raw image file in one bulk operation
+        with open(path, "wb") as f:
+            f.write(self.view)
+
+    def restore_image(self, path: str) -> None:
+        # overwrite the whole array with a raw image file written by save_image
+        with open(path, "rb") as f:
+            assert f.readinto(self.view) == self.size, "Error: image size does not match memory size"
+
+    def print(self, starting_addr: int) -> None:
+        # unwritten and zeroed bytes are indistinguishable so only nonzero bytes are printed
+        for addr, byte in enumerate(self.view):
+            if byte != 0:
+                print(f"Address {starting_addr+addr:08X}: {byte:02X}")
+
+class MemmapMemoryArray(DenseMemoryArray):
+    # DenseMemoryArray whose buffer is an np.memmap of a raw image file
+    # Pages of the image are only brought into host memory when touched, so images can be larger than host RAM
+    def __init__(self, size: int, path: str, create: bool = False) -> None:
+        self.size = size
+        self.path = path
+        # create (or truncate) the image when asked, otherwise open an existing image for read and write
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="w+" if create else "r+", shape=(size,))
+        self.view = memoryview(self.buffer)
+
+    def flush(self) -> None:
+        self.buffer.flush()
+
+    def save_image(self, path: str) -> None:
+        self.flush()
+        super().save_image(path)
+
+class SharedMemoryArray(DenseMemoryArray):
+    # DenseMemoryArray whose buffer is a multiprocessing.shared_memory block, so several processes can simulate
+    # on the same bytes; name=None creates a zeroed block, otherwise the block with that name is attached
+    # the creator unlinks the block once every process has closed it
+    def __init__(self, size: int, name: str = None) -> None:
+        self.size = size
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1) if name is None else 0)
+        assert self.shm.size >= size, "Error: shared memory block is smaller than the memory size"
+        self.name = self.shm.name
+        self.buffer = self.shm.buf
+        self.view = self.shm.buf[:size]
+
+    def close(self) -> None:
+        # NumPy views of the buffer (e.g. from tile_view) must be gone before closing
+        self.view.release()
+        self.buffer = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
+
+class PagedMemoryArray(MemoryArray):
+    # Same interface as MemoryArray for a large address space that is mostly untouched
+    # Fixed size NumPy pages are allocated on first write, untouched pages read as 0
+    def __init__(self, size: int, page_size: int = 4096) -> None:
+        assert page_size > 0 and (page_size & (page_size - 1)) == 0, "Page size must be a power of 2"
+        self.size = size
+        self.page_size = page_size
+        self.page_bits = page_size.bit_length() - 1
+        self.pages = {} # page number -> np.uint8 array of page_size bytes
+
+    def resident_bytes(self) -> int:
+        # bytes actually allocated on the host
+        return len(self.pages) * self.page_size
+
+    def mapped_bytes(self) -> int:
+        # bytes of simulated address space
+        return self.size
+
+    def page_chunks(self, addr: int, size: int):
+        # split an access into (page number, offset in page, offset in access, length) pieces
+        assert addr >= 0 and addr + size <= self.size
+        done = 0
+        while done < size:
+            page_num = (addr + done) >> self.page_bits
+            offset = (addr + done) & (self.page_size - 1)
+            length = min(size - done, self.page_size - offset)
+            yield page_num, offset, done, length
+            done += length
+
+    def load(self, addr: int, size: int) -> int:
+        offset = addr & (self.page_size - 1)
+        if offset + size <= self.page_size and addr >= 0 and addr + size <= self.size:
+            # fast path, access is inside a single page
+            page = self.pages.get(addr >> self.page_bits)
+            if page is None:
+                return 0
+            return int.from_bytes(page.data[offset : offset + size], "big")
+        data = bytearray(size)
+        for page_num, offset, start, length in self.page_chunks(addr, size):
+            page = self.pages.get(page_num)
+            if page is not None:
+                data[start : start + length] = page.data[offset : offset + length]
+        return int.from_bytes(data, "big")
+
+    def store(self, addr: int, size: int, data: int) -> None:
+        data = (data & ((1 << (size * 8)) - 1)).to_bytes(size, "big")
+        for page_num, offset, start, length in self.page_chunks(addr, size):
+            page = self.pages.get(page_num)
+            if page is None:
+                page = np.zeros(self.page_size, dtype=np.uint8)
+                self.pages[page_num] = page
+            page.data[offset : offset + length] = data[start : start + length]
+
+    def delete(self, addr: int, size: int) -> None:
+        for page_num, offset, start, length in self.page_chunks(addr, size):
+            page = self.pages.get(page_num)
+            if page is not None:
+                page[offset : offset + length] = 0
+
+    def save_image(self, path: str) -> None:
+        # untouched pages are left as holes so the image file is sparse where the filesystem supports it
+        with open(path, "wb") as f:
+            f.truncate(self.size)
+            for page_num in sorted(self.pages.keys()):
+                f.seek(page_num << self.page_bits)
+                f.write(self.pages[page_num][: self.size - (page_num << self.page_bits)])
+
+    def restore_image(self, path: str, chunk_pages: int = 256) -> None:
+        # read the image in multi-page chunks, all zero pages are not allocated
+        self.pages = {}
+        chunk = np.zeros(chunk_pages * self.page_size, dtype=np.uint8)
+        with open(path, "rb") as f:
+            for chunk_addr in range(0, self.size, len(chunk)):
+                num_bytes = f.readinto(chunk.data[: min(len(chunk), self.size - chunk_addr)])
+                assert num_bytes == min(len(chunk), self.size - chunk_addr), "Error: image size does not match memory size"
+                for page_addr in range(0, num_bytes, self.page_size):
+                    page = chunk[page_addr : page_addr + self.page_size]
+                    if page.any():
+                        new_page = np.zeros(self.page_size, dtype=np.uint8)
+                        new_page[: len(page)] = page
+                        self.pages[(chunk_addr + page_addr) >> self.page_bits] = new_page
+
+    def print(self, starting_addr: int) -> None:
+        # only resident pages are walked, nonzero bytes are printed like DenseMemoryArray
+        for page_num in sorted(self.pages.keys()):
+            page_addr = page_num << self.page_bits
+            for offset in np.flatnonzero(self.pages[page_num]):
+                print(f"Address {starting_addr+page_addr+int(offset):08X}: {self.pages[page_num][offset]:02X}")
+
 def key_to_addr_size(key) -> tuple[int, int]:
     if isinstance(key, slice):
         addr = key.start
@@ -66,8 +258,8 @@ if __name__ == "__main__":
 
     # Test [] operator, __getitem__ and __setitem__, single indexing and slices
     array[35] = 0xf0
-    array[32:34] = 0xf0f0f0
-    assert array[34:35] == 0xf0f0
+    array[32:35] = 0xf0f0f0
+    assert array[34:36] == 0xf0f0
     assert array[32] == 0xf0
     array[32] = 1
     assert array[32] == 1
@@ -91,3 +283,114 @@ if __name__ == "__main__":
     assert array[0:3] == 0 # All values start out as 0
     assert array[32:35] == 0
     print("MemoryArray Test Finished")
+
+    print("DenseMemoryArray Test Begin")
+    array = DenseMemoryArray(40)
+
+    # Test store and load functions
+    array.store(0, 1, 0xff)
+    assert array.load(0, 1) == 0xff
+    array.store(1, 3, 0xffffff)
+    assert array.load(0,4) == 0xffffffff
+
+    # Test big endian layout and truncation to the access size
+    array.store(4, 2, 0x12345)
+    assert array[4] == 0x23
+    assert array[4:6] == 0x2345
+    array.store(6, 1, -1)
+    assert array[6] == 0xff
+
+    # Test [] operator, __getitem__ and __setitem__, single indexing and slices
+    array[35] = 0xf0
+    array[32:35] = 0xf0f0f0
+    assert array[34:36] == 0xf0f0
+    assert array[32] == 0xf0
+    array[32] = 1
+    assert array[32] == 1
+
+    # Test size assertion
+    try:
+        array[40] = 0
+        print("Failed, should have exceeded max size")
+    except AssertionError:
+        pass
+
+    try:
+        array.load(38, 4)
+        print("Failed, should have exceeded max size")
+    except AssertionError:
+        pass
+
+    # Test delete
+    array.delete(32, 4)
+    del array[0:3]
+    assert array[0:3] == 0 # All values start out as 0
+    assert array[32:35] == 0
+    assert array[3] == 0xff
+
+    # Test strided tiles, dense tiles are views and the generic version copies row by row
+    tile = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    array.store_tile(8, 10, tile)
+    assert array[8:11] == 0x000102 and array[18:21] == 0x030405
+    assert (array.load_tile(8, 2, 3, 10) == tile).all()
+    assert (MemoryArray.load_tile(array, 8, 2, 3, 10) == tile).all()
+    array.tile_view(8, 2, 3, 10)[1, 2] = 9
+    assert array[20] == 9
+
+    # Test shared memory, a second attachment by name sees the same bytes
+    shared = SharedMemoryArray(64)
+    attached = SharedMemoryArray(64, shared.name)
+    shared.store_tile(8, 10, tile)
+    assert (attached.load_tile(8, 2, 3, 10) == tile).all() and attached[0:8] == 0
+    attached[0] = 7
+    assert shared[0] == 7
+    attached.close()
+    shared.close()
+    shared.unlink()
+    print("DenseMemoryArray Test Finished")
+
+    print("PagedMemoryArray Test Begin")
+    array = PagedMemoryArray(1 << 32, page_size=16) # 4 GB of address space
+
+    # Test untouched pages read as 0 without being allocated
+    assert array.load(0xFFFF0000, 8) == 0
+    assert array.resident_bytes() == 0
+    assert array.mapped_bytes() == 1 << 32
+
+    # Test store and load inside a page
+    array.store(0x100, 4, 0xdeadbeef)
+    assert array.load(0x100, 4) == 0xdeadbeef
+    assert array[0x101:0x103] == 0xadbe
+    assert array.resident_bytes() == 16
+
+    # Test accesses that straddle pages
+    array.store(0x20E, 4, 0x11223344)
+    assert array.load(0x20E, 4) == 0x11223344
+    assert array[0x20F] == 0x22
+    assert array[0x210] == 0x33
+    assert array.load(0x20C, 8) == 0x0000112233440000
+    assert array.resident_bytes() == 48
+    array.store(0x300, 40, (1 << 320) - 1)
+    assert array.load(0x2FF, 42) == ((1 << 320) - 1) << 8
+    assert array.resident_bytes() == 48 + 48
+
+    # Test reads that straddle into an untouched page
+    assert array.load(0x10E, 4) == 0
+
+    # Test size assertion
+    try:
+        array.store((1 << 32) - 2, 4, 0)
+        print("Failed, should have exceeded max size")
+    except AssertionError:
+        pass
+
+    # Test delete
+    del array[0x20E:0x212]
+    assert array.load(0x20E, 4) == 0
+    del array[0x500:0x504] # deleting untouched bytes does not allocate
+    assert array.resident_bytes() == 48 + 48
+
+    # Test tiles whose rows cross pages
+    array.store_tile(0x40E, 16, tile)
+    assert (array.load_tile(0x40E, 2, 3, 16) == tile).all()
+    print("PagedMemoryArray Test Finished")
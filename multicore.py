@@ -0,0 +1,379 @@
+# multicore.py
+
+from cpu import Cpu, CpuLatencies
+from dram import Dram
+from gemm_cache import Cache, GemmCache, GemmCacheLatencies
+from gemm_codegen import generate_gemm
+from memory import MemObject
+from packet import Packet, TilePacket
+from program import Program
+from encoded_program import EncodedProgram
+import numpy as np
+import heapq
+import math
+
+class DramArbiter:
+    # shares one Dram between cores, each core connects through its own DramPort
+    # the DRAM channel moves bytes_per_cycle bytes per cycle and serves requests in arrival order, a request that
+    # arrives while the channel is busy waits for it and the wait is added to its latency
+    # a request arrives at the time of the instruction that sent it plus the latency its packet already carries
+    def __init__(self, dram: Dram, bytes_per_cycle: int = 16) -> None:
+        assert bytes_per_cycle > 0, "Error: DRAM arbiter bandwidth must be greater than 0"
+        self.dram = dram
+        self.bytes_per_cycle = bytes_per_cycle
+        self.ports = []
+        self.now = 0 # time of the instruction being executed, set by MultiCoreSystem before each step
+        self.reset()
+
+    def reset(self) -> None:
+        self.channel_free = 0 # cycle the channel finishes the last request
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self.busy_cycles = 0 # cycles the channel spent transferring
+        self.queue_cycles = 0 # cycles requests spent waiting for the channel
+
+    def port(self) -> "DramPort":
+        port = DramPort(self, len(self.ports))
+        self.ports.append(port)
+        return port
+
+    def request(self, pkt: Packet | TilePacket, size: int, method) -> Packet | TilePacket:
+        # serve pkt with method (a packet method of the dram), size is the number of bytes moved
+        arrival = self.now + pkt.latency
+        start = max(arrival, self.channel_free)
+        occupancy = math.ceil(size / self.bytes_per_cycle)
+        self.channel_free = start + occupancy
+        pkt = method(pkt)
+        pkt.latency += start - arrival
+        self.requests += 1
+        self.bytes += size
+        self.busy_cycles += occupancy
+        self.queue_cycles += start - arrival
+        return pkt
+
+    def get_stats(self, elapsed: int = None) -> dict:
+        # utilization is the fraction of the elapsed cycles the channel was busy, 1.0 is saturated
+        stats = {
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "busy_cycles": self.busy_cycles,
+            "queue_cycles": self.queue_cycles,
+            "bandwidth": self.bytes / elapsed if elapsed else 0.0, # bytes per cycle
+            "utilization": self.busy_cycles / elapsed if elapsed else 0.0
+        }
+        stats["dram"] = self.dram.get_stats()
+        return stats
+
+class DramPort(MemObject):
+    # one core's view of the shared Dram, it covers the same addresses; its counters are the core's own traffic
+    def __init__(self, arbiter: DramArbiter, core: int) -> None:
+        dram = arbiter.dram
+        super().__init__(dram.size, dram.addr_range, dram.read_latency, dram.write_latency, dram.addr_start)
+        self.arbiter = arbiter
+        self.core = core
+        self.memory = dram.memory
+
+    def process_packet(self, pkt: Packet) -> Packet:
+        before = pkt.latency
+        pkt = self.arbiter.request(pkt, pkt.size, self.arbiter.dram.process_packet)
+        self.count(pkt.load, pkt.size, pkt.latency - before)
+        return pkt
+
+    def process_tile_packet(self, pkt: TilePacket) -> TilePacket:
+        before = pkt.latency
+        pkt = self.arbiter.request(pkt, pkt.rows * pkt.cols, self.arbiter.dram.process_tile_packet)
+        self.count(pkt.load, pkt.rows * pkt.cols, pkt.latency - before)
+        return pkt
+
+    def count(self, load: bool, size: int, cycles: int) -> None:
+        if load:
+            self.reads += 1
+            self.bytes_read += size
+        else:
+            self.writes += 1
+            self.bytes_written += size
+        self.busy_cycles += cycles
+
+    def print(self, starting_addr: int) -> None:
+        self.arbiter.dram.print(starting_addr)
+
+class CoherenceBus:
+    # snooping bus keeping the CoherentCaches attached to it coherent with the MESI protocol
+    # every transaction costs latency cycles plus the write backs of modified copies it forces
+    def __init__(self, latency: int = 1) -> None:
+        self.latency = latency
+        self.caches = []
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.reads = 0 # read misses (BusRd)
+        self.read_exclusives = 0 # write misses (BusRdX)
+        self.upgrades = 0 # writes to shared blocks (BusUpgr)
+        self.invalidations = 0 # copies invalidated in other caches
+        self.interventions = 0 # modified copies written back because another cache asked for the block
+
+    def attach(self, cache: "CoherentCache") -> None:
+        self.caches.append(cache)
+
+    def read(self, requester: "CoherentCache", block_addr: int, exclusive: bool) -> tuple[int, bool]:
+        # miss in requester, returns (cycles, whether another cache holds the block) after snooping the others
+        if exclusive:
+            self.read_exclusives += 1
+        else:
+            self.reads += 1
+        return self.snoop(requester, block_addr, exclusive)
+
+    def upgrade(self, requester: "CoherentCache", block_addr: int) -> int:
+        # write hit on a shared block, the other copies are invalidated; returns the cycles consumed
+        self.upgrades += 1
+        return self.snoop(requester, block_addr, True)[0]
+
+    def snoop(self, requester: "CoherentCache", block_addr: int, exclusive: bool) -> tuple[int, bool]:
+        cycles = self.latency
+        shared = False
+        for cache in self.caches:
+            if cache is not requester:
+                snoop_cycles, had_copy = cache.snoop(block_addr, exclusive)
+                cycles += snoop_cycles
+                shared |= had_copy
+        return cycles, shared
+
+    def get_stats(self) -> dict:
+        return {
+            "reads": self.reads,
+            "read_exclusives": self.read_exclusives,
+            "upgrades": self.upgrades,
+            "invalidations": self.invalidations,
+            "interventions": self.interventions
+        }
+
+class CoherentCache(Cache):
+    # private cache of one core kept coherent with the other caches on bus (MESI)
+    # the state of a block is derived from the Cache arrays: M = valid and dirty, S = valid and shared,
+    # E = valid, clean and not shared, I = not valid
+    # the bus only snoops the caches attached to it, so coherent caches must sit directly in front of the shared
+    # memory (e.g. a DramPort), and DMA or move_memory writes to shared memory are not snooped
+    def __init__(self, size: int, addr_range: int, block_size: int, read_latency: int, write_latency: int, next_level: MemObject, bus: CoherenceBus, associativity: int = 1, replacement_policy: str = "lru", miss_latency: int = 0) -> None:
+        super().__init__(size, addr_range, block_size, read_latency, write_latency, next_level, associativity, replacement_policy, miss_latency=miss_latency)
+        self.shared = np.zeros((self.num_sets, self.num_ways), dtype=bool)
+        self.bus = bus
+        bus.attach(self)
+
+    def state(self, addr: int) -> str:
+        set_idx = (addr >> self.offset_bits) & (self.num_sets - 1)
+        way = self.find_way(set_idx, addr >> (self.offset_bits + self.set_bits))
+        if way < 0:
+            return "I"
+        if self.dirty[set_idx, way]:
+            return "M"
+        return "S" if self.shared[set_idx, way] else "E"
+
+    def access_block(self, addr: int, write: bool) -> tuple[int, int, bool]:
+        # the bus transaction happens before the access, so modified copies elsewhere reach memory before the fill
+        set_idx = (addr >> self.offset_bits) & (self.num_sets - 1)
+        block_addr = addr & ~(self.block_size - 1)
+        way = self.find_way(set_idx, addr >> (self.offset_bits + self.set_bits))
+        if way >= 0:
+            cycles = 0
+            if write and self.shared[set_idx, way]:
+                cycles = self.bus.upgrade(self, block_addr)
+                self.shared[set_idx, way] = False
+            line_addr, latency, hit = super().access_block(addr, write)
+            return line_addr, latency + cycles, hit
+        cycles, shared = self.bus.read(self, block_addr, write)
+        line_addr, latency, hit = super().access_block(addr, write)
+        self.shared[set_idx, line_addr // self.block_size - set_idx * self.num_ways] = shared and not write
+        return line_addr, latency + cycles, hit
+
+    def snoop(self, block_addr: int, exclusive: bool) -> tuple[int, bool]:
+        # another cache missed on block_addr, returns (cycles, whether this cache held it)
+        # M copies are written back, every copy is invalidated on an exclusive request and becomes S otherwise
+        set_idx = (block_addr >> self.offset_bits) & (self.num_sets - 1)
+        way = self.find_way(set_idx, block_addr >> (self.offset_bits + self.set_bits))
+        if way < 0:
+            return 0, False
+        cycles = 0
+        if self.dirty[set_idx, way]:
+            self.bus.interventions += 1
+            cycles += self.write_back(set_idx, way)
+        if exclusive:
+            self.bus.invalidations += 1
+            self.drop(set_idx, way)
+        else:
+            self.shared[set_idx, way] = True
+        return cycles, True
+
+class MultiCoreSystem:
+    # runs several Cpus interleaved by simulated time: the core with the smallest time executes its next instruction,
+    # so requests reach shared memories roughly in time order; each instruction still runs to completion
+    def __init__(self, cpus: list[Cpu], arbiter: DramArbiter = None, bus: CoherenceBus = None) -> None:
+        self.cpus = cpus
+        self.arbiter = arbiter
+        self.bus = bus
+
+    def run(self, programs: list[Program | EncodedProgram]) -> dict:
+        # runs programs[i] on cpus[i] until every core halts, returns collect_stats()
+        assert len(programs) == len(self.cpus), "Error: need one program per core"
+        ready = []
+        for idx, (cpu, program) in enumerate(zip(self.cpus, programs)):
+            cpu.load_program(program)
+            ready.append((cpu.time, idx))
+        heapq.heapify(ready)
+        while ready:
+            _, idx = ready[0]
+            cpu = self.cpus[idx]
+            if self.arbiter is not None:
+                self.arbiter.now = cpu.time
+            if cpu.step():
+                heapq.heapreplace(ready, (cpu.time, idx))
+            else:
+                cpu.instructions_executed += 1 # halt, counted like run_program does
+                heapq.heappop(ready)
+        print(f"Halted at cycle {self.time()}")
+        return self.collect_stats()
+
+    def time(self) -> int:
+        return max(cpu.time for cpu in self.cpus)
+
+    def collect_stats(self) -> dict:
+        stats = {"cycles": self.time(), "cores": [cpu.collect_stats() for cpu in self.cpus]}
+        if self.arbiter is not None:
+            stats["dram"] = self.arbiter.get_stats(self.time())
+        if self.bus is not None:
+            stats["coherence"] = self.bus.get_stats()
+        return stats
+
+def partition_output_tiles(M: int, N: int, matrix_dim: int, num_cores: int, scheme: str = "rows") -> list[list[tuple[int, int]]]:
+    # splits the (tile row, tile col) output tiles of an M x N GEMM into num_cores lists whose sizes differ by at most 1
+    # rows: contiguous runs in row major order, so cores share few A row panels
+    # columns: contiguous runs in column major order, so cores share few B column panels
+    # round_robin: tile t goes to core t % num_cores
+    assert num_cores > 0, "Error: need at least 1 core"
+    m_tiles = math.ceil(M / matrix_dim)
+    n_tiles = math.ceil(N / matrix_dim)
+    if scheme == "rows":
+        tiles = [(i, j) for i in range(m_tiles) for j in range(n_tiles)]
+    elif scheme == "columns":
+        tiles = [(i, j) for j in range(n_tiles) for i in range(m_tiles)]
+    elif scheme == "round_robin":
+        tiles = [(i, j) for i in range(m_tiles) for j in range(n_tiles)]
+        return [tiles[core::num_cores] for core in range(num_cores)]
+    else:
+        assert False, f"Unknown partition scheme {scheme}, expected one of ['rows', 'columns', 'round_robin']"
+    shares = []
+    start = 0
+    for core in range(num_cores):
+        count = len(tiles) // num_cores + (1 if core < len(tiles) % num_cores else 0)
+        shares.append(tiles[start : start + count])
+        start += count
+    return shares
+
+def run_multicore_gemm(mat_A: np.ndarray, mat_B: np.ndarray, mat_D: np.ndarray, num_cores: int, matrix_dim: int,
+                       num_matrices: int = 4, bytes_per_cycle: int = 16, scheme: str = "rows",
+                       dataflow: str = "output_stationary", dram_read_latency: int = 100, dram_write_latency: int = 10) -> tuple[np.ndarray, dict]:
+    # C = A*B + D on num_cores cores, each with a private GemmCache and a port to one shared Dram
+    # operands are unsigned integers of 1, 2 or 4 bytes; returns (C, MultiCoreSystem stats)
+    M, K = mat_A.shape
+    N = mat_B.shape[1]
+    bpe = mat_A.dtype.itemsize
+    dtype = np.dtype(f">u{bpe}")
+    addr_A = 0
+    addr_B = addr_A + M * K * bpe
+    addr_C = addr_B + K * N * bpe
+    addr_D = addr_C + M * N * bpe
+    zero_addr = addr_D + M * N * bpe
+    dram_size = zero_addr + matrix_dim * matrix_dim * bpe
+    dram = Dram(dram_size, 0, dram_read_latency, dram_write_latency)
+    for addr, mat in ((addr_A, mat_A), (addr_B, mat_B), (addr_D, mat_D)):
+        dram.memory.store_tile(addr, mat.shape[1] * bpe, mat.astype(dtype).view(np.uint8).reshape(mat.shape[0], -1))
+
+    arbiter = DramArbiter(dram, bytes_per_cycle)
+    cpus = []
+    programs = []
+    for share in partition_output_tiles(M, N, matrix_dim, num_cores, scheme):
+        gemm_cache = GemmCache(matrix_dim, num_matrices, dram_size, GemmCacheLatencies(matrix_dim), bpe)
+        cpus.append(Cpu([arbiter.port(), gemm_cache], 8, 4, 1, CpuLatencies()))
+        program = Program(4)
+        generate_gemm(program, M, N, K, matrix_dim, num_matrices, dram_size, addr_A, addr_B, addr_C, addr_D, bpe,
+                      dataflow, zero_addr, share)
+        program.halt()
+        programs.append(program)
+    stats = MultiCoreSystem(cpus, arbiter).run(programs)
+    return dram.memory.load_tile(addr_C, M, N * bpe, N * bpe).view(dtype), stats
+
+if __name__ == "__main__":
+    print("MultiCore Test Begin")
+
+    # partitions cover every tile once and are balanced
+    for scheme in ("rows", "columns", "round_robin"):
+        shares = partition_output_tiles(10, 12, 4, 4, scheme)
+        assert sorted(tile for share in shares for tile in share) == [(i, j) for i in range(3) for j in range(3)]
+        assert max(map(len, shares)) - min(map(len, shares)) <= 1
+    assert partition_output_tiles(8, 8, 4, 2, "rows") == [[(0, 0), (0, 1)], [(1, 0), (1, 1)]]
+    assert partition_output_tiles(8, 8, 4, 2, "columns") == [[(0, 0), (1, 0)], [(0, 1), (1, 1)]]
+    assert partition_output_tiles(4, 4, 4, 3) == [[(0, 0)], [], []] # idle cores just halt
+
+    # MESI: core 0 writes a value that core 1 reads later, the modified copy is written back before core 1 fetches it
+    def make_cores(num_cores):
+        dram = Dram(1024, 0, 100, 10)
+        arbiter = DramArbiter(dram)
+        bus = CoherenceBus()
+        caches = [CoherentCache(64, 1024, 8, 1, 1, arbiter.port(), bus) for _ in range(num_cores)]
+        cpus = [Cpu([cache], 8, 4, 1, CpuLatencies()) for cache in caches]
+        return MultiCoreSystem(cpus, arbiter, bus), caches, dram
+
+    def delay(program, cycles):
+        for _ in range(cycles):
+            program.add_immediate(7, 7, 1)
+
+    system, caches, dram = make_cores(2)
+    writer = Program(4)
+    writer.move(1, 42)
+    writer.store_byte(1, 0, 0x10) # write miss: BusRdX, E -> M without sharers
+    delay(writer, 300)
+    writer.move(1, 43)
+    writer.store_byte(1, 0, 0x10) # after the reader shares the block: BusUpgr invalidates the reader's copy
+    writer.halt()
+    reader = Program(4)
+    delay(reader, 200)
+    reader.load_byte(2, 0, 0x10) # BusRd: the writer's M copy is written back and both become S
+    delay(reader, 300)
+    reader.load_byte(3, 0, 0x10) # invalidated by the upgrade, reads the new value from the writer
+    reader.halt()
+    stats = system.run([writer, reader])
+    assert system.cpus[1].registers[2] == 42 and system.cpus[1].registers[3] == 43
+    assert stats["coherence"] == {"reads": 2, "read_exclusives": 1, "upgrades": 1, "invalidations": 1, "interventions": 2}
+    assert caches[0].state(0x10) == "S" and caches[1].state(0x10) == "S"
+    assert dram.memory.load(0x10, 1) == 43
+    assert stats["cores"][0]["instructions"] == 2 + 300 + 2 + 1
+
+    # a single reader holds a block exclusively and writes it without a bus transaction
+    system, caches, _ = make_cores(2)
+    program = Program(4)
+    program.load_byte(1, 0, 0x20)
+    program.store_byte(1, 0, 0x21)
+    program.halt()
+    idle = Program(4)
+    idle.halt()
+    stats = system.run([program, idle])
+    assert caches[0].state(0x20) == "M" and stats["coherence"]["upgrades"] == 0 and stats["coherence"]["reads"] == 1
+
+    # the GEMM is correct on every core count and gets faster with more cores until the shared DRAM saturates
+    rng = np.random.default_rng(0)
+    mat_A = rng.integers(0, 4, size=(16, 12)).astype(np.uint8)
+    mat_B = rng.integers(0, 4, size=(12, 16)).astype(np.uint8)
+    mat_D = rng.integers(0, 4, size=(16, 16)).astype(np.uint8)
+    expected = (mat_A.astype(np.uint64) @ mat_B.astype(np.uint64) + mat_D).astype(np.uint8)
+    cycles = {}
+    for num_cores in (1, 2, 4):
+        for scheme in ("rows", "round_robin"):
+            result, stats = run_multicore_gemm(mat_A, mat_B, mat_D, num_cores, 4, scheme=scheme)
+            assert np.array_equal(result, expected), f"{num_cores} cores {scheme} is not correct"
+            cycles[num_cores, scheme] = stats["cycles"]
+    assert cycles[1, "rows"] > cycles[2, "rows"] > cycles[4, "rows"]
+    _, stats = run_multicore_gemm(mat_A, mat_B, mat_D, 4, 4, bytes_per_cycle=1)
+    assert stats["cycles"] > cycles[4, "rows"] and stats["dram"]["utilization"] > 0.5 and stats["dram"]["queue_cycles"] > 0
+    print("MultiCore Test Finished")
@@ -0,0 +1,34 @@
+# multicore_matrix.py
+
+from multicore import run_multicore_gemm
+import numpy as np
+import contextlib
+import io
+
+MATRIX_DIM = 64 # input matrices are size MATRIX_DIM by MATRIX_DIM
+TILE_DIM = 16 # GemmCache matrices are size TILE_DIM by TILE_DIM
+CORE_COUNTS = [1, 2, 4, 8, 16]
+DRAM_BYTES_PER_CYCLE = [16, 2] # shared DRAM channel bandwidth
+PARTITION = "rows" # "rows", "columns" or "round_robin"
+
+rng = np.random.default_rng(0)
+mat_A = rng.integers(0, 4, size=(MATRIX_DIM, MATRIX_DIM)).astype(np.uint8)
+mat_B = rng.integers(0, 4, size=(MATRIX_DIM, MATRIX_DIM)).astype(np.uint8)
+mat_D = rng.integers(0, 4, size=(MATRIX_DIM, MATRIX_DIM)).astype(np.uint8)
+expected = (mat_A.astype(np.uint64) @ mat_B.astype(np.uint64) + mat_D).astype(np.uint8)
+
+correct = True
+print(f"{'bytes/cycle':>12} {'cores':>6} {'cycles':>10} {'speedup':>8} {'dram util':>10} {'queue cycles':>13}")
+for bytes_per_cycle in DRAM_BYTES_PER_CYCLE:
+    base_cycles = None
+    for num_cores in CORE_COUNTS:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result, stats = run_multicore_gemm(mat_A, mat_B, mat_D, num_cores, TILE_DIM, bytes_per_cycle=bytes_per_cycle, scheme=PARTITION)
+        correct &= np.array_equal(result, expected)
+        base_cycles = base_cycles or stats["cycles"]
+        print(f"{bytes_per_cycle:12} {num_cores:6} {stats['cycles']:10} {base_cycles / stats['cycles']:8.2f} {stats['dram']['utilization']:10.2f} {stats['dram']['queue_cycles']:13}")
+
+if correct:
+    print("Matmul is correct")
+else:
+    print("Matmul is not correct")
@@ -1,12 +1,23 @@
 # packet.py
 
 class Packet:
-    def __init__(self, load: bool, addr: int, size: int = 0, data: int = None, latency: int = 0) -> None:
+    def __init__(self, load: bool, addr: int, size: int = 0, data: int = None, latency: int = 0, pc: int = None) -> None:
         self.load = load # whether the packet is for a load or store
         self.addr = addr
         self.size = size # size in bytes
         self.data = data
         self.latency = latency
+        self.pc = pc # pc of the instruction that issued the packet, None for packets not issued by the cpu
+
+class TilePacket:
+    def __init__(self, load: bool, addr: int, rows: int, cols: int, stride: int, data = None, latency: int = 0) -> None:
+        self.load = load # whether the packet is for a load or store
+        self.addr = addr # address of the first byte of the first row
+        self.rows = rows
+        self.cols = cols # bytes per row
+        self.stride = stride # bytes between the starts of consecutive rows
+        self.data = data # rows x cols np.uint8 array
+        self.latency = latency
 
 class MatrixPacket:
     def __init__(self, multiply: bool, matA_start: int, matB_start: int, matC_start: int, latency: int = 0) -> None:
@@ -16,4 +27,19 @@ class MatrixPacket:
         self.matC_start = matC_start
         self.latency = latency
 
-    
\ No newline at end of file
+class MatrixBatchPacket:
+    def __init__(self, multiply: bool, mat_starts: list[tuple[int, int, int]], accumulate: bool = False, latency: int = 0) -> None:
+        self.multiply = multiply # whether the packet is for multiply or add
+        self.mat_starts = mat_starts # (matA_start, matB_start, matC_start) for each operation, executed in order
+        self.accumulate = accumulate # multiply only, C += A*B instead of C = A*B
+        self.latency = latency
+
+class DmaPacket:
+    def __init__(self, src_memory, src_addr: int, dest_memory, dest_addr: int, size: int, tag: int = 0, latency: int = 0) -> None:
+        self.src_memory = src_memory # MemObject the transfer reads from
+        self.src_addr = src_addr # address inside src_memory
+        self.dest_memory = dest_memory # MemObject the transfer writes to
+        self.dest_addr = dest_addr # address inside dest_memory
+        self.size = size # size in bytes
+        self.tag = tag # transfers are waited on by tag
+        self.latency = latency
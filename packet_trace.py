@@ -0,0 +1,442 @@
+# packet_trace.py
+
+from collections import OrderedDict
+from memory import MemObject
+from packet import Packet, TilePacket
+from replacement_policy import REPLACEMENT_POLICIES
+import numpy as np
+import random
+import gzip
+
+# one record per packet the cpu sends to a memory, tiles are recorded as one record per row
+# cycle is Cpu.time when the instruction started, addr is the address inside memories[memory]
+TRACE_DTYPE = np.dtype([("cycle", np.uint64), ("addr", np.uint64), ("size", np.uint32), ("load", np.bool_), ("memory", np.uint8)])
+TRACE_MAGIC = b"GEMMTRACE1\n" # followed by the raw records, the whole file is gzip compressed
+
+class TraceWriter:
+    # streams packets to a gzip file in chunks of chunk_records, pass it (or a path) to Cpu.run_program(program, trace=...)
+    # only packets sent by the cpu (and its DMA engine) to cpu.memories are recorded, the accesses the memories
+    # make to their next levels and matrix packets are not
+    def __init__(self, path: str, chunk_records: int = 1 << 16, compresslevel: int = 6) -> None:
+        assert chunk_records > 0, "Error: trace chunk size must be greater than 0"
+        self.file = gzip.open(path, "wb", compresslevel=compresslevel)
+        self.file.write(TRACE_MAGIC)
+        self.buffer = np.zeros(chunk_records, dtype=TRACE_DTYPE)
+        self.count = 0 # records in buffer
+        self.records = 0 # records written, buffer included
+        self.cpu = None
+        self.depth = 0 # packets in flight, rows of a tile and nested calls are only recorded once
+        self.patched = []
+
+    def attach(self, cpu) -> None:
+        self.cpu = cpu
+        for idx, memory in enumerate(cpu.memories):
+            assert idx < 256, "Error: trace records support at most 256 memories"
+            self.wrap(memory, "process_packet", self.make_packet_wrapper(memory.process_packet, idx))
+            self.wrap(memory, "process_tile_packet", self.make_tile_wrapper(memory.process_tile_packet, idx))
+
+    def detach(self) -> None:
+        # restore whatever was there before, e.g. a profiler attached first
+        for memory, method_name, previous in reversed(self.patched):
+            if previous is None:
+                delattr(memory, method_name)
+            else:
+                setattr(memory, method_name, previous)
+        self.patched = []
+        self.cpu = None
+
+    def wrap(self, memory: MemObject, method_name: str, wrapper) -> None:
+        self.patched.append((memory, method_name, vars(memory).get(method_name)))
+        setattr(memory, method_name, wrapper)
+
+    def make_packet_wrapper(self, method, idx: int):
+        def wrapper(pkt: Packet) -> Packet:
+            if self.depth == 0:
+                self.record(self.cpu.time, pkt.addr, pkt.size, pkt.load, idx)
+            self.depth += 1
+            try:
+                return method(pkt)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+    def make_tile_wrapper(self, method, idx: int):
+        def wrapper(pkt: TilePacket) -> TilePacket:
+            if self.depth == 0:
+                self.record_rows(self.cpu.time, pkt.addr, pkt.rows, pkt.cols, pkt.stride, pkt.load, idx)
+            self.depth += 1
+            try:
+                return method(pkt)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+    def record(self, cycle: int, addr: int, size: int, load: bool, memory: int) -> None:
+        self.buffer[self.count] = (cycle, addr, size, load, memory)
+        self.count += 1
+        self.records += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def record_rows(self, cycle: int, addr: int, rows: int, cols: int, stride: int, load: bool, memory: int) -> None:
+        row = 0
+        while row < rows:
+            n = min(rows - row, len(self.buffer) - self.count)
+            records = self.buffer[self.count : self.count + n]
+            records["cycle"] = cycle
+            records["addr"] = addr + np.arange(row, row + n, dtype=np.uint64) * stride
+            records["size"] = cols
+            records["load"] = load
+            records["memory"] = memory
+            self.count += n
+            self.records += n
+            row += n
+            if self.count == len(self.buffer):
+                self.flush()
+
+    def flush(self) -> None:
+        self.file.write(self.buffer[: self.count].tobytes())
+        self.count = 0
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def iter_trace(path: str, chunk_records: int = 1 << 16):
+    # yields the records of a trace file in arrays of at most chunk_records, only one chunk is in memory at a time
+    with gzip.open(path, "rb") as f:
+        assert f.read(len(TRACE_MAGIC)) == TRACE_MAGIC, f"Error: {path} is not a trace file"
+        chunk_bytes = chunk_records * TRACE_DTYPE.itemsize
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            assert len(data) % TRACE_DTYPE.itemsize == 0, f"Error: {path} is truncated"
+            yield np.frombuffer(data, dtype=TRACE_DTYPE)
+
+def load_trace(path: str) -> np.ndarray:
+    return np.concatenate([np.empty(0, dtype=TRACE_DTYPE), *iter_trace(path)])
+
+class CacheReplay:
+    # replays trace records of one memory through a write allocate, write back cache model with the same
+    # geometry as Cache (size, block_size, associativity, replacement_policy) and counts hits, misses and evictions
+    # no data is stored and nothing is timed, so a configuration costs a fraction of a cpu run; prefetchers,
+    # inclusion and next levels are not modeled
+    # direct mapped caches are replayed one chunk at a time with numpy, associative LRU caches with one
+    # OrderedDict per set and the other policies with per set Python lists that mirror the ReplacementPolicy classes
+    def __init__(self, size: int, block_size: int, associativity: int = 1, replacement_policy: str = "lru", memory: int = 0) -> None:
+        assert block_size > 0 and (block_size & (block_size - 1)) == 0, "Error: cache block size must be a power of 2"
+        assert size % (block_size * associativity) == 0, "Error: cache size must be a multiple of block_size * associativity"
+        self.size = size
+        self.block_size = block_size
+        self.num_ways = associativity
+        self.num_sets = size // (block_size * associativity)
+        assert (self.num_sets & (self.num_sets - 1)) == 0, "Error: number of cache sets must be a power of 2"
+        self.offset_bits = block_size.bit_length() - 1
+        self.set_bits = self.num_sets.bit_length() - 1
+        self.replacement_policy = replacement_policy
+        self.memory = memory
+        if associativity == 1:
+            self.tags = np.zeros(self.num_sets, dtype=np.int64)
+            self.valid = np.zeros(self.num_sets, dtype=bool)
+            self.dirty = np.zeros(self.num_sets, dtype=bool)
+        elif replacement_policy == "lru":
+            self.lines = [OrderedDict() for _ in range(self.num_sets)] # tag -> dirty, least recently used first
+        else:
+            assert replacement_policy in REPLACEMENT_POLICIES, f"Unknown replacement policy {replacement_policy}, expected one of {list(REPLACEMENT_POLICIES.keys())}"
+            self.set_tags = [[None] * associativity for _ in range(self.num_sets)] # None is an invalid way
+            self.set_dirty = [[False] * associativity for _ in range(self.num_sets)]
+            if replacement_policy == "plru":
+                # the tree bits of a set as one int, bit i is heap node i of TreePlruPolicy
+                assert associativity & (associativity - 1) == 0, "Tree PLRU needs a power of 2 number of ways"
+                self.plru_levels = associativity.bit_length() - 1
+                self.plru_bits = [0] * self.num_sets
+                self.plru_touch = [] # way -> (keep mask, bits), touching points every node on the path away from the way
+                for way in range(associativity):
+                    mask = bits = node = 0
+                    for level in range(self.plru_levels - 1, -1, -1):
+                        direction = (way >> level) & 1
+                        mask |= 1 << node
+                        bits |= (1 - direction) << node
+                        node = 2 * node + 1 + direction
+                    self.plru_touch.append((~mask, bits))
+            elif replacement_policy == "rrip":
+                self.max_rrpv = 3 # the 2 bit default of RripPolicy
+                self.rrpv = [[self.max_rrpv] * associativity for _ in range(self.num_sets)]
+            elif replacement_policy == "random":
+                self.rng = random.Random(0) # the seed RandomPolicy uses, so victims match a Cache fed in trace order
+        self.accesses = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def block_accesses(self, records: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (block number, write) of every block touched by the records of this memory, in trace order
+        records = records[(records["memory"] == self.memory) & (records["size"] > 0)]
+        first = (records["addr"] >> np.uint64(self.offset_bits)).astype(np.int64)
+        last = ((records["addr"] + records["size"] - np.uint64(1)) >> np.uint64(self.offset_bits)).astype(np.int64)
+        counts = last - first + 1
+        starts = np.cumsum(counts) - counts
+        blocks = np.repeat(first, counts) + (np.arange(int(counts.sum())) - np.repeat(starts, counts))
+        return blocks, np.repeat(~records["load"], counts)
+
+    def feed(self, records: np.ndarray) -> None:
+        blocks, writes = self.block_accesses(records)
+        self.accesses += len(blocks)
+        self.writes += int(writes.sum())
+        if self.num_ways == 1:
+            self.feed_direct_mapped(blocks, writes)
+        elif self.replacement_policy == "lru":
+            self.feed_lru(blocks, writes)
+        else:
+            self.feed_policy(blocks, writes)
+
+    def feed_direct_mapped(self, blocks: np.ndarray, writes: np.ndarray) -> None:
+        if len(blocks) == 0:
+            return
+        # group the accesses by set, keeping trace order inside each set; a set only ever holds its last block
+        order = np.argsort(blocks & (self.num_sets - 1), kind="stable")
+        blocks = blocks[order]
+        writes = writes[order]
+        sets = blocks & (self.num_sets - 1)
+        tags = blocks >> self.set_bits
+        group_start = np.ones(len(blocks), dtype=bool)
+        group_start[1:] = sets[1:] != sets[:-1]
+        # the block resident before each access is the previous access of the set, or the carried state for the first one
+        prev_tags = np.empty_like(tags)
+        prev_tags[1:] = tags[:-1]
+        prev_tags[group_start] = self.tags[sets[group_start]]
+        prev_valid = np.ones(len(blocks), dtype=bool)
+        prev_valid[group_start] = self.valid[sets[group_start]]
+        hit = prev_valid & (prev_tags == tags)
+        miss = ~hit
+
+        # a residency runs from a miss (or the start of a set's group) to the next miss, its block is dirty if any
+        # access in it wrote, or if it continues a dirty block from the previous chunk
+        segment_start = miss | group_start
+        starts = np.flatnonzero(segment_start)
+        segment_dirty = np.logical_or.reduceat(writes, starts)
+        continued = hit[starts] # group starts that hit continue the carried block
+        segment_dirty[continued] |= self.dirty[sets[starts[continued]]]
+        segment = np.cumsum(segment_start) - 1
+
+        evicted = miss & prev_valid
+        # an evicted block is the previous residency of the set, or the carried block for a group start
+        evicted_dirty = np.where(group_start, self.dirty[sets], segment_dirty[np.maximum(segment - 1, 0)])
+        self.hits += int(hit.sum())
+        self.misses += int(miss.sum())
+        self.evictions += int(evicted.sum())
+        self.writebacks += int((evicted & evicted_dirty).sum())
+
+        group_end = np.append(group_start[1:], True)
+        last_sets = sets[group_end]
+        self.tags[last_sets] = tags[group_end]
+        self.valid[last_sets] = True
+        self.dirty[last_sets] = segment_dirty[segment[group_end]]
+
+    def feed_lru(self, blocks: np.ndarray, writes: np.ndarray) -> None:
+        set_mask = self.num_sets - 1
+        hits = evictions = writebacks = 0
+        for block, write in zip(blocks.tolist(), writes.tolist()):
+            lines = self.lines[block & set_mask]
+            tag = block >> self.set_bits
+            if tag in lines:
+                hits += 1
+                lines.move_to_end(tag)
+                if write:
+                    lines[tag] = True
+                continue
+            if len(lines) == self.num_ways:
+                evictions += 1
+                writebacks += lines.popitem(last=False)[1]
+            lines[tag] = write
+        self.hits += hits
+        self.misses += len(blocks) - hits
+        self.evictions += evictions
+        self.writebacks += writebacks
+
+    def feed_policy(self, blocks: np.ndarray, writes: np.ndarray) -> None:
+        # same steps as Cache.access_block, without the data
+        sets = blocks & (self.num_sets - 1)
+        if self.replacement_policy != "random":
+            # a set's state only depends on its own accesses, so they are replayed grouped by set (in trace order
+            # inside each set); random victims come from one generator and keep the trace order
+            order = np.argsort(sets, kind="stable")
+            blocks = blocks[order]
+            writes = writes[order]
+            sets = sets[order]
+        policy = self.replacement_policy
+        set_tags = self.set_tags
+        set_dirty = self.set_dirty
+        plru_touch = getattr(self, "plru_touch", None)
+        plru_bits = getattr(self, "plru_bits", None)
+        set_rrpv = getattr(self, "rrpv", None)
+        hits = evictions = writebacks = 0
+        for set_idx, tag, write in zip(sets.tolist(), (blocks >> self.set_bits).tolist(), writes.tolist()):
+            tags = set_tags[set_idx]
+            dirty = set_dirty[set_idx]
+            if tag in tags:
+                way = tags.index(tag)
+                hits += 1
+                if write:
+                    dirty[way] = True
+                if policy == "plru":
+                    mask, bits = plru_touch[way]
+                    plru_bits[set_idx] = plru_bits[set_idx] & mask | bits
+                elif policy == "rrip":
+                    set_rrpv[set_idx][way] = 0
+                continue
+            if None in tags:
+                way = tags.index(None)
+            else:
+                way = self.victim(set_idx)
+                evictions += 1
+                writebacks += dirty[way]
+            tags[way] = tag
+            dirty[way] = write
+            if policy == "plru":
+                mask, bits = plru_touch[way]
+                plru_bits[set_idx] = plru_bits[set_idx] & mask | bits
+            elif policy == "rrip":
+                set_rrpv[set_idx][way] = self.max_rrpv - 1
+        self.hits += hits
+        self.misses += len(blocks) - hits
+        self.evictions += evictions
+        self.writebacks += writebacks
+
+    def victim(self, set_idx: int) -> int:
+        # the way the policy's ReplacementPolicy.victim would pick
+        if self.replacement_policy == "plru":
+            bits = self.plru_bits[set_idx]
+            way = node = 0
+            for _ in range(self.plru_levels):
+                direction = (bits >> node) & 1
+                way = (way << 1) | direction
+                node = 2 * node + 1 + direction
+            return way
+        if self.replacement_policy == "rrip":
+            # age the whole set until some way reaches the distant re-reference value
+            rrpv = self.rrpv[set_idx]
+            age = self.max_rrpv - max(rrpv)
+            if age:
+                rrpv[:] = [value + age for value in rrpv]
+            return rrpv.index(self.max_rrpv)
+        if self.replacement_policy == "random":
+            return self.rng.randrange(self.num_ways)
+        # lru over an associative cache is replayed by feed_lru
+        assert False, f"Error: no replay victim for {self.replacement_policy}"
+
+    def get_stats(self) -> dict:
+        return {
+            "accesses": self.accesses,
+            "writes": self.writes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks,
+            "hit_rate": self.hits / self.accesses if self.accesses > 0 else 0.0
+        }
+
+def replay(trace: str | np.ndarray, chunk_records: int = 1 << 16, **config) -> dict:
+    # stats of one cache configuration, config holds the CacheReplay arguments
+    return replay_many(trace, [config], chunk_records)[0]
+
+def replay_many(trace: str | np.ndarray, configs: list[dict], chunk_records: int = 1 << 16) -> list[dict]:
+    # stats of every configuration, the trace is read (and decompressed) once and each chunk is fed to all of them
+    replays = [CacheReplay(**config) for config in configs]
+    chunks = iter_trace(trace, chunk_records) if isinstance(trace, str) else (trace[i : i + chunk_records] for i in range(0, len(trace), chunk_records))
+    for chunk in chunks:
+        for cache_replay in replays:
+            cache_replay.feed(chunk)
+    return [dict(config, **cache_replay.get_stats()) for config, cache_replay in zip(configs, replays)]
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    from gemm_cache import Cache
+    from program import Program
+    print("Trace Test Begin")
+
+    # strided loads and stores over a region larger than the caches, with a 2 byte access crossing blocks
+    program = Program(4)
+    program.move(1, 96)
+    program.move(4, 3)
+    program.insert_label("loop")
+    program.load_byte(2, 1, 0x100)
+    program.store_byte(2, 1, 0x400)
+    program.load(3, 1, 0x7ff)
+    program.add_immediate(1, 1, -1)
+    program.label_branch_if(1, "loop")
+    program.move(1, 0x100)
+    program.move(2, 0x900)
+    program.move_tile(1, 2, 4, 8, 32, 16) # 4 rows
+    program.halt()
+
+    with tempfile.TemporaryDirectory() as trace_dir:
+        path = os.path.join(trace_dir, "trace.gz")
+        cpu = Cpu([Cache(256, 4096, 8, 1, 1, Dram(4096, 0, 100, 10))], 8, 4, 1, CpuLatencies())
+        with TraceWriter(path, chunk_records=16) as writer: # several chunks
+            cpu.run_program(program, trace=writer)
+        assert "process_packet" not in vars(cpu.memories[0]) # wrappers are removed afterwards
+        records = load_trace(path)
+        assert len(records) == writer.records == 3 * 96 + 2 * 4
+        assert records[0]["addr"] == 0x100 + 96 and records[0]["load"] and records[0]["cycle"] == 2
+        assert not records[1]["load"] and records[2]["size"] == 4
+        assert list(records["addr"][-4:]) == [0x900, 0x910, 0x920, 0x930] and not records[-1]["load"]
+        assert all(len(chunk) <= 5 for chunk in iter_trace(path, 5))
+
+        # tracing doesn't change the run, and works together with the profiler and the jit
+        from profiler import Profiler
+        reference = Cpu([Cache(256, 4096, 8, 1, 1, Dram(4096, 0, 100, 10))], 8, 4, 1, CpuLatencies())
+        reference.run_program(program)
+        assert reference.time == cpu.time
+        traced = Cpu([Cache(256, 4096, 8, 1, 1, Dram(4096, 0, 100, 10))], 8, 4, 1, CpuLatencies())
+        traced.run_program(program, jit=True, profiler=Profiler(), trace=os.path.join(trace_dir, "profiled.gz"))
+        assert traced.time == cpu.time and np.array_equal(load_trace(os.path.join(trace_dir, "profiled.gz")), records)
+
+        # replay matches the hits of the real cache for every kind of configuration
+        configs = [
+            {"size": 64, "block_size": 8},
+            {"size": 256, "block_size": 16},
+            {"size": 128, "block_size": 8, "associativity": 4},
+            {"size": 128, "block_size": 8, "associativity": 2, "replacement_policy": "plru"},
+            {"size": 128, "block_size": 8, "associativity": 4, "replacement_policy": "rrip"},
+            {"size": 64, "block_size": 8, "associativity": 4, "replacement_policy": "random"}
+        ]
+        results = replay_many(path, configs, chunk_records=7)
+        for config, result in zip(configs, results):
+            dram = Dram(4096, 0, 100, 10)
+            dram_writes = []
+            dram_process_packet = dram.process_packet
+            def count_writes(pkt: Packet) -> Packet:
+                dram_writes.append(not pkt.load) # the cache only writes to dram on a write back
+                return dram_process_packet(pkt)
+            dram.process_packet = count_writes
+            cache = Cache(config["size"], 4096, config["block_size"], 1, 1, dram, config.get("associativity", 1), config.get("replacement_policy", "lru"))
+            hits = accesses = 0
+            for record in records.tolist():
+                _, addr, size, load, _ = record
+                for block in range(addr // cache.block_size, (addr + size - 1) // cache.block_size + 1):
+                    hits += cache.access_block(block * cache.block_size, not load)[2]
+                    accesses += 1
+            assert result["accesses"] == accesses and result["hits"] == hits, f"{config}: {result}"
+            assert result["misses"] == result["evictions"] + np.count_nonzero(cache.valid)
+            assert result["writebacks"] == sum(dram_writes) > 0
+        # chunking doesn't change the result
+        assert replay(records, chunk_records=1, size=64, block_size=8) == replay(records, chunk_records=len(records), size=64, block_size=8)
+        plru = {"size": 128, "block_size": 8, "associativity": 4, "replacement_policy": "plru"}
+        assert replay(records, chunk_records=1, **plru) == replay(records, chunk_records=len(records), **plru)
+        assert replay(records, memory=1, size=64, block_size=8)["accesses"] == 0
+    print("Trace Test Finished")
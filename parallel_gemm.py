@@ -0,0 +1,182 @@
+# parallel_gemm.py
+
+from concurrent.futures import ProcessPoolExecutor
+from cpu import Cpu, CpuLatencies
+from dram import Dram
+from gemm_cache import GemmCache, GemmCacheLatencies
+from gemm_codegen import GemmCodegen
+from encoded_program import EncodedProgram, INSTRUCTION_DTYPE
+from memory_array import SharedMemoryArray
+from program import Program
+import numpy as np
+import contextlib
+import tempfile
+import io
+import os
+
+# Output stationary GEMM simulated as independent jobs, one per group of C tiles that share the GemmCache
+# (see GemmCodegen.checkpoints), in a process pool. The serial program is generated once and every job runs its
+# slice of it on its own Cpu, Dram and GemmCache, starting from the registers and GemmCache slots the serial run
+# has at that point, so the per job cycles add up to exactly the serial cycles. The DRAM bytes live in a shared
+# memory block: inputs are read and disjoint C tiles are written in place by every worker, nothing is pickled
+# besides the job descriptions. Latencies must not depend on history, so the DRAM timing model isn't supported.
+
+worker = None # (config, memory, encoded program, codegen) of this process, set by init_worker
+
+def init_worker(config: dict) -> None:
+    global worker
+    memory = SharedMemoryArray(config["dram_size"], config["shm_name"])
+    encoded = EncodedProgram.load(config["program_path"]).encoded
+    worker = (config, memory, encoded, GemmCodegen(**config["codegen"]))
+
+def close_worker() -> None:
+    global worker
+    worker[1].close()
+    worker = None
+
+def run_job(job: tuple[int, int, dict, dict]) -> tuple[int, int]:
+    # runs instructions [start, end) of the program, returns (cycles, instructions executed)
+    start, end, registers, slot_tiles = job
+    config, memory, encoded, codegen = worker
+    bpe = codegen.bytes_per_element
+    dram = Dram(config["dram_size"], 0, config["dram_read_latency"], config["dram_write_latency"], config["burst_size"], memory)
+    gemm_cache = GemmCache(codegen.dim, codegen.num_matrices, config["dram_size"], config["gemm_cache_latencies"], bpe)
+    # the A, B and D tiles the serial run holds in the GemmCache at start, copied without charging cycles
+    for slot, tile in slot_tiles.items():
+        if tile is None or tile[0] == "C":
+            continue
+        name, row, col = tile
+        addr, rows, cols = codegen.tile_extent(name, row, col)
+        row_elements = codegen.K if name == "A" else codegen.N
+        data = memory.load_tile(addr, rows, cols * bpe, row_elements * bpe)
+        gemm_cache.matrices.store_tile(slot * codegen.matrix_bytes, codegen.dim * bpe, data)
+    cpu = Cpu([dram, gemm_cache], config["num_registers"], config["register_bytes"], 1, config["cpu_latencies"])
+    for register, value in registers.items():
+        cpu.registers[register] = value
+    program = np.concatenate([encoded[start:end], np.zeros(1, dtype=INSTRUCTION_DTYPE)]) # opcode 0 is halt
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpu.run_program(program)
+    return cpu.time, cpu.instructions_executed - 1
+
+def gemm_layout(M: int, N: int, K: int, matrix_dim: int, bytes_per_element: int = 1, with_D: bool = True) -> dict:
+    # DRAM addresses parallel_gemm uses: A, B, C, D (None without D) and a zeroed tile, then the DRAM size
+    addr_A = 0
+    addr_B = addr_A + M * K * bytes_per_element
+    addr_C = addr_B + K * N * bytes_per_element
+    addr_D = addr_C + M * N * bytes_per_element if with_D else None
+    zero_addr = addr_C + M * N * bytes_per_element * (2 if with_D else 1)
+    dram_size = zero_addr + matrix_dim * matrix_dim * bytes_per_element
+    return {"addr_A": addr_A, "addr_B": addr_B, "addr_C": addr_C, "addr_D": addr_D, "zero_addr": zero_addr, "dram_size": dram_size}
+
+def parallel_gemm(mat_A: np.ndarray, mat_B: np.ndarray, mat_D: np.ndarray, matrix_dim: int, num_matrices: int = 4,
+                  workers: int = None, dram_read_latency: int = 100, dram_write_latency: int = 10, burst_size: int = 64,
+                  gemm_cache_latencies: GemmCacheLatencies = None, cpu_latencies: CpuLatencies = None,
+                  num_registers: int = 8, register_bytes: int = 4) -> tuple[np.ndarray, dict]:
+    # C = A*B (+ D, None to skip) with operands of unsigned 1, 2 or 4 byte elements, laid out in DRAM by gemm_layout
+    # like large_matrix.py: A, B, C, D and a zeroed tile; workers=0 runs the jobs in this process
+    # returns (C, stats), stats has the cycles and instructions of the serial run and each job's tiles and cycles
+    M, K = mat_A.shape
+    N = mat_B.shape[1]
+    bpe = mat_A.dtype.itemsize
+    dtype = np.dtype(f">u{bpe}")
+    layout = gemm_layout(M, N, K, matrix_dim, bpe, mat_D is not None)
+    addr_A, addr_B, addr_C, addr_D = layout["addr_A"], layout["addr_B"], layout["addr_C"], layout["addr_D"]
+    zero_addr = layout["zero_addr"]
+    dram_size = layout["dram_size"]
+    codegen_params = {
+        "M": M, "N": N, "K": K, "matrix_dim": matrix_dim, "num_matrices": num_matrices, "gemm_cache_addr": dram_size,
+        "addr_A": addr_A, "addr_B": addr_B, "addr_C": addr_C, "addr_D": addr_D, "bytes_per_element": bpe,
+        "dataflow": "output_stationary", "zero_addr": zero_addr
+    }
+    program = Program(register_bytes)
+    codegen = GemmCodegen(**codegen_params)
+    codegen.generate(program)
+    program.halt()
+    assert len(program.get_instructions()) == len(program.instructions), "Error: generated GEMM must not use labels"
+    checkpoints = codegen.checkpoints
+    assert checkpoints[0][0] == 0
+    ends = [checkpoint[0] for checkpoint in checkpoints[1:]] + [len(program.instructions) - 1]
+    jobs = [(start, end, registers, slot_tiles) for (start, registers, slot_tiles, _), end in zip(checkpoints, ends)]
+
+    memory = SharedMemoryArray(dram_size)
+    try:
+        for addr, mat in ((addr_A, mat_A), (addr_B, mat_B), (addr_D, mat_D)):
+            if mat is not None:
+                memory.store_tile(addr, mat.shape[1] * bpe, mat.astype(dtype).view(np.uint8).reshape(mat.shape[0], -1))
+        with tempfile.TemporaryDirectory() as program_dir:
+            config = {
+                "shm_name": memory.name,
+                "program_path": os.path.join(program_dir, "gemm.npy"),
+                "dram_size": dram_size,
+                "dram_read_latency": dram_read_latency,
+                "dram_write_latency": dram_write_latency,
+                "burst_size": burst_size,
+                "gemm_cache_latencies": gemm_cache_latencies or GemmCacheLatencies(matrix_dim),
+                "cpu_latencies": cpu_latencies or CpuLatencies(),
+                "num_registers": num_registers,
+                "register_bytes": register_bytes,
+                "codegen": codegen_params
+            }
+            EncodedProgram.from_program(program).save(config["program_path"])
+            if workers == 0:
+                init_worker(config)
+                try:
+                    results = [run_job(job) for job in jobs]
+                finally:
+                    close_worker()
+            else:
+                workers = workers or os.cpu_count()
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config,)) as executor:
+                    chunksize = max(1, len(jobs) // (4 * workers))
+                    results = list(executor.map(run_job, jobs, chunksize=chunksize))
+        result = memory.load_tile(addr_C, M, N * bpe, N * bpe).view(dtype)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    stats = {
+        "cycles": sum(cycles for cycles, _ in results),
+        "instructions": sum(instructions for _, instructions in results) + 1, # the final halt
+        "jobs": [{"tiles": checkpoint[3], "cycles": cycles, "instructions": instructions} for checkpoint, (cycles, instructions) in zip(checkpoints, results)]
+    }
+    return result, stats
+
+if __name__ == "__main__":
+    print("ParallelGemm Test Begin")
+
+    def serial_gemm(mat_A, mat_B, mat_D, matrix_dim, num_matrices):
+        # the same layout and program as parallel_gemm run on one Cpu
+        M, K = mat_A.shape
+        N = mat_B.shape[1]
+        bpe = mat_A.dtype.itemsize
+        addr_C = (M * K + K * N) * bpe
+        addr_D = addr_C + M * N * bpe if mat_D is not None else None
+        zero_addr = addr_C + M * N * bpe * (2 if mat_D is not None else 1)
+        dram_size = zero_addr + matrix_dim * matrix_dim * bpe
+        dram = Dram(dram_size, 0, 100, 10)
+        for addr, mat in ((0, mat_A), (M * K * bpe, mat_B), (addr_D, mat_D)):
+            if mat is not None:
+                dram.memory.store_tile(addr, mat.shape[1] * bpe, mat.view(np.uint8).reshape(mat.shape[0], -1))
+        cpu = Cpu([dram, GemmCache(matrix_dim, num_matrices, dram_size, GemmCacheLatencies(matrix_dim), bpe)], 8, 4, 1, CpuLatencies())
+        program = Program(4)
+        GemmCodegen(M, N, K, matrix_dim, num_matrices, dram_size, 0, M * K * bpe, addr_C, addr_D, bpe, zero_addr=zero_addr).generate(program)
+        program.halt()
+        cpu.run_program(program)
+        return cpu
+
+    rng = np.random.default_rng(0)
+    # square, ragged with the A panel resident (6 slots), ragged in group mode without D, 2 byte elements
+    for M, N, K, matrix_dim, num_matrices, with_D, dtype in ((16, 16, 16, 4, 4, True, ">u1"), (13, 11, 9, 4, 6, True, ">u1"),
+                                                             (13, 11, 9, 4, 4, False, ">u1"), (9, 7, 8, 4, 4, True, ">u2")):
+        mat_A = rng.integers(0, 4, size=(M, K)).astype(dtype)
+        mat_B = rng.integers(0, 4, size=(K, N)).astype(dtype)
+        mat_D = rng.integers(0, 4, size=(M, N)).astype(dtype) if with_D else None
+        expected = (mat_A.astype(np.uint64) @ mat_B.astype(np.uint64) + (mat_D if with_D else 0)).astype(dtype)
+        serial = serial_gemm(mat_A, mat_B, mat_D, matrix_dim, num_matrices)
+        for workers in (0, 2):
+            result, stats = parallel_gemm(mat_A, mat_B, mat_D, matrix_dim, num_matrices, workers)
+            assert np.array_equal(result, expected), f"{M}x{N}x{K} with {workers} workers is not correct"
+            assert stats["cycles"] == serial.time and stats["instructions"] == serial.instructions_executed
+            tiles = sorted(tile for job in stats["jobs"] for tile in job["tiles"])
+            assert tiles == [(i, j) for i in range(-(-M // matrix_dim)) for j in range(-(-N // matrix_dim))]
+    print("ParallelGemm Test Finished")
@@ -0,0 +1,130 @@
+# prefetcher.py
+
+class Prefetcher:
+    # hardware prefetcher attached to a Cache
+    # the cache calls observe on every demand access and prefetches the block addresses it returns
+    # degree is how many blocks are prefetched per trigger, distance is how many blocks ahead the first one is
+    def __init__(self, block_size: int, degree: int = 1, distance: int = 1) -> None:
+        assert degree > 0 and distance > 0
+        self.block_size = block_size
+        self.degree = degree
+        self.distance = distance
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        # counters, updated by the cache
+        self.issued = 0 # prefetches filled into the cache
+        self.useful = 0 # prefetched blocks hit by a demand access before eviction
+        self.useless = 0 # prefetched blocks evicted or invalidated without being used
+        self.fill_bytes = 0 # bytes read from the next level for prefetches
+
+    def observe(self, addr: int, pc: int, hit: bool) -> list[int]:
+        return []
+
+    def get_stats(self) -> dict:
+        return {
+            "issued": self.issued,
+            "useful": self.useful,
+            "useless": self.useless,
+            "fill_bytes": self.fill_bytes,
+            "accuracy": self.useful / self.issued if self.issued > 0 else 0.0
+        }
+
+class NextLinePrefetcher(Prefetcher):
+    # on a miss, prefetch the next degree blocks starting distance blocks after the missing block
+    def observe(self, addr: int, pc: int, hit: bool) -> list[int]:
+        if hit:
+            return []
+        block = addr // self.block_size
+        return [(block + self.distance + i) * self.block_size for i in range(self.degree)]
+
+class StridePrefetcher(Prefetcher):
+    # reference prediction table indexed by pc, or by address region when the access has no pc
+    # once the same nonzero stride is seen twice in a row, prefetch degree strides starting distance strides ahead
+    def __init__(self, block_size: int, degree: int = 1, distance: int = 1, table_size: int = 64, region_bits: int = 12) -> None:
+        super().__init__(block_size, degree, distance)
+        self.table_size = table_size
+        self.region_bits = region_bits
+        self.table = {} # key -> [last addr, stride, confident], insertion ordered for FIFO replacement
+
+    def observe(self, addr: int, pc: int, hit: bool) -> list[int]:
+        key = ("pc", pc) if pc is not None else ("region", addr >> self.region_bits)
+        entry = self.table.get(key)
+        if entry is None:
+            if len(self.table) >= self.table_size:
+                del self.table[next(iter(self.table))]
+            self.table[key] = [addr, 0, False]
+            return []
+        stride = addr - entry[0]
+        entry[2] = stride != 0 and stride == entry[1]
+        entry[0] = addr
+        entry[1] = stride
+        if not entry[2]:
+            return []
+        blocks = []
+        for i in range(self.degree):
+            block_addr = (addr + stride * (self.distance + i)) // self.block_size * self.block_size
+            if block_addr != addr // self.block_size * self.block_size and block_addr not in blocks:
+                blocks.append(block_addr)
+        return blocks
+
+class StreamPrefetcher(Prefetcher):
+    # stream buffers: a miss within window blocks after (or before) a tracked stream confirms its direction,
+    # then each miss on the stream prefetches degree blocks starting distance blocks ahead
+    def __init__(self, block_size: int, degree: int = 2, distance: int = 1, num_streams: int = 4, window: int = 4) -> None:
+        super().__init__(block_size, degree, distance)
+        self.num_streams = num_streams
+        self.window = window
+        self.streams = [] # [last block, direction (0 when unconfirmed)], most recently used last
+
+    def observe(self, addr: int, pc: int, hit: bool) -> list[int]:
+        if hit:
+            return []
+        block = addr // self.block_size
+        for i, stream in enumerate(self.streams):
+            offset = block - stream[0]
+            if offset != 0 and abs(offset) <= self.window and (stream[1] == 0 or (offset > 0) == (stream[1] > 0)):
+                stream[0] = block
+                stream[1] = 1 if offset > 0 else -1
+                self.streams.append(self.streams.pop(i))
+                return [(block + stream[1] * (self.distance + j)) * self.block_size for j in range(self.degree)]
+        if len(self.streams) >= self.num_streams:
+            self.streams.pop(0)
+        self.streams.append([block, 0])
+        return []
+
+PREFETCHERS = {
+    "next_line": NextLinePrefetcher,
+    "stride": StridePrefetcher,
+    "stream": StreamPrefetcher
+}
+
+def make_prefetcher(name: str, block_size: int, **kwargs) -> Prefetcher:
+    assert name in PREFETCHERS, f"Unknown prefetcher {name}, expected one of {list(PREFETCHERS.keys())}"
+    return PREFETCHERS[name](block_size, **kwargs)
+
+if __name__ == "__main__":
+    print("Prefetcher Test Begin")
+
+    # next line only triggers on misses
+    next_line = make_prefetcher("next_line", 8, degree=2, distance=1)
+    assert next_line.observe(0x13, None, False) == [0x18, 0x20]
+    assert next_line.observe(0x13, None, True) == []
+
+    # stride needs the same stride twice before prefetching
+    stride = make_prefetcher("stride", 8, degree=2, distance=2)
+    assert stride.observe(0, 5, True) == []
+    assert stride.observe(32, 5, True) == []
+    assert stride.observe(64, 5, True) == [128, 160]
+    assert stride.observe(100, 7, True) == [] # other pc has its own entry
+    assert stride.observe(96, 5, True) == [160, 192]
+    assert stride.observe(97, 5, True) == [] # stride changed
+
+    # stream confirms a direction on the second miss and follows descending streams too
+    stream = make_prefetcher("stream", 8, degree=2, distance=1)
+    assert stream.observe(0x100, None, False) == []
+    assert stream.observe(0x108, None, False) == [0x110, 0x118]
+    assert stream.observe(0x500, None, False) == []
+    assert stream.observe(0x4F8, None, False) == [0x4F0, 0x4E8]
+    assert stream.observe(0x0F8, None, False) == [] # against the direction of the first stream
+    print("Prefetcher Test Finished")
@@ -0,0 +1,194 @@
+# profiler.py
+
+from memory import MemObject
+
+# packet methods whose added latency is attributed to the memory that served them
+PACKET_METHODS = ("process_packet", "process_tile_packet", "process_matrix_op_packet", "process_matrix_batch_packet")
+
+class Profiler:
+    # per opcode and per pc execution counts and cycles for Cpu.run_program(program, profiler=Profiler())
+    # memories reachable from the cpu (including next_level chains) get wrappers on their packet methods while
+    # profiling, so the cycles of memory instructions are attributed to each MemObject that served them
+    # (total cycles include the next levels, self cycles don't); copies started by dma_start run in the background
+    # and are counted as background cycles instead of being charged to the instruction, prefetch fills are
+    # counted by the memory that served them even though no instruction is charged for them
+    def __init__(self) -> None:
+        self.instructions = []
+        self.opcodes = {} # opcode -> [count, cycles]
+        self.pc_counts = {} # pc -> count
+        self.pc_cycles = {} # pc -> cycles
+        self.memories = {} # label -> {"packets", "cycles", "self_cycles", "background_cycles"}
+        self.stacks = {} # (frame, ...) -> cycles, for collapsed stack output
+        self.total_cycles = 0
+        self.memory_stack = [] # labels of the memories currently serving a packet
+        self.nested_cycles = [] # latency added by the next levels of each memory on memory_stack
+        self.current_memory = {} # memory path -> self cycles of the instruction being executed
+        self.background = False
+        self.patched = []
+
+    def attach(self, cpu, instructions: list[tuple]) -> None:
+        self.instructions = instructions
+        seen = set()
+        for idx, memory in enumerate(cpu.memories):
+            label = f"memories[{idx}]"
+            while isinstance(memory, MemObject) and id(memory) not in seen:
+                seen.add(id(memory))
+                self.wrap(memory, f"{type(memory).__name__}@{label}")
+                memory = getattr(memory, "next_level", None)
+                label += ".next_level"
+
+    def detach(self) -> None:
+        # the wrappers are instance attributes shadowing the class methods (or an outer wrapper, e.g. a trace)
+        for memory, method_name, previous in reversed(self.patched):
+            if previous is None:
+                delattr(memory, method_name)
+            else:
+                setattr(memory, method_name, previous)
+        self.patched = []
+
+    def wrap(self, memory: MemObject, label: str) -> None:
+        self.memories[label] = {"packets": 0, "cycles": 0, "self_cycles": 0, "background_cycles": 0}
+        for method_name in PACKET_METHODS:
+            if hasattr(memory, method_name):
+                self.patched.append((memory, method_name, vars(memory).get(method_name)))
+                setattr(memory, method_name, self.make_wrapper(getattr(memory, method_name), label))
+
+    def make_wrapper(self, method, label: str):
+        stats = self.memories[label]
+        def wrapper(pkt, *args):
+            if self.memory_stack and self.memory_stack[-1] == label:
+                # the memory calling its own packet methods (e.g. the generic process_tile_packet calls
+                # process_packet per row) is already being accounted by the outer call
+                return method(pkt, *args)
+            before = pkt.latency
+            self.memory_stack.append(label)
+            self.nested_cycles.append(0)
+            try:
+                resp = method(pkt, *args)
+            finally:
+                path = tuple(self.memory_stack)
+                nested = self.nested_cycles.pop()
+                self.memory_stack.pop()
+            cycles = resp.latency - before
+            stats["packets"] += 1
+            if self.background:
+                stats["background_cycles"] += cycles - nested
+            else:
+                stats["cycles"] += cycles
+                stats["self_cycles"] += cycles - nested
+                self.current_memory[path] = self.current_memory.get(path, 0) + cycles - nested
+            if self.nested_cycles:
+                self.nested_cycles[-1] += cycles
+            return resp
+        return wrapper
+
+    def begin(self, pc: int) -> None:
+        self.background = self.instructions[pc][0] == "dma_start"
+
+    def end(self, pc: int, cycles: int) -> None:
+        opcode = self.instructions[pc][0]
+        stats = self.opcodes.get(opcode)
+        if stats is None:
+            stats = self.opcodes[opcode] = [0, 0]
+        stats[0] += 1
+        stats[1] += cycles
+        self.pc_counts[pc] = self.pc_counts.get(pc, 0) + 1
+        self.pc_cycles[pc] = self.pc_cycles.get(pc, 0) + cycles
+        self.total_cycles += cycles
+
+        frames = (opcode, f"pc_{pc}")
+        memory_cycles = 0
+        for path, path_cycles in self.current_memory.items():
+            self.stacks[frames + path] = self.stacks.get(frames + path, 0) + path_cycles
+            memory_cycles += path_cycles
+        self.stacks[frames] = self.stacks.get(frames, 0) + cycles - memory_cycles
+        self.current_memory.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            "total_cycles": self.total_cycles,
+            "instructions": sum(self.pc_counts.values()),
+            "opcodes": {opcode: {"count": count, "cycles": cycles} for opcode, (count, cycles) in self.opcodes.items()},
+            "pcs": {pc: {"instruction": self.instructions[pc], "count": self.pc_counts[pc], "cycles": self.pc_cycles[pc]} for pc in sorted(self.pc_counts)},
+            "memories": {label: dict(stats) for label, stats in self.memories.items()}
+        }
+
+    def report(self, top_pcs: int = 20) -> str:
+        # text tables sorted by cycles
+        total = max(self.total_cycles, 1)
+        lines = [f"Total: {self.total_cycles} cycles, {sum(self.pc_counts.values())} instructions", "", f"{'opcode':24} {'count':>10} {'cycles':>12} {'%':>6}"]
+        for opcode, (count, cycles) in sorted(self.opcodes.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{opcode:24} {count:10} {cycles:12} {100 * cycles / total:6.1f}")
+        lines += ["", f"{'pc':>6} {'count':>10} {'cycles':>12} {'%':>6}  instruction"]
+        for pc in sorted(self.pc_cycles, key=lambda pc: -self.pc_cycles[pc])[:top_pcs]:
+            lines.append(f"{pc:6} {self.pc_counts[pc]:10} {self.pc_cycles[pc]:12} {100 * self.pc_cycles[pc] / total:6.1f}  {self.instructions[pc]}")
+        lines += ["", f"{'memory':40} {'packets':>10} {'cycles':>12} {'self':>12} {'background':>12}"]
+        for label, stats in sorted(self.memories.items(), key=lambda item: -item[1]["cycles"]):
+            lines.append(f"{label:40} {stats['packets']:10} {stats['cycles']:12} {stats['self_cycles']:12} {stats['background_cycles']:12}")
+        return "\n".join(lines)
+
+    def collapsed_stacks(self) -> str:
+        # one "frame;frame;... cycles" line per stack, the input format of flamegraph.pl and speedscope
+        return "\n".join(f"{';'.join(frames)} {cycles}" for frames, cycles in self.stacks.items() if cycles > 0) + "\n"
+
+    def write_collapsed_stacks(self, path: str) -> None:
+        with open(path, "w") as f:
+            f.write(self.collapsed_stacks())
+
+if __name__ == "__main__":
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    from gemm_cache import Cache
+    from program import Program
+    print("Profiler Test Begin")
+
+    dram = Dram(4096, 0, 100, 10)
+    cache = Cache(256, 4096, 8, 1, 1, dram)
+    cpu = Cpu([cache], 8, 4, 1, CpuLatencies())
+    program = Program(4)
+    program.move(1, 4)
+    program.insert_label("loop")
+    program.load_byte(2, 1, 0x100)
+    program.add_immediate(1, 1, -1)
+    program.label_branch_if(1, "loop")
+    program.halt()
+
+    profiler = Profiler()
+    cpu.run_program(program, profiler=profiler)
+    assert "process_packet" not in vars(cache) # wrappers are removed afterwards
+    stats = profiler.to_dict()
+    assert stats["total_cycles"] == cpu.time
+    # every load_byte starts at 1 cycle and pays the cache read, the first one also misses to DRAM
+    assert stats["opcodes"]["load_byte"] == {"count": 4, "cycles": 4 * (1 + 1) + 100}
+    assert stats["pcs"][1]["count"] == 4 and stats["pcs"][0]["cycles"] == 1
+    assert stats["memories"]["Cache@memories[0]"]["cycles"] == 104
+    assert stats["memories"]["Cache@memories[0]"]["self_cycles"] == 4
+    assert stats["memories"]["Dram@memories[0].next_level"]["self_cycles"] == 100
+    stacks = profiler.collapsed_stacks()
+    assert "load_byte;pc_1;Cache@memories[0];Dram@memories[0].next_level 100\n" in stacks
+    assert "load_byte;pc_1;Cache@memories[0] 4\n" in stacks
+    assert "load_byte;pc_1 4\n" in stacks and "add_immediate;pc_2 4\n" in stacks
+    assert profiler.report().splitlines()[3].startswith("load_byte")
+
+    # a tile move through the cache's generic process_tile_packet (one process_packet per row) is counted once
+    tile_cache = Cache(256, 4096, 8, 1, 1, Dram(4096, 0, 100, 10))
+    tile_cpu = Cpu([tile_cache], 8, 4, 1, CpuLatencies())
+    tile_program = Program(4)
+    tile_program.move(1, 0x100)
+    tile_program.move(2, 0x200)
+    tile_program.move_tile(1, 2, 4, 8, 8, 8)
+    tile_program.halt()
+    profiler = Profiler()
+    tile_cpu.run_program(tile_program, profiler=profiler)
+    stats = profiler.to_dict()
+    move_cycles = stats["pcs"][2]["cycles"]
+    cache_stats = stats["memories"]["Cache@memories[0]"]
+    assert cache_stats["cycles"] == move_cycles == 808 and cache_stats["packets"] == 2 # one load and one store tile packet
+    assert "Cache@memories[0];Cache@memories[0]" not in profiler.collapsed_stacks()
+    assert sum(cycles for frames, cycles in profiler.stacks.items() if frames[:2] == ("move_tile", "pc_2")) == move_cycles
+
+    # the same run without a profiler takes the same number of cycles
+    reference = Cpu([Cache(256, 4096, 8, 1, 1, Dram(4096, 0, 100, 10))], 8, 4, 1, CpuLatencies())
+    reference.run_program(program)
+    assert reference.time == cpu.time
+    print("Profiler Test Finished")
@@ -8,44 +8,57 @@ class Program:
         self.register_bytes = register_bytes
         self.half_register_mask = [0xf, 0xff, 0xfff, 0xffff][register_bytes-1]
         # half of length of each register in number of bytes for use in label_jump translation
+        self.assembled = None # result of the last get_instructions
+        self.assembled_length = 0 # len(self.instructions) when it was assembled, instructions are only ever appended
 
-	# convert labels to addresses and get instruction list
+    # convert labels to addresses and get instruction list
     def get_instructions(self) -> list[tuple]:
+        # two pass assembler, self.instructions is left untouched and the result is reused until an instruction is added
+        # callers must not modify the returned list
+        if self.assembled is not None and self.assembled_length == len(self.instructions):
+            return self.assembled
+
+        # pass 1: address of every label, labels take no space and each label_jump becomes 4 instructions
         labels = {}
-        label_branch_ifs = []
-        label_jumps = []
-        for i,instr in enumerate(self.instructions):
-            instr_addr = i - len(labels) + 3*len(label_jumps) # account for previous labels which will be removed and adds for jumps
+        addr = 0
+        for i, instr in enumerate(self.instructions):
             if instr[0] == "label":
-                assert not instr[1] in labels
-                labels[instr[1]] = instr_addr
-            if instr[0] == "label_branch_if":
-                label_branch_ifs.append(instr_addr)
-            if instr[0] == "label_jump":
-                label_jumps.append(instr_addr)
-        for label in labels.keys():
-            self.instructions.remove(("label", label))
-        for jump_addr in label_jumps:
-            assert self.instructions[jump_addr][0] == "label_jump"
-            available_register = self.instructions[jump_addr][1]
-            label = self.instructions[jump_addr][2]
-            dest_addr = labels[label]
-            left_half_addr = (dest_addr >> (self.register_bytes//2)) & self.half_register_mask
-            right_half_addr = dest_addr & self.half_register_mask
-            labeled_jump_to_jump_instrs = [
-                ("move", available_register, left_half_addr),
-                ("logical_shift_left", available_register, available_register, self.register_bytes*8//2),
-                ("move", available_register, right_half_addr)
-            ]
-            self.instructions[jump_addr] = ("jump", available_register)
-            self.instructions[jump_addr:jump_addr] = labeled_jump_to_jump_instrs
-        for branch_addr in label_branch_ifs:
-            assert self.instructions[branch_addr][0] == "label_branch_if"
-            branch = list(self.instructions[branch_addr])
-            branch[0] = "branch_if"
-            branch[2] = labels[branch[2]] - branch_addr
-            self.instructions[branch_addr] = tuple(branch)
-        return self.instructions
+                if instr[1] in labels:
+                    raise ValueError(f"Duplicate label {instr[1]!r} at instruction {i}")
+                labels[instr[1]] = addr
+            elif instr[0] == "label_jump":
+                addr += 4
+            else:
+                addr += 1
+
+        # pass 2: emit into a new list, resolving label_branch_if offsets and label_jump addresses
+        assembled = []
+        half_bits = self.register_bytes * 8 // 2
+        for i, instr in enumerate(self.instructions):
+            name = instr[0]
+            if name == "label":
+                continue
+            if name in ("label_branch_if", "label_jump"):
+                label = instr[2]
+                if label not in labels:
+                    raise ValueError(f"Undefined label {label!r} used by {name} at instruction {i}")
+                dest_addr = labels[label]
+                if name == "label_branch_if":
+                    assembled.append(("branch_if", instr[1], dest_addr - len(assembled)))
+                else:
+                    available_register = instr[1]
+                    assert dest_addr >> (2 * half_bits) == 0, f"Error: label {label!r} address doesn't fit in a register"
+                    # the left half is shifted into place and the right half is added to the zeroed low bits
+                    assembled.append(("move", available_register, (dest_addr >> half_bits) & self.half_register_mask))
+                    assembled.append(("logical_shift_left", available_register, available_register, half_bits))
+                    assembled.append(("add_immediate", available_register, available_register, dest_addr & self.half_register_mask))
+                    assembled.append(("jump", available_register))
+            else:
+                assembled.append(instr)
+
+        self.assembled = assembled
+        self.assembled_length = len(self.instructions)
+        return assembled
 
     def halt(self) -> None:
         self.instructions.append(("halt",)) # comma required to make single element tuple
@@ -74,6 +87,15 @@ class Program:
     def move_memory(self, src_addr_register: int, dest_addr_register: int, size_register: int) -> None:
         self.instructions.append(("move_memory", src_addr_register, dest_addr_register, size_register))
 
+    def move_tile(self, src_addr_register: int, dest_addr_register: int, rows: int, cols: int, src_stride: int, dest_stride: int) -> None:
+        self.instructions.append(("move_tile", src_addr_register, dest_addr_register, rows, cols, src_stride, dest_stride))
+
+    def dma_start(self, src_addr_register: int, dest_addr_register: int, size_register: int, tag: int) -> None:
+        self.instructions.append(("dma_start", src_addr_register, dest_addr_register, size_register, tag))
+
+    def dma_wait(self, tag: int) -> None: # tag -1 waits for every outstanding transfer
+        self.instructions.append(("dma_wait", tag))
+
     def move(self, dest_register: int, immediate: int) -> int:
         self.instructions.append(("move", dest_register, immediate))
 
@@ -118,3 +140,55 @@ class Program:
 
     def matrix_add(self, dest_addr_register: int, src_addr_register1: int, src_addr_register2: int) -> int:
         self.instructions.append(("matrix_add", dest_addr_register, src_addr_register1, src_addr_register2))
+
+    def matrix_multiply_batch(self, dest_addr_register: int, src_addr_register1: int, src_addr_register2: int, count: int, dest_stride: int, src1_stride: int, src2_stride: int, accumulate: bool = False) -> int:
+        # count, strides (in bytes) and accumulate are immediates
+        self.instructions.append(("matrix_multiply_batch", dest_addr_register, src_addr_register1, src_addr_register2, count, dest_stride, src1_stride, src2_stride, accumulate))
+
+    def matrix_add_batch(self, dest_addr_register: int, src_addr_register1: int, src_addr_register2: int, count: int, dest_stride: int, src1_stride: int, src2_stride: int) -> int:
+        self.instructions.append(("matrix_add_batch", dest_addr_register, src_addr_register1, src_addr_register2, count, dest_stride, src1_stride, src2_stride))
+
+if __name__ == "__main__":
+    from cpu import Cpu, CpuLatencies
+    from dram import Dram
+    print("Program Test Begin")
+
+    program = Program(4)
+    program.move(1, 3)
+    program.insert_label("loop")
+    program.add_immediate(1, 1, -1)
+    program.label_branch_if(1, "loop")
+    program.label_jump(2, "far")
+    for _ in range(70000): # pushes "far" past the 16 bit right half of the register
+        program.halt()
+    program.insert_label("far")
+    program.move(3, 7)
+    program.halt()
+
+    instructions = program.get_instructions()
+    assert instructions[2] == ("branch_if", 1, -1)
+    assert instructions[3:7] == [("move", 2, 1), ("logical_shift_left", 2, 2, 16), ("add_immediate", 2, 2, 70007 & 0xffff), ("jump", 2)]
+    # assembling is non destructive and cached until the program changes
+    assert program.instructions[1] == ("label", "loop")
+    assert program.get_instructions() is instructions
+    program.halt()
+    assert len(program.get_instructions()) == len(instructions) + 1
+
+    cpu = Cpu([Dram(64, 0, 1, 1)], 4, 4, 1, CpuLatencies())
+    cpu.run_program(program)
+    assert cpu.registers[3] == 7 and cpu.registers[1] == 0
+
+    # undefined and duplicate labels are reported
+    for bad_label in ("loop", "missing"):
+        program = Program(4)
+        program.insert_label("loop")
+        program.label_jump(1, bad_label)
+        if bad_label == "loop":
+            program.insert_label("loop")
+        try:
+            program.get_instructions()
+        except ValueError:
+            pass
+        else:
+            assert False
+    print("Program Test Finished")
@@ -0,0 +1,138 @@
+# replacement_policy.py
+
+import numpy as np
+import random
+
+class ReplacementPolicy:
+    # tracks per set replacement state for a set associative cache
+    # the cache calls touch on hits, insert on fills and victim when every way of a set is valid
+    def __init__(self, num_sets: int, num_ways: int) -> None:
+        self.num_sets = num_sets
+        self.num_ways = num_ways
+
+    def touch(self, set_idx: int, way: int) -> None:
+        pass
+
+    def insert(self, set_idx: int, way: int) -> None:
+        self.touch(set_idx, way)
+
+    def victim(self, set_idx: int) -> int:
+        pass
+
+class LruPolicy(ReplacementPolicy):
+    # true LRU, each way stores the time of its last access
+    def __init__(self, num_sets: int, num_ways: int) -> None:
+        super().__init__(num_sets, num_ways)
+        self.last_access = np.zeros((num_sets, num_ways), dtype=np.uint64)
+        self.clock = 0
+
+    def touch(self, set_idx: int, way: int) -> None:
+        self.clock += 1
+        self.last_access[set_idx, way] = self.clock
+
+    def victim(self, set_idx: int) -> int:
+        return int(np.argmin(self.last_access[set_idx]))
+
+class TreePlruPolicy(ReplacementPolicy):
+    # tree pseudo LRU, num_ways - 1 bits per set stored as a binary heap
+    # a bit of 0 points the victim search to the left subtree and 1 to the right subtree
+    def __init__(self, num_sets: int, num_ways: int) -> None:
+        super().__init__(num_sets, num_ways)
+        assert num_ways & (num_ways - 1) == 0, "Tree PLRU needs a power of 2 number of ways"
+        self.levels = num_ways.bit_length() - 1
+        self.bits = np.zeros((num_sets, max(num_ways - 1, 1)), dtype=np.uint8)
+
+    def touch(self, set_idx: int, way: int) -> None:
+        # point every node on the path away from the accessed way
+        node = 0
+        for level in range(self.levels - 1, -1, -1):
+            direction = (way >> level) & 1
+            self.bits[set_idx, node] = 1 - direction
+            node = 2 * node + 1 + direction
+
+    def victim(self, set_idx: int) -> int:
+        node = 0
+        way = 0
+        for _ in range(self.levels):
+            direction = int(self.bits[set_idx, node])
+            way = (way << 1) | direction
+            node = 2 * node + 1 + direction
+        return way
+
+class RandomPolicy(ReplacementPolicy):
+    def __init__(self, num_sets: int, num_ways: int, seed: int = 0) -> None:
+        super().__init__(num_sets, num_ways)
+        self.rng = random.Random(seed)
+
+    def victim(self, set_idx: int) -> int:
+        return self.rng.randrange(self.num_ways)
+
+class RripPolicy(ReplacementPolicy):
+    # static re-reference interval prediction (SRRIP) with rrpv_bits bits per way
+    # fills are predicted to be re-referenced in a long interval, hits in the near future
+    def __init__(self, num_sets: int, num_ways: int, rrpv_bits: int = 2) -> None:
+        super().__init__(num_sets, num_ways)
+        self.max_rrpv = (1 << rrpv_bits) - 1
+        self.rrpv = np.full((num_sets, num_ways), self.max_rrpv, dtype=np.uint8)
+
+    def touch(self, set_idx: int, way: int) -> None:
+        self.rrpv[set_idx, way] = 0
+
+    def insert(self, set_idx: int, way: int) -> None:
+        self.rrpv[set_idx, way] = self.max_rrpv - 1
+
+    def victim(self, set_idx: int) -> int:
+        # age the whole set until some way reaches the distant re-reference value
+        rrpv = self.rrpv[set_idx]
+        rrpv += self.max_rrpv - rrpv.max()
+        return int(np.argmax(rrpv == self.max_rrpv))
+
+REPLACEMENT_POLICIES = {
+    "lru": LruPolicy,
+    "plru": TreePlruPolicy,
+    "random": RandomPolicy,
+    "rrip": RripPolicy
+}
+
+def make_replacement_policy(name: str, num_sets: int, num_ways: int) -> ReplacementPolicy:
+    assert name in REPLACEMENT_POLICIES, f"Unknown replacement policy {name}, expected one of {list(REPLACEMENT_POLICIES.keys())}"
+    return REPLACEMENT_POLICIES[name](num_sets, num_ways)
+
+if __name__ == "__main__":
+    print("ReplacementPolicy Test Begin")
+
+    # LRU evicts the least recently touched way
+    lru = make_replacement_policy("lru", 2, 4)
+    for way in range(4):
+        lru.insert(1, way)
+    lru.touch(1, 0)
+    assert lru.victim(1) == 1
+    lru.touch(1, 1)
+    assert lru.victim(1) == 2
+
+    # Tree PLRU evicts a way in the subtree that was not touched last
+    plru = make_replacement_policy("plru", 2, 4)
+    for way in range(4):
+        plru.insert(0, way)
+    assert plru.victim(0) == 0
+    plru.touch(0, 0)
+    assert plru.victim(0) == 2
+    plru.touch(0, 2)
+    assert plru.victim(0) == 1
+    assert make_replacement_policy("plru", 1, 1).victim(0) == 0
+
+    # Random stays inside the set
+    rand = make_replacement_policy("random", 2, 4)
+    assert all(0 <= rand.victim(0) < 4 for _ in range(100))
+
+    # RRIP evicts ways that were filled but never hit before ways that hit
+    rrip = make_replacement_policy("rrip", 1, 4)
+    for way in range(4):
+        rrip.insert(0, way)
+    rrip.touch(0, 0)
+    rrip.touch(0, 1)
+    assert rrip.victim(0) == 2
+    rrip.insert(0, 2)
+    rrip.touch(0, 2)
+    assert rrip.victim(0) == 3
+    print("ReplacementPolicy Test Finished")
@@ -0,0 +1,174 @@
+# sweep.py
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cpu import Cpu, CpuLatencies
+from dram import Dram
+from gemm_cache import GemmCache, GemmCacheLatencies
+from gemm_codegen import generate_gemm
+from program import Program
+import numpy as np
+import contextlib
+import itertools
+import argparse
+import json
+import time
+import csv
+import io
+import os
+
+# every parameter a sweep point can set, anything missing from a point uses these values
+# cpu_<name> and gemm_<name> override the attribute <name> of CpuLatencies and GemmCacheLatencies
+DEFAULT_PARAMS = {
+    "M": 25,
+    "N": 25,
+    "K": 25,
+    "tile_dim": 5,
+    "num_matrices": 4,
+    "bytes_per_element": 1,
+    "dataflow": "output_stationary",
+    "dram_read_latency": 100,
+    "dram_write_latency": 10,
+    "burst_size": 64,
+    "seed": 0
+}
+
+RESULT_FIELDS = ["cycles", "instructions", "correct", "seconds", "error"]
+
+def expand_grid(grid: dict[str, list]) -> list[dict]:
+    # cartesian product of the value lists, e.g. {"tile_dim": [4, 8], "dataflow": [...]}
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def run_point(point: dict) -> dict:
+    # simulate one GEMM and return the point with its cycles and correctness, printing is suppressed
+    params = dict(DEFAULT_PARAMS, **point)
+    result = dict(point)
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result.update(simulate(params))
+        result["error"] = ""
+    except Exception as e:
+        result.update({"cycles": None, "instructions": None, "correct": False, "error": f"{type(e).__name__}: {e}"})
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def simulate(params: dict) -> dict:
+    M, N, K = params["M"], params["N"], params["K"]
+    tile_dim = params["tile_dim"]
+    bpe = params["bytes_per_element"]
+    dtype = np.dtype(f">u{bpe}")
+
+    cpu_latencies = CpuLatencies()
+    gemm_cache_latencies = GemmCacheLatencies(tile_dim)
+    for key, value in params.items():
+        if key.startswith("cpu_"):
+            assert hasattr(cpu_latencies, key[4:]), f"Error: CpuLatencies has no {key[4:]}"
+            setattr(cpu_latencies, key[4:], value)
+        elif key.startswith("gemm_"):
+            assert hasattr(gemm_cache_latencies, key[5:]), f"Error: GemmCacheLatencies has no {key[5:]}"
+            setattr(gemm_cache_latencies, key[5:], value)
+        else:
+            assert key in DEFAULT_PARAMS, f"Error: unknown sweep parameter {key}"
+
+    rng = np.random.default_rng(params["seed"])
+    mat_A = rng.integers(0, 2, size=(M, K)).astype(dtype)
+    mat_B = rng.integers(0, 2, size=(K, N)).astype(dtype)
+    mat_D = rng.integers(0, 2, size=(M, N)).astype(dtype)
+    expected = (mat_A.astype(np.uint64) @ mat_B.astype(np.uint64) + mat_D).astype(dtype)
+
+    addr_A = 0
+    addr_B = addr_A + mat_A.nbytes
+    addr_C = addr_B + mat_B.nbytes
+    addr_D = addr_C + mat_D.nbytes
+    addr_zero = addr_D + mat_D.nbytes
+    dram_size = addr_zero + tile_dim * tile_dim * bpe
+    dram = Dram(dram_size, 0, params["dram_read_latency"], params["dram_write_latency"], params["burst_size"])
+    for addr, mat in ((addr_A, mat_A), (addr_B, mat_B), (addr_D, mat_D)):
+        dram.memory.store_tile(addr, mat.shape[1] * bpe, mat.view(np.uint8).reshape(mat.shape[0], -1))
+    gemm_cache = GemmCache(tile_dim, params["num_matrices"], dram_size, gemm_cache_latencies, bpe)
+    cpu = Cpu([dram, gemm_cache], 8, 4, 1, cpu_latencies)
+
+    program = Program(4)
+    generate_gemm(program, M, N, K, tile_dim, params["num_matrices"], dram_size, addr_A, addr_B, addr_C, addr_D,
+                  bpe, params["dataflow"], addr_zero)
+    program.halt()
+    cpu.run_program(program)
+
+    result = dram.memory.load_tile(addr_C, M, N * bpe, N * bpe).view(dtype)
+    return {"cycles": cpu.time, "instructions": len(program.get_instructions()), "correct": bool(np.array_equal(result, expected))}
+
+def completed_points(output_path: str) -> list[dict]:
+    # points that finished without an error in an output file, so an interrupted sweep can resume
+    # and rerun the points that failed (their new rows are appended after the failed ones)
+    if not os.path.exists(output_path):
+        return []
+    with open(output_path, newline="") as f:
+        if output_path.endswith(".csv"):
+            results = [{key: parse_csv_value(value) for key, value in row.items()} for row in csv.DictReader(f)]
+        else:
+            results = [json.loads(line) for line in f if line.strip()]
+    return [{key: value for key, value in result.items() if key not in RESULT_FIELDS} for result in results if not result.get("error")]
+
+def existing_fields(output_path: str) -> list[str]:
+    # columns of the rows already in an output file in order, None for a missing or empty file
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return None
+    with open(output_path, newline="") as f:
+        if output_path.endswith(".csv"):
+            return next(csv.reader(f), None)
+        line = next((line for line in f if line.strip()), None)
+        return list(json.loads(line)) if line else None
+
+def parse_csv_value(value: str):
+    # CSV stores everything as text, numbers and booleans are read back through json
+    try:
+        return json.loads(value.lower() if value in ("True", "False") else value)
+    except ValueError:
+        return value
+
+def run_sweep(grid: dict[str, list], output_path: str, workers: int = None, resume: bool = True) -> list[dict]:
+    # runs every point of the grid on a process pool, each result is appended to output_path as soon as it finishes
+    # output_path ending in .csv writes CSV, anything else writes JSON lines
+    # resuming appends to the file, so its rows must have the grid's keys; CSV rows keep the file's column order
+    points = expand_grid(grid)
+    fields = existing_fields(output_path) if resume else None
+    if fields is not None:
+        point_keys = [field for field in fields if field not in RESULT_FIELDS]
+        if set(point_keys) != set(grid.keys()):
+            raise ValueError(f"{output_path} has points with keys {point_keys}, not the grid's {list(grid.keys())}, "
+                             "use another output or --no-resume")
+        done = completed_points(output_path)
+        points = [point for point in points if point not in done]
+    as_csv = output_path.endswith(".csv")
+
+    results = []
+    with open(output_path, "a" if resume else "w", newline="") as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=fields or list(grid.keys()) + RESULT_FIELDS) if as_csv else None
+        if as_csv and fields is None:
+            writer.writeheader()
+        futures = [executor.submit(run_point, point) for point in points]
+        for future in as_completed(futures):
+            result = future.result()
+            if as_csv:
+                writer.writerow(result)
+            else:
+                f.write(json.dumps(result) + "\n")
+            f.flush()
+            results.append(result)
+            print(f"[{len(results)}/{len(points)}] {result}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a GEMM design space sweep on a process pool")
+    parser.add_argument("grid", help='JSON file mapping parameters to lists of values, e.g. {"tile_dim": [5, 25], "num_matrices": [4, 8]}')
+    parser.add_argument("--output", default="sweep.jsonl", help="results file, .csv for CSV, otherwise JSON lines")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the number of CPUs")
+    parser.add_argument("--no-resume", action="store_true", help="overwrite the output instead of skipping points that finished without an error")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    results = run_sweep(grid, args.output, args.workers, not args.no_resume)
+    failed = [result for result in results if not result["correct"]]
+    print(f"Ran {len(results)} points, {len(failed)} incorrect or failed")
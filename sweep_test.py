@@ -0,0 +1,43 @@
+# sweep_test.py
+
+from sweep import run_sweep, completed_points
+import contextlib
+import tempfile
+import csv
+import io
+import os
+
+if __name__ == "__main__":
+    print("Sweep Test Begin")
+
+    grid = {"M": [8], "N": [8], "K": [8], "tile_dim": [4, 3]}
+    for name in ("results.csv", "results.jsonl"):
+        with tempfile.TemporaryDirectory() as out_dir, contextlib.redirect_stdout(io.StringIO()):
+            path = os.path.join(out_dir, name)
+            results = run_sweep({"M": [8], "N": [8], "K": [8], "tile_dim": [4]}, path, workers=1)
+            assert len(results) == 1 and results[0]["correct"]
+
+            # same keys in another order, only the new point runs and CSV rows follow the file's header
+            results = run_sweep({"tile_dim": [4, 3], "K": [8], "N": [8], "M": [8]}, path, workers=1)
+            assert [result["tile_dim"] for result in results] == [3]
+            done = completed_points(path)
+            assert {point["tile_dim"] for point in done} == {4, 3} and all(point["M"] == 8 for point in done)
+            if name.endswith(".csv"):
+                with open(path, newline="") as f:
+                    rows = list(csv.DictReader(f))
+                assert all(row["correct"] == "True" and int(row["cycles"]) > 100 for row in rows)
+
+            # added or removed keys would misalign the rows, resuming refuses and the file is untouched
+            size = os.path.getsize(path)
+            for changed in (dict(grid, dataflow=["output_stationary"]), {"M": [8], "N": [8], "tile_dim": [4]}):
+                try:
+                    run_sweep(changed, path, workers=1)
+                    assert False, "Error: resuming with a changed grid must fail"
+                except ValueError:
+                    pass
+                assert os.path.getsize(path) == size
+
+            # without resume the file is rewritten for the new grid
+            results = run_sweep(dict(grid, dataflow=["output_stationary"]), path, workers=1, resume=False)
+            assert len(results) == 2 and len(completed_points(path)) == 2
+    print("Sweep Test Finished")